@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Counts the App Engine API calls (datastore, memcache, ...) made by each
+# blog handler for a single anonymous request.
+#
+# Requires the App Engine SDK; run from the root of the repository with the
+# SDK on the path:
+#   PYTHONPATH=$APPENGINE_SDK python benchmark/datastore_rpc_benchmark.py
+
+import os
+import sys
+import wsgiref.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+from tornado.options import options, define, parse_command_line
+
+define("entries", default=20, type=int, help="number of entries to create")
+define("comments", default=30, type=int, help="comments on the probed entry")
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+_calls = {}
+
+def _count_call(service, call, request, response, rpc=None):
+    key = "%s.%s" % (service, call)
+    _calls[key] = _calls.get(key, 0) + 1
+
+
+def _setup():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        "rpc_counter", _count_call)
+    return bed
+
+
+def _request(application, path, method="GET"):
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path}
+    wsgiref.util.setup_testing_defaults(environ)
+    if "?" in path:
+        environ["PATH_INFO"], environ["QUERY_STRING"] = path.split("?", 1)
+    result = {}
+    def start_response(status, headers):
+        result["status"] = status
+    body = "".join(application(environ, start_response))
+    return result["status"], body
+
+
+def _populate(blog):
+    import datetime
+    start = datetime.datetime(2011, 1, 1)
+    prev = None
+    for i in range(options.entries):
+        entry = blog.Entry(title=u"Entry %d" % i, slug=u"entry-%d" % i,
+                           markdown=u"Hello", html=u"<p>Hello</p>",
+                           categories=[blog.db.Category(u"python")])
+        entry.set_neighbours(prev, None)
+        entry.put()
+        # auto_now_add ignores the constructor argument, so fix it up
+        entry.published = start + datetime.timedelta(days=i)
+        entry.updated = entry.published
+        entry.put()
+        entry.update_neighbours()
+        blog.ArchiveSummary.record_entry(published=entry.published,
+                                         added_categories=entry.categories)
+        prev = entry
+    probe = blog.Entry.get_by_slug(u"entry-%d" % (options.entries // 2))
+    for i in range(options.comments):
+        blog.Comment(author=u"reader", email="reader@example.com",
+                     url="http://example.com/", body=u"Nice post",
+                     slug=probe.slug).put()
+        blog.db.run_in_transaction(blog.Entry.increment_comment_count,
+                                   probe.key())
+    return probe
+
+
+def main():
+    parse_command_line()
+    bed = _setup()
+    try:
+        import blog
+        probe = _populate(blog)
+        paths = ["/page/1/", "/entry/" + probe.slug, "/archive",
+                 "/feed", "/categories/python/", "/2011/01"]
+        for path in paths:
+            # The first request warms memcache; report the second one
+            _request(blog.application, path)
+            _calls.clear()
+            status, body = _request(blog.application, path)
+            total = sum(_calls.values())
+            datastore = sum(n for k, n in _calls.items()
+                            if k.startswith("datastore_v3."))
+            print "%-20s %-8s %3d RPCs (%d datastore)  %s" % (
+                path, status.split()[0], total, datastore,
+                ", ".join("%s=%d" % item for item in sorted(_calls.items())))
+    finally:
+        bed.deactivate()
+
+if __name__ == "__main__":
+    main()
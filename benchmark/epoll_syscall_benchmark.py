@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Counts the system calls HTTPServer makes to serve keep-alive clients,
+# with connections registered level-triggered (switched between reading
+# and writing with epoll_ctl for every request) and edge-triggered
+# (registered once). Each client sends its requests one after
+# another over a single HTTP/1.1 connection, from its own process; with
+# --pipeline, it sends that many at once before reading the responses.
+#
+# epoll_ctl calls are counted through the IOLoop's add_handler,
+# update_handler and remove_handler, epoll_wait calls as the IOLoop's
+# wakeups, and recv and send through a wrapper around each connection's
+# socket. Requires epoll (Linux).
+#
+# Run from the root of the repository:
+#   python benchmark/epoll_syscall_benchmark.py --clients=10 --requests=1000
+#   python benchmark/epoll_syscall_benchmark.py --pipeline=16
+
+import logging
+import os
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tornado import httpserver
+from tornado import ioloop
+from tornado import iostream
+from tornado import web
+from tornado.options import options, define, parse_command_line
+from tornado.testing import get_unused_port
+
+define("clients", default=10, type=int, help="number of client connections")
+define("requests", default=1000, type=int,
+       help="number of requests sent over each connection")
+define("pipeline", default=1, type=int,
+       help="requests each client sends before reading their responses")
+define("think_time", default=0.001, type=float,
+       help="seconds each client waits before its next request, as a "
+       "stand-in for the network round trip")
+
+COUNTERS = ["epoll_ctl", "epoll_wait", "recv", "send", "wake"]
+
+
+class HelloHandler(web.RequestHandler):
+    def get(self):
+        self.write("Hello, world")
+
+
+class _CountingSocket(object):
+    """Counts the recv and send calls made on a socket."""
+    def __init__(self, socket, counts):
+        self._socket = socket
+        self._counts = counts
+
+    def recv(self, *args):
+        self._counts["recv"] += 1
+        return self._socket.recv(*args)
+
+    def send(self, *args):
+        self._counts["send"] += 1
+        return self._socket.send(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+def _count_calls(obj, name, counts, counter):
+    method = getattr(obj, name)
+    def wrapper(*args, **kwargs):
+        counts[counter] += 1
+        return method(*args, **kwargs)
+    setattr(obj, name, wrapper)
+
+
+def _client(port, num_requests):
+    sock = socket.create_connection(("127.0.0.1", port), 10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data = ""
+    for i in xrange(0, num_requests, options.pipeline):
+        if i and options.think_time:
+            time.sleep(options.think_time)
+        batch = min(options.pipeline, num_requests - i)
+        sock.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n\r\n" * batch)
+        while batch:
+            end = data.find("\r\n\r\n")
+            if end != -1:
+                length = int(re.search(r"Content-Length: (\d+)",
+                                       data[:end]).group(1))
+                if len(data) >= end + 4 + length:
+                    data = data[end + 4 + length:]
+                    batch -= 1
+                    continue
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise IOError("connection closed")
+            data += chunk
+    sock.close()
+
+
+def _start_client(port, num_requests):
+    """Runs a client in a child process, so it doesn't share the GIL."""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            _client(port, num_requests)
+        except Exception:
+            logging.error("Client failed", exc_info=True)
+            status = 1
+        os._exit(status)
+    return pid
+
+
+def run(edge_triggered):
+    """Returns the counters and seconds taken to serve every client."""
+    counts = dict((name, 0) for name in COUNTERS)
+    io_loop = ioloop.IOLoop()
+    for name in ("add_handler", "update_handler", "remove_handler"):
+        _count_calls(io_loop, name, counts, "epoll_ctl")
+    _count_calls(io_loop, "_wake", counts, "wake")
+
+    original_stream = iostream.IOStream
+    class CountingIOStream(original_stream):
+        def __init__(self, socket, *args, **kwargs):
+            original_stream.__init__(
+                self, _CountingSocket(socket, counts), *args, **kwargs)
+
+    server = httpserver.HTTPServer(web.Application([("/", HelloHandler)]),
+                                   io_loop=io_loop,
+                                   edge_triggered=edge_triggered)
+    port = get_unused_port()
+    server.listen(port, "127.0.0.1")
+    pids = [_start_client(port, options.requests)
+            for i in xrange(options.clients)]
+    failed = []
+    def wait_for_clients():
+        for pid in pids:
+            if os.waitpid(pid, 0)[1]:
+                failed.append(pid)
+        io_loop.add_callback(io_loop.stop)
+    # HTTPServer looks the class up when it accepts each connection
+    iostream.IOStream = CountingIOStream
+    try:
+        start = time.time()
+        threading.Thread(target=wait_for_clients).start()
+        io_loop.start()
+        elapsed = time.time() - start
+    finally:
+        iostream.IOStream = original_stream
+    server.stop()
+    counts["epoll_wait"] = io_loop.stats()["wakeups"]
+    if failed:
+        raise Exception("%d clients failed" % len(failed))
+    return counts, elapsed
+
+
+def main():
+    parse_command_line()
+    # Don't log every request
+    logging.getLogger().setLevel(logging.WARNING)
+    if not hasattr(select, "epoll"):
+        print "epoll is not available"
+        return
+    total = options.clients * options.requests
+    print "%d clients, %d requests each, %d at a time; " \
+        "system calls per request:" % (
+        options.clients, options.requests, options.pipeline)
+    print "%-16s%s %10s" % ("", "".join("%11s" % name for name in COUNTERS),
+                            "req/s")
+    for name, edge_triggered in (("level-triggered", False),
+                                 ("edge-triggered", True)):
+        counts, elapsed = run(edge_triggered)
+        print "%-16s%s %10d" % (
+            name, "".join("%11.2f" % (float(counts[counter]) / total)
+                          for counter in COUNTERS),
+            total / elapsed)
+
+if __name__ == "__main__":
+    main()
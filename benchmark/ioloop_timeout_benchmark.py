@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Microbenchmark of IOLoop timeouts: schedules many timeouts, as a server
+# with thousands of keep-alive connections and client requests does,
+# cancels most of them before they expire and runs the rest.
+#
+# With --compare, the timings of the sorted list the IOLoop used before
+# (bisect.insort, list.remove and pop(0)) are printed too; removal from
+# it is quadratic, so use a smaller --num.
+#
+# Run from the root of the repository:
+#   python benchmark/ioloop_timeout_benchmark.py --num=100000
+#   python benchmark/ioloop_timeout_benchmark.py --num=10000 --compare
+
+import bisect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tornado import ioloop
+from tornado.options import options, define, parse_command_line
+
+define("num", default=100000, type=int, help="number of timeouts")
+define("cancel", default=0.9, type=float,
+       help="fraction of the timeouts cancelled before they expire")
+define("compare", default=False, type=bool,
+       help="also time the previous sorted list of timeouts")
+
+
+class _OldTimeout(object):
+    """The timeout handle of the previous IOLoop."""
+    __slots__ = ['deadline', 'callback']
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+
+    def __lt__(self, other):
+        return ((self.deadline, id(self.callback)) <
+                (other.deadline, id(other.callback)))
+
+
+class _ListTimeouts(object):
+    """The sorted list of timeouts of the previous IOLoop."""
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        timeout = _OldTimeout(deadline, callback)
+        bisect.insort(self.timeouts, timeout)
+        return timeout
+
+    def remove_timeout(self, timeout):
+        self.timeouts.remove(timeout)
+
+    def run_expired(self, now):
+        while self.timeouts and self.timeouts[0].deadline <= now:
+            self.timeouts.pop(0).callback()
+
+
+class _LoopTimeouts(object):
+    """Runs expired timeouts through one IOLoop iteration."""
+    def __init__(self):
+        self.io_loop = ioloop.IOLoop()
+        self.add_timeout = self.io_loop.add_timeout
+        self.remove_timeout = self.io_loop.remove_timeout
+
+    def run_expired(self, now):
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.io_loop.start()
+
+
+def run(timeouts, deadlines, cancelled):
+    """Returns the seconds taken to add, remove and run the timeouts."""
+    calls = [0]
+    def callback():
+        calls[0] += 1
+    results = []
+    start = time.time()
+    handles = [timeouts.add_timeout(deadline, callback)
+               for deadline in deadlines]
+    results.append(time.time() - start)
+    start = time.time()
+    for i in cancelled:
+        timeouts.remove_timeout(handles[i])
+    results.append(time.time() - start)
+    start = time.time()
+    timeouts.run_expired(max(deadlines))
+    results.append(time.time() - start)
+    assert calls[0] == len(deadlines) - len(cancelled), calls
+    return results
+
+
+def main():
+    parse_command_line()
+    # Deadlines are in the past so that the last step runs them all
+    now = time.time()
+    deadlines = [now - random.random() for i in xrange(options.num)]
+    cancelled = random.sample(xrange(options.num),
+                              int(options.num * options.cancel))
+    print "%d timeouts, %d cancelled" % (options.num, len(cancelled))
+    print "%-12s %10s %10s %10s" % ("", "add", "remove", "run")
+    implementations = [("heap", _LoopTimeouts())]
+    if options.compare:
+        implementations.append(("sorted list", _ListTimeouts()))
+    for name, timeouts in implementations:
+        print "%-12s %9.3fs %9.3fs %9.3fs" % (
+            (name,) + tuple(run(timeouts, deadlines, cancelled)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Microbenchmarks of IOStream buffering: read_until on request headers
+# that arrive in small chunks, as they do from slow or pipelining clients,
+# and the bytes copied while writing responses out in partial sends.
+#
+# Run from the root of the repository:
+#   python benchmark/iostream_benchmark.py --chunk=16 --headers=100
+
+import collections
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tornado import iostream
+from tornado.iostream import IOStream
+from tornado.options import options, define, parse_command_line
+
+define("num", default=200, type=int, help="number of requests to parse")
+define("chunk", default=16, type=int, help="bytes per socket read")
+define("headers", default=100, type=int, help="header lines per request")
+define("send_size", default=65536, type=int,
+       help="bytes accepted by each socket send call")
+
+
+class _ChunkedStream(IOStream):
+    """An IOStream whose reads return queued chunks instead of calling
+    recv(), so that only the buffer handling is timed."""
+    def __init__(self, *args, **kwargs):
+        super(_ChunkedStream, self).__init__(*args, **kwargs)
+        self.chunks = collections.deque()
+
+    def _read_from_socket(self):
+        if self.chunks:
+            return self.chunks.popleft()
+        return None
+
+
+class _PartialSocket(object):
+    """Accepts at most send_size bytes per send, like a busy socket."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+        self.calls = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data):
+        num_bytes = min(len(data), options.send_size)
+        self.sent += num_bytes
+        self.calls += 1
+        return num_bytes
+
+
+def _count_merge_copies(counter):
+    """Wraps iostream._merge_prefix to count the bytes of the strings it
+    creates, which is where the write path copies data."""
+    merge_prefix = iostream._merge_prefix
+    def counting_merge_prefix(deque, size):
+        before = set(id(chunk) for chunk in deque)
+        merge_prefix(deque, size)
+        counter[0] += sum(len(chunk) for chunk in deque
+                          if id(chunk) not in before)
+    iostream._merge_prefix = counting_merge_prefix
+    return merge_prefix
+
+
+def _write_response(chunks):
+    """Writes chunks out through a _PartialSocket.
+
+    Returns (seconds taken, number of send calls).
+    """
+    server, client = socket.socketpair()
+    sock = _PartialSocket(server)
+    stream = IOStream(sock)
+    for chunk in chunks:
+        stream._write_buffer.append(chunk)
+    start = time.time()
+    while stream.writing():
+        stream._handle_write()
+    elapsed = time.time() - start
+    assert sock.sent == sum(len(chunk) for chunk in chunks)
+    stream.close()
+    client.close()
+    return elapsed, sock.calls
+
+
+def write_benchmark():
+    responses = [
+        ("200 KB feed", ["x" * 200 * 1024]),
+        ("1 MB entry", ["x" * 1024 * 1024]),
+        ("headers + 200 KB", ["h" * 300, "x" * 200 * 1024]),
+        ("100 x 1 KB writes", ["x" * 1024] * 100),
+        ]
+    for name, chunks in responses:
+        best = min(_write_response(chunks)[0] for i in xrange(20))
+        # Count copies in a separate run, since counting is slow
+        copied = [0]
+        merge_prefix = _count_merge_copies(copied)
+        try:
+            calls = _write_response(chunks)[1]
+        finally:
+            iostream._merge_prefix = merge_prefix
+        print "%-18s %8d bytes copied, %3d sends, %.1f usec" % (
+            name, copied[0], calls, best * 1000000)
+
+
+def main():
+    parse_command_line()
+    write_benchmark()
+    request = "GET / HTTP/1.1\r\n" + "".join(
+        "X-Header-%d: %s\r\n" % (i, "v" * 40)
+        for i in range(options.headers)) + "\r\n"
+    chunks = [request[i:i + options.chunk]
+              for i in range(0, len(request), options.chunk)]
+    server, client = socket.socketpair()
+    stream = _ChunkedStream(server)
+    results = []
+    start = time.time()
+    for i in xrange(options.num):
+        stream.chunks.extend(chunks)
+        stream.read_until("\r\n\r\n", results.append)
+    elapsed = time.time() - start
+    assert len(results) == options.num and results[-1] == request
+    print "%d-byte headers in %d-byte chunks: %.1f usec/request" % (
+        len(request), options.chunk, elapsed * 1000000 / options.num)
+
+if __name__ == "__main__":
+    main()
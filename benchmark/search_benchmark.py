@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# A benchmark of the ranked search engine (search/engine.py): indexing
+# time and query latency as the number of posts grows.
+#
+# Run from the root of the repository:
+#   python benchmark/search_benchmark.py --posts=1000,10000 --store=file
+
+import bisect
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "search"))
+
+import engine
+from tornado.options import options, define, parse_command_line
+
+define("posts", default="1000,5000,20000",
+       help="comma-separated numbers of posts to index")
+define("words", default=300, type=int, help="words per post")
+define("queries", default=200, type=int, help="number of queries to time")
+define("store", default="memory", help="'memory' or 'file'")
+
+VOCABULARY = os.path.join(os.path.dirname(__file__), "..", "search",
+                          "pyporter2", "voc.txt")
+
+
+def _load_vocabulary():
+    words = [line.strip() for line in open(VOCABULARY)]
+    return [word for word in words if len(word) > 3][:5000]
+
+
+def _zipf_sampler(words):
+    # Word frequencies in prose roughly follow Zipf's law
+    weights = [1.0 / rank for rank in xrange(1, len(words) + 1)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+    def sample():
+        return words[min(bisect.bisect(cumulative, random.random()),
+                         len(words) - 1)]
+    return sample
+
+
+def run(num_posts, sample):
+    tmpdir = None
+    if options.store == "file":
+        tmpdir = tempfile.mkdtemp()
+        store = engine.FileStore(os.path.join(tmpdir, "index"))
+    else:
+        store = engine.MemoryStore()
+    index = engine.InvertedIndex(store)
+    start = time.time()
+    for i in xrange(num_posts):
+        text = " ".join(sample() for j in xrange(options.words))
+        index.add("post-%d" % i, text)
+    index_time = time.time() - start
+    queries = [" ".join(sample() for j in xrange(random.randint(1, 3)))
+               for i in xrange(options.queries)]
+    start = time.time()
+    for query in queries:
+        index.search(query)
+    query_time = time.time() - start
+    print "%6d posts: %6.2f ms/post indexed, %7.3f ms/query" % (
+        num_posts, index_time * 1000 / num_posts,
+        query_time * 1000 / len(queries))
+    if tmpdir:
+        store.close()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parse_command_line()
+    random.seed(0)
+    sample = _zipf_sampler(_load_vocabulary())
+    for num_posts in options.posts.split(","):
+        run(int(num_posts), sample)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# A benchmark of rendering the blog's home page template, comparing the
+# default exec-per-render mode with compiled_render mode, and with entry
+# modules served from a fragment cache (as pagecache.fragment_cached does).
+#
+# Run from the root of the repository:
+#   python benchmark/template_benchmark.py --num=2000
+
+import datetime
+import os
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tornado import locale
+from tornado.options import options, define, parse_command_line
+from tornado.template import Loader
+
+define("num", default=1000, type=int, help="number of iterations")
+define("entries", default=5, type=int,
+       help="number of modules.Entry calls per page")
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "..", "templates")
+
+
+class _Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Entry(_Object):
+    def key(self):
+        return "entry-key-%s" % self.slug
+
+
+def _make_page(compiled_render, fragments=None):
+    loader = Loader(TEMPLATE_PATH, compiled_render=compiled_render)
+    user_locale = locale.get("en_US")
+    request = _Object(uri="/page/1/")
+    handler = _Object(settings=dict(blog_title=u"zhili/blog",
+                                    blog_subtitle=u"Random ideas",
+                                    blog_about=u"About me"))
+    users = _Object(create_login_url=lambda uri: "/login?next=" + uri,
+                    create_logout_url=lambda uri: "/logout?next=" + uri)
+    common = dict(handler=handler, request=request, current_user=None,
+                  locale=user_locale, _=user_locale.translate, users=users,
+                  static_url=lambda path: "/static/" + path + "?v=395e1")
+
+    def entry_module(entry):
+        if fragments is not None:
+            fragment = fragments.get((entry.slug, entry.published))
+            if fragment is not None:
+                return fragment
+        fragment = loader.load("modules/entry.html").generate(
+            entry=entry, **common)
+        if fragments is not None:
+            fragments[(entry.slug, entry.published)] = fragment
+        return fragment
+    modules = _Object(Entry=entry_module)
+
+    published = datetime.datetime(2011, 3, 1, 12, 0, 0)
+    entries = [_Entry(slug="entry-%d" % i, title=u"Entry %d" % i,
+                      categories=[u"python", u"tornado"],
+                      published=published,
+                      html=u"<p>Hello</p>" * 50)
+               for i in range(options.entries)]
+    archives = [(2011, "03", "March 2011"), (2011, "02", "February 2011")]
+    home = loader.load("home.html")
+
+    def render():
+        return home.generate(entries=entries, archives=archives,
+                             pageinfo=[2, None], modules=modules, **common)
+    return render
+
+
+def main():
+    parse_command_line()
+    plain = _make_page(compiled_render=False)
+    compiled = _make_page(compiled_render=True)
+    fragments = _make_page(compiled_render=True, fragments={})
+    assert plain() == compiled() == fragments()
+    results = {}
+    for name, render in (("exec", plain), ("compiled", compiled),
+                         ("fragments", fragments)):
+        t = Timer(render)
+        results[name] = t.timeit(options.num) / options.num * 1000000
+        print "%-9s %.2f usec/page" % (name, results[name])
+    for name in ("compiled", "fragments"):
+        saved = results["exec"] - results[name]
+        print "%-9s saves %.2f usec/page (%.1f%%)" % (
+            name, saved, 100.0 * saved / results["exec"])
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@ import functools
 import markdown
 import os.path
 import re
+import tornado.escape
 import tornado.web
 import tornado.wsgi
 import unicodedata
@@ -25,8 +26,9 @@ import wsgiref.handlers
 import datetime
 from google.appengine.api import users
 from google.appengine.ext import db
-from paging import *
-import search
+import pagecache
+# The models are also used through this module by scripts
+from storage.appengine import AppEngineStore, Entry, Comment, ArchiveSummary
 from google.appengine.api import memcache
 from google.appengine.datastore import entity_pb
 import logging
@@ -34,28 +36,6 @@ import logging
 ARCHIVES_CACHE_TIME = 43200
 CATEGORIES_REFRESH_TIME = 3600
 
-class Entry(search.Searchable, db.Model):
-    """A single blog entry."""
-    author = db.UserProperty()
-    title = db.StringProperty(required=True)
-    slug = db.StringProperty(required=True)
-    markdown = db.TextProperty(required=True)
-    html = db.TextProperty(required=True)
-    categories = db.ListProperty(db.Category)
-    published = db.DateTimeProperty(auto_now_add=True)
-    updated = db.DateTimeProperty(auto_now=True)
-    INDEX_TITLE_FROM_PROP = 'slug'
-    INDEX_ONLY = ['title', 'markdown']
-
-class Comment(db.Model):
-    # the comment associated with an entry.
-    author = db.TextProperty(True)
-    email = db.EmailProperty(True)
-    url = db.LinkProperty(True)
-    body = db.TextProperty(True)
-    published = db.DateTimeProperty(auto_now_add=True)
-    slug = db.StringProperty(required=True)
-    
 def administrator(method):
     """Decorate with this method to restrict to site admins."""
     @functools.wraps(method)
@@ -75,8 +55,16 @@ def administrator(method):
     return wrapper
 
 
-class BaseHandler(tornado.web.RequestHandler):
+class BaseHandler(pagecache.PageCacheMixin, tornado.web.RequestHandler):
     """Implements Google Accounts authentication methods."""
+    # Every page shows the recent archives in its footer
+    page_cache_tags = ["sidebar"]
+
+    @property
+    def store(self):
+        """The storage.BlogStore the blog's data is kept in."""
+        return self.settings["blog_store"]
+
     def get_current_user(self):
         user = users.get_current_user()
         if user: user.administrator = users.is_current_user_admin()
@@ -94,17 +82,8 @@ class BaseHandler(tornado.web.RequestHandler):
         
         archives = memcache.get("recently_archives")
         if not archives:
-            entries = db.Query(Entry).order('-published')
-            markDict = {}
-            archives = []
-            for entry in entries:
-                year = entry.published.year
-                month = entry.published.month
-                if (year, month) in markDict:
-                    continue
-                markDict[(year, month)] = 1
-                archives.append((year, "%02d" % month, datetime.date(year, month, 1).strftime("%B %Y")))
-                memcache.set("recently_archives", archives, ARCHIVES_CACHE_TIME)
+            archives = self.store.archive_months()
+            memcache.set("recently_archives", archives, ARCHIVES_CACHE_TIME)
         if not fullArchives and archives:
             return archives[:4]
         return archives
@@ -128,6 +107,7 @@ class BaseHandler(tornado.web.RequestHandler):
             return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
 
 PAGESIZE = 5
+COMMENTS_PAGESIZE = 50
 
 class HomeHandler(BaseHandler):
     def get(self):
@@ -137,30 +117,39 @@ class HomeHandler(BaseHandler):
 
 
 class EntryHandler(BaseHandler):
+    @pagecache.cached(lambda slug: ["entry:" + slug], xsrf_form=True)
     def get(self, slug):
-        entry = db.Query(Entry).filter("slug =", slug).get()
+        entry = self.store.get_entry_by_slug(slug)
         if not entry: raise tornado.web.HTTPError(404)
-        nextEntry = db.Query(Entry).filter('published >', entry.published).order('published').get()
-        prevEntry = db.Query(Entry).filter('published <', entry.published).order('-published').get()
-        prevNextEntry = (prevEntry, nextEntry)
-        comments = db.Query(Comment).filter("slug =", slug).fetch(1000)
-        self.render("entry.html", entry=entry, comments=comments, archives=self.get_archives(), prevnextentry=prevNextEntry)
+        if not entry.links_cached:
+            self.store.refresh_links(entry)
+        try:
+            commentPage = max(int(self.get_argument("comments", 1)), 1)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        comments = self.store.get_comments(slug, COMMENTS_PAGESIZE,
+            (commentPage - 1) * COMMENTS_PAGESIZE)
+        commentPageInfo = [None, None]
+        if entry.comment_count > commentPage * COMMENTS_PAGESIZE:
+            commentPageInfo[0] = commentPage + 1
+        if commentPage > 1:
+            commentPageInfo[1] = commentPage - 1
+        self.render("entry.html", entry=entry, comments=comments, archives=self.get_archives(), commentpageinfo=commentPageInfo)
 
 class PagingHandler(BaseHandler):
+    @pagecache.cached(lambda page: ["listing"])
     def get(self, page):
-        query = Entry.all().order('-published')
-        thisPagedQuery = PagedQuery(query, PAGESIZE)
         pageNumber = int(page)
-        entries = thisPagedQuery.fetch_page(pageNumber)
+        entries, hasNextPage = self.store.get_page(pageNumber, PAGESIZE)
         if not entries:
             if not self.current_user or self.current_user.administrator:
                 self.redirect("/compose")
                 return
 
         pageInfo = [None, None]
-        if thisPagedQuery.has_page(pageNumber+1):
+        if hasNextPage:
             pageInfo[0] = pageNumber+1
-        if thisPagedQuery.has_page(pageNumber-1):
+        if pageNumber > 1:
             pageInfo[1] = pageNumber-1
         self.render("home.html", entries=entries, archives=self.get_archives(), pageinfo=pageInfo)
 
@@ -169,15 +158,12 @@ class ArchiveHandler(BaseHandler):
     def get(self):
         allCategories = memcache.get("categories")
         if not allCategories:
-            entries = Entry.all()
-            allCategories = set()
-            for entry in entries:
-                # logging.info(entry.categories)
-                allCategories = allCategories.union(set(entry.categories))
+            allCategories = self.store.categories()
             memcache.set("categories", allCategories, CATEGORIES_REFRESH_TIME)
         self.render("archive.html", categories = allCategories, archive_list=self.get_archives(fullArchives=True), archives=self.get_archives())
 
 class MonthArchiveHandler(BaseHandler):
+    @pagecache.cached(lambda year, month: ["month:%s-%s" % (year, month)])
     def get(self, year, month):
 
         startDate = datetime.date(int(year), int(month), 1)
@@ -189,63 +175,161 @@ class MonthArchiveHandler(BaseHandler):
         else:
             endMonth += 1
         endDate = datetime.date(int(endYear), int(endMonth), 1)
-        entries = Entry.all().filter('published >=', startDate).filter('published <', endDate).order('-published')
+        entries = self.store.entries_between(startDate, endDate)
         self.render("archives.html", entries=entries, archives=self.get_archives())
 
 class FeedHandler(BaseHandler):
+    page_cache_tags = []
+
+    @pagecache.cached(lambda: ["listing"])
     def get(self):
-        entries = db.Query(Entry).order('-published').fetch(limit=10)
+        entries = self.store.latest_entries(10)
         self.set_header("Content-Type", "application/atom+xml")
         self.render("feed.xml", entries=entries)
 
 
+EXPORT_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+class ExportHandler(BaseHandler):
+    """Exports every entry and comment as JSON lines, or as an Atom feed
+    with format=atom.
+
+    The export is generated as it is sent, one entry at a time, so it runs
+    in constant memory under localserver.py. App Engine buffers it.
+    """
+    @administrator
+    def get(self):
+        format = self.get_argument("format", "json")
+        if format == "json":
+            self.set_header("Content-Type", "application/x-ndjson")
+            chunks = self.json_lines()
+        elif format == "atom":
+            self.set_header("Content-Type", "application/atom+xml")
+            chunks = self.atom_feed()
+        else:
+            raise tornado.web.HTTPError(400, "Unknown export format %r",
+                                        format)
+        self.set_header("Content-Disposition",
+                        "attachment; filename=blog.%s" % format)
+        self.finish_stream(chunks)
+
+    def json_lines(self):
+        for entry in self.store.iter_entries():
+            yield tornado.escape.json_encode(dict(
+                type="entry", slug=entry.slug, title=entry.title,
+                author=_email(entry.author), markdown=entry.markdown,
+                html=entry.html, categories=list(entry.categories),
+                published=entry.published.strftime(EXPORT_DATE_FORMAT),
+                updated=entry.updated.strftime(EXPORT_DATE_FORMAT))) + "\n"
+        for comment in self.store.iter_comments():
+            yield tornado.escape.json_encode(dict(
+                type="comment", slug=comment.slug, author=comment.author,
+                email=comment.email, url=comment.url, body=comment.body,
+                published=comment.published.strftime(
+                    EXPORT_DATE_FORMAT))) + "\n"
+
+    def atom_feed(self):
+        escape = tornado.escape.xhtml_escape
+        base = "http://%s/" % self.request.host
+        yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<feed xmlns="http://www.w3.org/2005/Atom" '
+               'xmlns:thr="http://purl.org/syndication/thread/1.0">\n'
+               '<title>%s</title>\n<id>%s</id>\n<updated>%s</updated>\n' % (
+                   escape(self.settings["blog_title"]), base,
+                   datetime.datetime.utcnow().strftime(EXPORT_DATE_FORMAT)))
+        for entry in self.store.iter_entries():
+            url = base + "entry/" + entry.slug
+            yield (u'<entry><id>%s</id><title type="text">%s</title>'
+                   u'<link href="%s" rel="alternate" type="text/html"/>'
+                   u'<author><name>%s</name></author>'
+                   u'<updated>%s</updated><published>%s</published>%s'
+                   u'<content type="html" xml:base="%s">%s</content>'
+                   u'</entry>\n' % (
+                       url, escape(entry.title), url,
+                       escape(_email(entry.author) or ""),
+                       entry.updated.strftime(EXPORT_DATE_FORMAT),
+                       entry.published.strftime(EXPORT_DATE_FORMAT),
+                       u"".join([u'<category term="%s"/>' % escape(c)
+                                 for c in entry.categories]),
+                       base, escape(entry.html or "")))
+        for comment in self.store.iter_comments():
+            url = base + "entry/" + comment.slug
+            published = comment.published.strftime(EXPORT_DATE_FORMAT)
+            # email and url may be NULL in the SQL store
+            email = u""
+            if comment.email:
+                email = u"<email>%s</email>" % escape(comment.email)
+            yield (u'<entry><id>%s#comment-%s</id>'
+                   u'<title type="text">Comment by %s</title>'
+                   u'<author><name>%s</name>%s</author>'
+                   u'<updated>%s</updated><published>%s</published>'
+                   u'<thr:in-reply-to ref="%s" href="%s"/>'
+                   u'<content type="text">%s</content></entry>\n' % (
+                       url, comment.published.isoformat(),
+                       escape(comment.author or ""),
+                       escape(comment.author or ""),
+                       email,
+                       published, published, url, url,
+                       escape(comment.body or "")))
+        yield "</feed>\n"
+
+
+def _email(author):
+    """Returns the email address of an entry author, a users.User or a
+    plain string."""
+    if hasattr(author, "email"):
+        return author.email()
+    return author
+
+
 class ComposeHandler(BaseHandler):
     @administrator
     def get(self):
         key = self.get_argument("key", None)
-        entry = Entry.get(key) if key else None
+        entry = self.store.get_entry(key) if key else None
         self.render("compose.html", entry=entry, archives=self.get_archives())
 
     @administrator
     def post(self):
         key = self.get_argument("key", None)
+        title = self.get_argument("title")
+        text = self.get_argument("markdown")
+        html = markdown.markdown(text)
+        categories = [c.strip() for c in self.get_argument("categories").split(',') if len(c.strip()) != 0]
         if key:
-            entry = Entry.get(key)
-            entry.title = self.get_argument("title")
-            entry.markdown = self.get_argument("markdown")
-            categories = [c.strip() for c in self.get_argument("categories").split(',') if len(c.strip()) != 0]
-            entry.categories = [cat if type(cat) == db.Category else db.Category(unicode(cat)) for cat in categories]
-            entry.html = markdown.markdown(self.get_argument("markdown"))
+            entry = self.store.get_entry(key)
+            if not entry: raise tornado.web.HTTPError(404)
+            update = self.store.update_entry(entry, title, text, html,
+                                             categories)
         else:
-            title = self.get_argument("title")
             slug = unicodedata.normalize("NFKD", title).encode(
                 "ascii", "ignore")
             slug = re.sub(r"[^\w]+", " ", slug)
             slug = "-".join(slug.lower().strip().split())
             if not slug: slug = "entry"
-            while True:
-                existing = db.Query(Entry).filter("slug =", slug).get()
-                if not existing or str(existing.key()) == key:
-                    break
+            while self.store.get_entry_by_slug(slug):
                 slug += "-2"
-
-            categories = [c.strip() for c in self.get_argument("categories").split(',') if len(c.strip()) != 0]
-            standarlized_categories = [cat if type(cat) == db.Category else db.Category(unicode(cat)) for cat in categories]
-            entry = Entry(
-                author=self.current_user,
-                title=title,
-                slug=slug,
-                markdown=self.get_argument("markdown"),
-                html=markdown.markdown(self.get_argument("markdown")),
-                categories=standarlized_categories
-                )
-        entry.put()
-        # entry.index()
-        entry.enqueue_indexing(url="/tasks/searchindexing")
+            update = self.store.create_entry(self.current_user, title, slug,
+                                             text, html, categories)
+        entry = update.entry
+        memcache.delete_multi(["recently_archives", "categories"])
+        tags = ["listing", "entry:" + entry.slug,
+                "month:" + entry.published.strftime("%Y-%m")]
+        tags.extend("entry:" + neighbour for neighbour in update.neighbours)
+        tags.extend("category:" + c for c in
+                    update.old_categories | set(entry.categories))
+        if update.months_changed:
+            tags.append("sidebar")
+        pagecache.invalidate(tags)
+        self.store.enqueue_indexing(entry)
         self.redirect("/entry/" + entry.slug)
 
 
 class EntryModule(tornado.web.UIModule):
+    # Administrators get an "Edit this post" link
+    @pagecache.fragment_cached(lambda module, entry: (
+            str(entry.key()), entry.updated, module.locale.code,
+            bool(module.current_user and module.current_user.administrator)))
     def render(self, entry):
         return self.render_string("modules/entry.html", entry=entry)
 
@@ -256,7 +340,7 @@ class CommentModule(tornado.web.UIModule):
 class SearchHandler(BaseHandler):
     def get(self,):
         keyword = self.get_argument("s").strip()
-        entries = Entry.search(keyword)
+        entries = self.store.search(keyword)
         self.render("search_result.html", entries=entries, archives=self.get_archives(), SearchKeyWord=keyword)
 
 class SearchIndexingHandler(BaseHandler):
@@ -264,16 +348,14 @@ class SearchIndexingHandler(BaseHandler):
     def post(self):
         key_str = self.get_argument('key')
         if key_str:
-            key = db.Key(key_str)
-            entity = db.get(key)
-            if entity:
-                entity.index()
+            self.store.index_entry(key_str)
             self.set_status(200)
 
 class CategoriesHandler(BaseHandler):
+    @pagecache.cached(lambda category: ["category:" + category])
     def get(self, category):
         # logging.info(category)
-        entries = Entry.all().order("-published").filter("categories =", category.decode("utf-8"))
+        entries = self.store.entries_in_category(category.decode("utf-8"))
         self.render("categories.html", entries=entries, archives=self.get_archives())
 
 class CommentHandler(BaseHandler):
@@ -287,30 +369,32 @@ class CommentHandler(BaseHandler):
         url = self.get_argument("url")
         body = self.get_argument("body")
         slug = self.get_argument("slug")
-        comment = Comment(
-            author = author,
-            email = email,
-            url = url,
-            body = body,
-            slug = slug,
-            )
-        comment.put()
-        self.redirect("/entry/" + comment.slug)
+        entry = self.store.get_entry_by_slug(slug)
+        if not entry: raise tornado.web.HTTPError(404)
+        self.store.add_comment(entry, author, email, url, body)
+        pagecache.invalidate(["entry:" + slug])
+        self.redirect("/entry/" + entry.slug)
         
 settings = {
     "blog_title": u"zhili/blog",
     "blog_subtitle": u"Random ideas & notes by zhilihu",
     "blog_about": u"I am a wireless engineer.",
     "template_path": os.path.join(os.path.dirname(__file__), "templates"),
+    "static_path": os.path.join(os.path.dirname(__file__), "static"),
+    "static_manifest": os.path.join(os.path.dirname(__file__),
+                                    "static_manifest.json"),
     "ui_modules": {"Entry": EntryModule, "Comment": CommentModule},
+    "blog_store": AppEngineStore(indexing_url="/tasks/searchindexing"),
     "xsrf_cookies": True,
+    "compiled_templates": True,
 }
 
 
-application = tornado.wsgi.WSGIApplication([
+handlers = [
     (r"/", HomeHandler),
     (r"/archive", ArchiveHandler),
     (r"/feed", FeedHandler),
+    (r"/export", ExportHandler),
     (r"/entry/([^/]+)", EntryHandler),
     (r"/compose", ComposeHandler),
     (r"/(\d{4})/(\d{2})", MonthArchiveHandler),
@@ -319,7 +403,10 @@ application = tornado.wsgi.WSGIApplication([
     (r"/tasks/searchindexing", SearchIndexingHandler),
     (r"/categories/([^/]+)/", CategoriesHandler),
     (r"/postcomment", CommentHandler)
-], **settings)
+]
+
+
+application = tornado.wsgi.WSGIApplication(handlers, **settings)
 
 
 def main():
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+#
+# Writes static_manifest.json, the content hashes static_url() uses to
+# version the URLs of the files under static/.  Run it whenever a static
+# file changes, before deploying: App Engine serves static/ itself, so the
+# application cannot hash those files at startup.
+
+import os
+
+from tornado import web
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    web.write_static_manifest(os.path.join(ROOT, "static"),
+                              os.path.join(ROOT, "static_manifest.json"))
+
+if __name__ == "__main__":
+    main()
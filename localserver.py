@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Serves the blog from a long-running Tornado HTTPServer instead of App
+# Engine, so it can be run and load-tested on any Linux host:
+#
+#   python localserver.py --port=8888 --processes=4
+#
+# The handlers are the ones blog.py runs on App Engine. The datastore,
+# memcache and users APIs are backed by the App Engine SDK's local stubs
+# (the SDK must be importable or given with --appengine_sdk), and search
+# indexing runs in the request rather than on a task queue.
+#
+# With --sqlite_database or --mysql_host, entries, comments and the search
+# index are kept in that database (see storage/sql.py) instead of the
+# datastore stub, and the tables are created if they don't exist:
+#
+#   python localserver.py --mysql_host=localhost --processes=0
+#
+# Sign in at /_ah/login with any email address. Anyone can sign in as an
+# administrator there, so the server only listens on 127.0.0.1 unless
+# --address is given. Administrators can download every entry and comment
+# from /export, streamed as it is read.
+# With --ioloop_metrics, /_debug/ioloop shows how busy the worker that
+# serves it is, and which handlers were the slowest.
+# Each worker process has its own memcache and its own copy of the
+# datastore, loaded at startup, so use a single process to write entries
+# and several for read-only load tests.
+
+import Cookie
+import functools
+import hashlib
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from storage import sql
+from tornado import database
+from tornado import escape
+from tornado import httpserver
+from tornado import ioloop
+from tornado import process
+from tornado import web
+from tornado.options import options, define, parse_command_line
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+define("port", default=8888, type=int, help="port to listen on")
+define("address", default="127.0.0.1",
+       help="address to listen on (\"\" for all interfaces)")
+define("processes", default=1, type=int,
+       help="number of worker processes (0 for one per CPU)")
+define("datastore_path",
+       default=os.path.join(tempfile.gettempdir(), "blog.datastore"),
+       help="file the local datastore is kept in")
+define("appengine_sdk", default=os.environ.get("APPENGINE_SDK", ""),
+       help="path to the App Engine SDK")
+define("sqlite_database", default="",
+       help="SQLite database file to keep the blog in")
+define("mysql_host", default="", help="MySQL server to keep the blog in")
+define("mysql_database", default="blog", help="MySQL database name")
+define("mysql_user", default="blog", help="MySQL user")
+define("mysql_password", default="blog", help="MySQL password")
+define("query_cache_ttl", default=0, type=float,
+       help="seconds to cache database reads for (0 to not cache)")
+define("debug", default=False, type=bool, help="reload templates and code")
+define("ioloop_metrics", default=False, type=bool,
+       help="time the IOLoop of each worker, shown at /_debug/ioloop")
+define("edge_triggered", default=False, type=bool,
+       help="register connections with epoll edge-triggered")
+
+# Cookie set by the local login page, in the dev_appserver format
+LOGIN_COOKIE = "dev_appserver_login"
+AUTH_DOMAIN = "gmail.com"
+
+
+def _app_id():
+    for line in open(os.path.join(ROOT, "app.yaml")):
+        match = re.match(r"application:\s*(\S+)", line)
+        if match:
+            return match.group(1)
+    return "blog"
+
+
+def install_stubs(app_id, datastore_path):
+    """Backs the App Engine APIs used by the blog with the SDK's stubs."""
+    if options.appengine_sdk:
+        sys.path.insert(0, options.appengine_sdk)
+        try:
+            import dev_appserver
+            dev_appserver.fix_sys_path()
+        except (ImportError, AttributeError):
+            pass
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_file_stub
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    os.environ["APPLICATION_ID"] = app_id
+    os.environ["AUTH_DOMAIN"] = AUTH_DOMAIN
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub("datastore_v3",
+        datastore_file_stub.DatastoreFileStub(app_id, datastore_path))
+    apiproxy_stub_map.apiproxy.RegisterStub("memcache",
+        memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub("user",
+        user_service_stub.UserServiceStub())
+
+
+class LocalApplication(web.Application):
+    """Runs each request with the signed-in user in os.environ.
+
+    The users API reads the current user from os.environ, as set by App
+    Engine for every request. The blog's handlers are synchronous, so the
+    environment belongs to one request at a time.
+    """
+    def __call__(self, request):
+        email, admin, user_id = "", False, ""
+        cookies = Cookie.BaseCookie()
+        try:
+            cookies.load(request.headers.get("Cookie", ""))
+        except Cookie.CookieError:
+            pass
+        if LOGIN_COOKIE in cookies:
+            parts = cookies[LOGIN_COOKIE].value.split(":")
+            if len(parts) == 3:
+                email, admin, user_id = parts[0], parts[1] == "True", parts[2]
+        os.environ["USER_EMAIL"] = email
+        os.environ["USER_ID"] = user_id
+        os.environ["USER_IS_ADMIN"] = admin and "1" or "0"
+        return web.Application.__call__(self, request)
+
+
+class LoginHandler(web.RequestHandler):
+    """Stands in for the Google Accounts sign-in and sign-out pages."""
+    def get(self):
+        next_url = self.get_argument("continue", "/")
+        if self.get_argument("action", None) == "Logout":
+            self.clear_cookie(LOGIN_COOKIE)
+            self.redirect(next_url)
+            return
+        email = self.get_argument("email", None)
+        if not email:
+            self.write('<form action="/_ah/login" method="get">'
+                       '<input type="hidden" name="continue" value="%s"/>'
+                       'Email: <input name="email"/> '
+                       '<label><input type="checkbox" name="admin" '
+                       'value="True"/> Administrator</label> '
+                       '<input type="submit" value="Sign in"/></form>' %
+                       escape.xhtml_escape(next_url))
+            return
+        admin = self.get_argument("admin", "") == "True"
+        user_id = str(int(hashlib.md5(email.lower()).hexdigest()[:15], 16))
+        self.set_cookie(LOGIN_COOKIE, "%s:%s:%s" % (email, admin, user_id))
+        self.redirect(next_url)
+
+
+class IOLoopDebugHandler(web.RequestHandler):
+    """Shows the IOLoop counters and metrics of the worker serving it.
+
+    Only administrators may see it. With reset=1 the metrics are cleared
+    after being shown, to start a new measurement.
+    """
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        if os.environ.get("USER_IS_ADMIN") != "1":
+            raise web.HTTPError(403)
+        self.write(dict(pid=os.getpid(),
+                        stats=ioloop.IOLoop.instance().stats(),
+                        metrics=self.metrics and self.metrics.snapshot()))
+        if self.metrics and self.get_argument("reset", None) == "1":
+            self.metrics.reset()
+
+
+def make_store():
+    """Returns a storage.sql.SQLStore, or None to use the datastore."""
+    if options.sqlite_database:
+        db = database.SQLiteConnection(options.sqlite_database,
+                                       compact_rows=True)
+    elif options.mysql_host:
+        # Pooled, so that a streaming export has a connection to itself
+        db = database.ConnectionPool(functools.partial(
+            database.Connection, options.mysql_host, options.mysql_database,
+            options.mysql_user, options.mysql_password, compact_rows=True),
+            max_size=4)
+    else:
+        return None
+    return sql.SQLStore(db, cache_ttl=options.query_cache_ttl)
+
+
+def make_application(metrics=None):
+    import blog
+    import search
+    search.INDEX_INLINE = True
+    settings = dict(blog.settings, gzip=True, debug=options.debug)
+    handlers = blog.handlers + [
+        (r"/_ah/login", LoginHandler),
+        (r"/_debug/ioloop", IOLoopDebugHandler, dict(metrics=metrics)),
+        (r"/(fonts/.*)", web.StaticFileHandler,
+         dict(path=settings["static_path"])),
+    ]
+    return LocalApplication(handlers, **settings)
+
+
+def main():
+    parse_command_line()
+    install_stubs(_app_id(), options.datastore_path)
+    store = make_store()
+    if store:
+        store.create_tables()
+        store.db.close()
+    metrics = options.ioloop_metrics and ioloop.IOLoopMetrics() or None
+    application = make_application(metrics)
+    server = httpserver.HTTPServer(application,
+                                   edge_triggered=options.edge_triggered)
+    if options.processes == 1:
+        server.listen(options.port, options.address)
+    else:
+        process.Supervisor(server, options.port, options.address,
+                           num_processes=options.processes).start()
+    if store:
+        # Connect in each worker; connections can't be shared across fork()
+        application.settings["blog_store"] = make_store()
+    if metrics:
+        # Each worker records into its own copy
+        metrics.reset()
+        ioloop.IOLoop.instance().set_metrics(metrics)
+    logging.info("Serving the blog on port %d", options.port)
+    ioloop.IOLoop.instance().start()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Full-page output cache for anonymous GET requests.
+
+Rendered pages are stored in memcache, so every App Engine instance sees
+the same pages and the same invalidations. Each page is tagged with the
+data it was built from (e.g. "listing", "entry:<slug>"). Every tag has a
+generation number in memcache, and the generation numbers of a page's tags
+are part of its cache key. Bumping a tag with invalidate() therefore drops
+exactly the pages that depend on it, without having to know their URLs.
+
+Usage:
+
+    class EntryHandler(BaseHandler):
+        @pagecache.cached(lambda slug: ["entry:" + slug])
+        def get(self, slug):
+            ...
+
+    pagecache.invalidate(["entry:" + slug])
+
+The handler must mix in PageCacheMixin, which stores the response when
+the request finishes. Requests from logged-in users are never cached or
+served from the cache.
+
+If the application has the 'gzip' setting, each page is stored together
+with its gzip encoding (at the 'gzip_level' compression level) and is
+served with RequestHandler.finish_precompressed, so cache hits cost no
+compression. Pages containing a per-visitor XSRF field are patched on
+every hit and are therefore stored uncompressed; their handlers must pass
+xsrf_form=True to cached().
+
+Tag generations are seconds since the epoch, so they double as HTTP
+validators: a page's ETag is derived from its cache key and its
+Last-Modified is the newest generation among its tags. Conditional GETs
+are answered with 304 before the page is fetched or rendered.
+
+Rendered UI modules can also be cached, in process memory, with the
+fragment_cached decorator. The fragment key must include everything the
+output depends on (e.g. an entity's key and updated time), since
+fragments are never invalidated; old versions simply age out.
+"""
+
+import datetime
+import functools
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from tornado import web
+
+PAGE_CACHE_TIME = 3600
+
+TAG_KEY_PREFIX = "pagegen:"
+PAGE_KEY_PREFIX = "page:"
+
+# Stands in for the per-visitor XSRF form field in cached pages
+XSRF_PLACEHOLDER = "<!--pagecache:xsrf-->"
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+
+def tag_versions(tags):
+    """Returns a dict mapping each tag to its current generation."""
+    tags = [_utf8(tag) for tag in tags]
+    versions = memcache.get_multi(tags, key_prefix=TAG_KEY_PREFIX)
+    for tag in tags:
+        if tag not in versions:
+            # Start from the clock rather than 0 so that a tag evicted from
+            # memcache never comes back with a generation it had before.
+            initial = int(time.time())
+            if not memcache.add(TAG_KEY_PREFIX + tag, initial):
+                initial = memcache.get(TAG_KEY_PREFIX + tag) or initial
+            versions[tag] = initial
+    return versions
+
+
+def invalidate(tags):
+    """Drops every cached page that carries one of the given tags.
+
+    The new generation is the current time, or one past the old generation
+    if that is newer, so Last-Modified never goes backwards.
+    """
+    tags = list(set(_utf8(tag) for tag in tags))
+    versions = memcache.get_multi(tags, key_prefix=TAG_KEY_PREFIX)
+    now = int(time.time())
+    memcache.set_multi(dict((tag, max(now, versions.get(tag, 0) + 1))
+                            for tag in tags), key_prefix=TAG_KEY_PREFIX)
+
+
+def last_modified(versions):
+    """Returns the Last-Modified datetime of a page with the given tags."""
+    return datetime.datetime.utcfromtimestamp(max(versions.values()))
+
+
+def page_key(request, versions):
+    parts = [request.host, request.uri]
+    parts.extend("%s=%s" % (tag, versions[tag]) for tag in sorted(versions))
+    return PAGE_KEY_PREFIX + hashlib.sha1("\n".join(parts)).hexdigest()
+
+
+def cached(tags, xsrf_form=False):
+    """Serves anonymous GETs of the decorated method from the page cache.
+
+    tags is a function that takes the arguments of the handler method and
+    returns the list of tags the page depends on. Pass xsrf_form=True if
+    the page contains xsrf_form_html(); its ETag then also covers the
+    visitor's XSRF cookie, and it gets no Last-Modified header.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            if self.request.method != "GET" or self.current_user:
+                return method(self, *args)
+            versions = tag_versions(self.page_cache_tags + tags(*args))
+            key = page_key(self.request, versions)
+            etag = key[len(PAGE_KEY_PREFIX):]
+            if xsrf_form:
+                # A visitor without the cookie gets a fresh token in the
+                # page, so their cached copy must not be revalidated.
+                cookie = self.get_cookie("_xsrf")
+                if cookie and self.check_conditional_headers(
+                        hashlib.sha1(etag + cookie).hexdigest()):
+                    return
+            elif self.check_conditional_headers(etag,
+                                                last_modified(versions)):
+                return
+            page = memcache.get(key)
+            if page is not None:
+                content_type, body, gzip_body = page
+                self.set_header("Content-Type", content_type)
+                if XSRF_PLACEHOLDER in body:
+                    body = body.replace(XSRF_PLACEHOLDER,
+                                        self.xsrf_form_html())
+                    etag = hashlib.sha1(etag + self.xsrf_token).hexdigest()
+                self.finish_precompressed(body, gzip_body, etag)
+                return
+            self._page_cache_key = key
+            return method(self, *args)
+        return wrapper
+    return decorator
+
+
+class PageCacheMixin(object):
+    """RequestHandler mix-in that stores pages rendered under @cached."""
+
+    # Tags added to every cached page of this handler
+    page_cache_tags = []
+
+    def finish(self, chunk=None):
+        key = getattr(self, "_page_cache_key", None)
+        if key is None or self.get_status() != 200:
+            super(PageCacheMixin, self).finish(chunk)
+            return
+        del self._page_cache_key
+        if chunk is not None:
+            self.write(chunk)
+        body = "".join(self._write_buffer)
+        self._write_buffer = []
+        content_type = self._headers["Content-Type"]
+        etag = key[len(PAGE_KEY_PREFIX):]
+        gzip_body = None
+        stored = body
+        if hasattr(self, "_xsrf_token"):
+            stored = body.replace(self.xsrf_form_html(), XSRF_PLACEHOLDER)
+        if stored != body:
+            etag = hashlib.sha1(etag + self.xsrf_token).hexdigest()
+        else:
+            if self.settings.get("gzip"):
+                gzip_body = web.gzip_encode(
+                    body, self.settings.get("gzip_level",
+                        web.GZipContentEncoding.COMPRESS_LEVEL),
+                    content_type)
+        memcache.set(key, (content_type, stored, gzip_body), PAGE_CACHE_TIME)
+        self.finish_precompressed(body, gzip_body, etag)
+
+
+class FragmentCache(object):
+    """A bounded in-process cache of rendered template fragments.
+
+    Fragments are small and cheaper to render than a memcache round trip,
+    so they are kept in instance memory. When the cache is full it is
+    emptied; keys carry data versions, so a full cache is mostly stale.
+    """
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = {}
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, key):
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fragment
+
+    def put(self, key, fragment):
+        if len(self._fragments) >= self.max_size:
+            self._fragments.clear()
+        self._fragments[key] = fragment
+
+    def clear(self):
+        self._fragments.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+fragments = FragmentCache()
+
+
+def fragment_cached(key):
+    """Caches the output of a UIModule's render method in `fragments`.
+
+    key is a function that takes the module and the arguments of render
+    and returns a hashable key for the output.
+
+        class EntryModule(tornado.web.UIModule):
+            @pagecache.fragment_cached(lambda module, entry: (
+                str(entry.key()), entry.updated, module.locale.code))
+            def render(self, entry):
+                ...
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            fragment_key = (self.__class__.__name__,) + tuple(key(self, *args))
+            fragment = fragments.get(fragment_key)
+            if fragment is None:
+                fragment = method(self, *args)
+                fragments.put(fragment_key, fragment)
+            return fragment
+        return wrapper
+    return decorator
@@ -32,16 +32,22 @@ Complex Apps on App Engine' talk at Google I/O, 2009).
 
 The keyword extraction code was slightly modified from Ryan Barrett's
 SearchableModel implementation.
+
+Models can instead opt into ranked search over an inverted index (see the
+engine module and Searchable.INDEX_RANKED).
 """
 __author__ = 'William T. Katz'
 
 import logging
+import marshal
 import re
 import string
 import sys
 
 from google.appengine.api import datastore
 from google.appengine.api import datastore_types
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 import tornado.web
 # TODO -- This will eventually be moved out of labs namespace
@@ -49,6 +55,7 @@ from google.appengine.api.labs import taskqueue
 
 # Use python port of Porter2 stemmer.
 from pyporter2 import Stemmer
+import engine
 
 class Error(Exception):
     """Base search module error type."""
@@ -56,6 +63,9 @@ class Error(Exception):
 class IndexTitleError(Error):
     """Raised when INDEX_TITLE_FROM_PROP or title alterations are incorrect."""
 
+class PostingsTooLargeError(Error):
+    """Raised when a term header would not fit in an entity."""
+
 # Following module-level constants are cached in instance
 
 KEY_NAME_DELIMITER = '||'  # Used to hold arbitrary strings in key names.
@@ -65,6 +75,20 @@ MAX_ENTITY_SEARCH_PHRASES = datastore._MAX_INDEXED_PROPERTIES - 1
 
 SEARCH_PHRASE_MIN_LENGTH = 4
 
+SEARCH_CACHE_KEY_PREFIX = 'search_entity:'
+
+POSTINGS_CACHE_KEY_PREFIX = 'search_postings:'
+
+POSTINGS_CACHE_TIME = 3600
+
+# Largest marshalled term header or postings chunk written, below the 1MB
+# limit of entities and memcache values
+MAX_POSTINGS_VALUE_SIZE = 1000000
+
+# Index entities as soon as enqueue_indexing() is called instead of adding
+# a task, for servers that run without a task queue (see localserver.py).
+INDEX_INLINE = False
+
 STOP_WORDS = frozenset([
  'a', 'about', 'according', 'accordingly', 'affected', 'affecting', 'after',
  'again', 'against', 'all', 'almost', 'already', 'also', 'although',
@@ -156,6 +180,155 @@ class StemmedIndex(SearchIndex):
     phrases = db.StringListProperty(required=True)
 
 
+class IndexTerm(db.Model):
+    """Chunk list of the postings of one term of an inverted index.
+
+    The key name is the index name and the term joined by
+    KEY_NAME_DELIMITER; header is the marshalled term header (see
+    engine.IndexStore).
+    """
+    header = db.BlobProperty()
+
+
+class IndexChunk(db.Model):
+    """A chunk of the postings of one term of an inverted index.
+
+    The key name is the IndexTerm key name and the chunk id joined by
+    KEY_NAME_DELIMITER; postings is a marshalled {doc_id: (tf, length)}.
+    """
+    postings = db.BlobProperty(required=True)
+
+
+class IndexDocument(db.Model):
+    """Terms of one document of an inverted index, used to re-index it."""
+    length = db.IntegerProperty(required=True)
+    terms = db.BlobProperty(required=True)
+    title = db.StringProperty()
+
+
+class IndexStats(db.Model):
+    """Document count and total length of an inverted index."""
+    count = db.IntegerProperty(default=0)
+    total_length = db.IntegerProperty(default=0)
+
+
+class DatastoreStore(engine.IndexStore):
+    """An engine.IndexStore kept in the datastore.
+
+    Each call is a single batch get or put.  Term headers and postings
+    chunks are read through memcache, so a query whose terms were all seen
+    recently does no datastore reads at all.
+
+    A chunk holds at most engine.CHUNK_SIZE postings, well under the 1MB
+    entity and memcache value limits.  A header takes about 50 bytes per
+    chunk plus the length of a document id, which caps a term at roughly
+    10,000 chunks (5 million documents); put_postings raises
+    PostingsTooLargeError rather than write a larger value.
+
+    Postings are updated without transactions, so documents of one index
+    should be indexed one at a time (as the indexing task queue does at
+    its default rate).
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def _key_name(self, name):
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        return self.name + KEY_NAME_DELIMITER + name
+
+    def _chunk_key_name(self, (term, chunk_id)):
+        return self._key_name(term) + KEY_NAME_DELIMITER + unicode(chunk_id)
+
+    def _get_cached(self, model, property_name, key_names):
+        """Returns {key_name: unmarshalled property} of the entities found."""
+        cached = memcache.get_multi(key_names,
+                                    key_prefix=POSTINGS_CACHE_KEY_PREFIX)
+        missing = [key_name for key_name in key_names
+                   if key_name not in cached]
+        if missing:
+            to_cache = {}
+            for key_name, entity in zip(missing,
+                                        model.get_by_key_name(missing)):
+                to_cache[key_name] = entity and getattr(
+                    entity, property_name) or ''
+            memcache.set_multi(to_cache, time=POSTINGS_CACHE_TIME,
+                               key_prefix=POSTINGS_CACHE_KEY_PREFIX)
+            cached.update(to_cache)
+        return dict((key_name, marshal.loads(data))
+                    for key_name, data in cached.iteritems() if data)
+
+    def get_headers(self, terms):
+        key_names = dict((self._key_name(term), term) for term in terms)
+        found = self._get_cached(IndexTerm, 'header', key_names.keys())
+        return dict((key_names[key_name], header)
+                    for key_name, header in found.iteritems())
+
+    def get_chunks(self, keys):
+        key_names = dict((self._chunk_key_name(key), key) for key in keys)
+        found = self._get_cached(IndexChunk, 'postings', key_names.keys())
+        return dict((key_names[key_name], chunk)
+                    for key_name, chunk in found.iteritems())
+
+    def put_postings(self, headers, chunks, changed):
+        key_names = []
+        to_put = []
+        to_delete = []
+        for items, model, key_name_func, property_name in (
+                (headers, IndexTerm, self._key_name, 'header'),
+                (chunks, IndexChunk, self._chunk_key_name, 'postings')):
+            for key, value in items.iteritems():
+                key_name = key_name_func(key)
+                key_names.append(key_name)
+                if value is None:
+                    to_delete.append(db.Key.from_path(model.kind(), key_name))
+                    continue
+                data = marshal.dumps(value)
+                if len(data) > MAX_POSTINGS_VALUE_SIZE:
+                    raise PostingsTooLargeError(
+                        'Postings of %r take %d bytes' % (key, len(data)))
+                to_put.append(model(key_name=key_name,
+                                    **{property_name: data}))
+        db.put(to_put)
+        db.delete(to_delete)
+        memcache.delete_multi(key_names, key_prefix=POSTINGS_CACHE_KEY_PREFIX)
+
+    def get_documents(self, doc_ids):
+        entities = IndexDocument.get_by_key_name(
+            [self._key_name(doc_id) for doc_id in doc_ids])
+        result = {}
+        for doc_id, entity in zip(doc_ids, entities):
+            if entity:
+                result[doc_id] = (entity.length, marshal.loads(entity.terms),
+                                  entity.title)
+        return result
+
+    def put_document(self, doc_id, record):
+        key_name = self._key_name(doc_id)
+        if record is None:
+            db.delete(db.Key.from_path('IndexDocument', key_name))
+        else:
+            length, terms, title = record
+            IndexDocument(key_name=key_name, length=length,
+                          terms=marshal.dumps(terms), title=title).put()
+
+    def get_stats(self):
+        stats = IndexStats.get_by_key_name(self.name)
+        if stats is None:
+            return 0, 0
+        return stats.count, stats.total_length
+
+    def update_stats(self, count_delta, length_delta):
+        def txn():
+            stats = IndexStats.get_by_key_name(self.name)
+            if stats is None:
+                stats = IndexStats(key_name=self.name)
+            stats.count += count_delta
+            stats.total_length += length_delta
+            stats.put()
+        db.run_in_transaction(txn)
+
+
 class Searchable(object):
     """A class that supports full text indexing and search on entities.
     
@@ -170,6 +343,8 @@ class Searchable(object):
             # INDEX_USES_MULTI_ENTITIES = False
             # INDEX_MULTI_WORD = False
             # INDEX_ONLY = ['content']
+            # SEARCH_CACHE_TIME = 3600
+            # INDEX_RANKED = True
 
     There are a few class variables that can be overridden by your Model.
     The settings were made class variables because their use should be
@@ -234,6 +409,21 @@ class Searchable(object):
     over multiple index entities, the keyword AND may fail portion of the
     search may fail, i.e., there will be false negative search results.
 
+    Entities for a search result page are fetched with one batch get.  If
+    SEARCH_CACHE_TIME is set, search() first looks the hits up in memcache
+    (serialized as protocol buffers) and only fetches the misses from the
+    datastore, caching them for SEARCH_CACHE_TIME seconds.  The cached copy
+    of an entity is dropped by enqueue_indexing(), index() and uncache(), so
+    call one of them after every put(), including puts that change no
+    indexed property.
+
+    If INDEX_RANKED is True, index() instead adds the entity to an inverted
+    index of its kind (see the engine module), and search() returns every
+    entity that matches any search term, ranked with BM25.  Ranked search
+    does not depend on how many index entities a model needs, so it has no
+    false negatives.  Entities indexed before INDEX_RANKED was turned on
+    must be re-indexed.
+
     You can use the full_text_search() static method to return all entities,
     not just a particular kind, that have been indexed:
 
@@ -252,6 +442,13 @@ class Searchable(object):
     # indexed properties limit (MAX_ENTITY_SEARCH_PHRASES)
     INDEX_USES_MULTI_ENTITIES = True
 
+    # If not None, search() caches result entities in memcache for this
+    # many seconds.
+    SEARCH_CACHE_TIME = None
+
+    # If True, use a ranked inverted index instead of phrase index entities.
+    INDEX_RANKED = False
+
     @staticmethod
     def full_text_search(phrase, limit=10, 
                          kind=None, 
@@ -412,15 +609,83 @@ class Searchable(object):
             A list.  If keys_only is True, the list holds (key, title) tuples.
             If keys_only is False, the list holds Model instances.
         """
-        key_list = Searchable.full_text_search(
-                        phrase, limit=limit, kind=cls.kind(),
-                        stemming=cls.INDEX_STEMMING, 
-                        multi_word_literal=cls.INDEX_MULTI_WORD)
+        if cls.INDEX_RANKED:
+            key_list = cls.ranked_search(phrase, limit=limit)
+        else:
+            key_list = Searchable.full_text_search(
+                            phrase, limit=limit, kind=cls.kind(),
+                            stemming=cls.INDEX_STEMMING,
+                            multi_word_literal=cls.INDEX_MULTI_WORD)
         if keys_only:
             logging.debug("key_list: %s", key_list)
             return key_list
+        keys = [key_and_title[0] for key_and_title in key_list]
+        if cls.SEARCH_CACHE_TIME is None:
+            entities = cls.get(keys)
         else:
-            return [cls.get(key_and_title[0]) for key_and_title in key_list]
+            entities = cls.get_cached(keys)
+        # Index entities may briefly outlive a deleted parent entity
+        return [entity for entity in entities if entity is not None]
+
+    @classmethod
+    def search_engine(cls):
+        """Returns the engine.InvertedIndex used when INDEX_RANKED is set."""
+        name = cls.kind()
+        if cls.INDEX_STEMMING:
+            name += KEY_NAME_DELIMITER + 'stemmed'
+        return engine.InvertedIndex(DatastoreStore(name),
+                                    stemming=cls.INDEX_STEMMING)
+
+    @classmethod
+    def ranked_search(cls, phrase, limit=10):
+        """Returns (key, title) tuples of the best matches, best first."""
+        search_engine = cls.search_engine()
+        hits = search_engine.search(phrase, limit=limit)
+        titles = search_engine.titles([doc_id for doc_id, score in hits])
+        return [(db.Key(doc_id), titles.get(doc_id) or 'Unknown Title')
+                for doc_id, score in hits]
+
+    @classmethod
+    def get_cached(cls, keys):
+        """Gets the entities for keys, trying memcache before the datastore.
+
+        All cache lookups are done with a single get_multi, and all misses
+        with a single batch get.  Entities fetched from the datastore are
+        written back to memcache for SEARCH_CACHE_TIME seconds.
+
+        Returns:
+            A list of Model instances (or None) in the same order as keys.
+        """
+        if not keys:
+            return []
+        str_keys = [str(key) for key in keys]
+        cached = memcache.get_multi(str_keys,
+                                    key_prefix=SEARCH_CACHE_KEY_PREFIX)
+        missing = [key for key, str_key in zip(keys, str_keys)
+                   if str_key not in cached]
+        fetched = {}
+        if missing:
+            to_cache = {}
+            for key, entity in zip(missing, cls.get(missing)):
+                fetched[str(key)] = entity
+                if entity is not None:
+                    to_cache[str(key)] = db.model_to_protobuf(entity).Encode()
+            if to_cache:
+                memcache.set_multi(to_cache, time=cls.SEARCH_CACHE_TIME,
+                                   key_prefix=SEARCH_CACHE_KEY_PREFIX)
+        entities = []
+        for str_key in str_keys:
+            if str_key in cached:
+                entities.append(db.model_from_protobuf(
+                    entity_pb.EntityProto(cached[str_key])))
+            else:
+                entities.append(fetched.get(str_key))
+        return entities
+
+    def uncache(self):
+        """Removes this entity from the search result cache."""
+        if self.SEARCH_CACHE_TIME is not None:
+            memcache.delete(SEARCH_CACHE_KEY_PREFIX + str(self.key()))
 
     def indexed_title_changed(self):
         """Renames index entities for this model to match new title."""
@@ -465,21 +730,27 @@ class Searchable(object):
         if self.INDEX_STEMMING:
             stemmer = Stemmer.Stemmer('english')
         phrases = set()
+        for value in self.get_indexed_values():
+            words = indexing_func(value)
+            if self.INDEX_STEMMING:
+                stemmed_words = set(stemmer.stemWords(words))
+                phrases.update(stemmed_words)
+            else:
+                phrases.update(words)
+        return list(phrases)
+
+    def get_indexed_values(self):
+        """Returns the string values of the properties that are indexed."""
+        indexed = []
         for prop_name, prop_value in self.properties().iteritems():
             if (not self.INDEX_ONLY) or (prop_name in self.INDEX_ONLY):
                 values = prop_value.get_value_for_datastore(self)
                 if not isinstance(values, list):
                     values = [values]
-                if (isinstance(values[0], basestring) and
+                if (values and isinstance(values[0], basestring) and
                         not isinstance(values[0], datastore_types.Blob)):
-                    for value in values:
-                        words = indexing_func(value)
-                        if self.INDEX_STEMMING:
-                            stemmed_words = set(stemmer.stemWords(words))
-                            phrases.update(stemmed_words)
-                        else:
-                            phrases.update(words)
-        return list(phrases)
+                    indexed.extend(value for value in values if value)
+        return indexed
 
     def index(self, indexing_func=None):
         """Generates or replaces a search entities for a Model instance.
@@ -488,8 +759,16 @@ class Searchable(object):
             indexing_func: A function that returns a set of keywords or phrases.
 
         Note that the indexing_func can be passed in to allow more customized
-        search phrase generation.
+        search phrase generation.  It is not used when INDEX_RANKED is set.
         """
+        self.uncache()
+        if self.INDEX_RANKED:
+            title = getattr(self, getattr(self, 'INDEX_TITLE_FROM_PROP', ''),
+                            None)
+            self.search_engine().add(str(self.key()),
+                                     u'\n'.join(self.get_indexed_values()),
+                                     title=title)
+            return
         search_phrases = self.get_search_phrases(indexing_func=indexing_func)
 
         key = self.key()
@@ -523,13 +802,25 @@ class Searchable(object):
                     delete_keys.append(key)
             db.delete(delete_keys)
 
+    def unindex(self):
+        """Removes this entity from the ranked search index."""
+        self.uncache()
+        if self.INDEX_RANKED:
+            self.search_engine().remove(str(self.key()))
+
     def enqueue_indexing(self, url, only_index=None):
         """Adds an indexing task to the default task queue.
+
+        If INDEX_INLINE is set, the entity is indexed right away instead.
         
         Args:
             url: String. The url associated with LiteralIndexing handler.
             only_index: List of strings.  Restricts indexing to these prop names.
         """
+        if INDEX_INLINE:
+            self.index()
+            return
+        self.uncache()
         if url:
             tRequest = tornado.web.RequestHandler
             params = {'key': str(self.key())}
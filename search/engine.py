@@ -0,0 +1,718 @@
+#!/usr/bin/env python
+#
+# The MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""A ranked full-text search engine over an inverted index.
+
+Every term maps to a postings list of the documents that contain it, with
+the term frequency and the length of each document:
+
+    term -> {doc_id: (term_frequency, document_length)}
+
+A query ranks the union of the documents found in the postings of its
+terms with BM25, so a document matching every term ranks above one
+matching only some of them, and no document is missed because its terms
+were stored in different places. Keeping the document length inside the
+postings means few per-document reads are needed to rank.
+
+Postings lists are stored in chunks of bounded size, best postings first,
+and a query only reads as many chunks as it takes to settle the top
+results (see InvertedIndex), so neither the size of a stored value nor
+the cost of a query grows with the number of documents.
+
+The index is kept in an IndexStore. MemoryStore and FileStore are
+provided for tests and benchmarks; search.DatastoreStore keeps it in the
+App Engine datastore.
+
+    index = InvertedIndex(MemoryStore())
+    index.add('post-1', u'Tuning the IOLoop', title=u'IOLoop')
+    index.search(u'ioloop')    # -> [('post-1', 0.28...)]
+
+Run this file to run the unit tests.
+"""
+
+import bisect
+import heapq
+import math
+import re
+import shelve
+import string
+
+# Use python port of Porter2 stemmer.
+from pyporter2 import Stemmer
+
+TERM_MIN_LENGTH = 2
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Most postings kept in one chunk of a postings list
+CHUNK_SIZE = 500
+
+# Words that carry no meaning for ranking.  Kept short on purpose: BM25
+# already discounts common words, and every entry here is a word that can
+# never be found.
+STOP_WORDS = frozenset([
+ 'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+ 'has', 'have', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the',
+ 'this', 'to', 'was', 'were', 'will', 'with'])
+
+_PUNCTUATION_REGEX = re.compile(u'[' + re.escape(string.punctuation) + u']')
+
+# Runs of CJK ideographs are not separated by spaces, so they are indexed
+# as overlapping bigrams.
+_CJK_REGEX = re.compile(u'([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)')
+
+
+def analyze(text, stemming=True):
+    """Splits text into a list of index terms, in document order.
+
+    >>> analyze(u'Indexing the indexes, again!')
+    [u'index', u'index', u'again']
+    """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = _PUNCTUATION_REGEX.sub(u' ', text.lower())
+    terms = []
+    for i, fragment in enumerate(_CJK_REGEX.split(text)):
+        if i % 2:
+            if len(fragment) == 1:
+                terms.append(fragment)
+            else:
+                terms.extend(fragment[j:j + 2]
+                             for j in xrange(len(fragment) - 1))
+            continue
+        words = [word for word in fragment.split()
+                 if len(word) >= TERM_MIN_LENGTH and word not in STOP_WORDS]
+        if stemming:
+            words = Stemmer.Stemmer('english').stemWords(words)
+        terms.extend(words)
+    return terms
+
+
+class IndexStore(object):
+    """Interface of the storage behind an InvertedIndex.
+
+    The postings list of a term is split into chunks of at most
+    InvertedIndex.chunk_size postings, ordered by impact() (see
+    InvertedIndex).  A term's header holds the reference length its
+    impacts are computed with and its chunk descriptors, highest impact
+    first:
+
+        (reference_length, [(chunk_id, count, max_impact, last_key), ...])
+
+    where last_key is the sort key of the chunk's last posting, and a chunk
+    is a {doc_id: (tf, length)} dict.  Chunks are addressed by (term,
+    chunk_id) pairs.
+
+    Document ids are strings.  A document record is a tuple
+    (length, {term: term_frequency}, title).  Every method works on a batch
+    so that a store backed by a remote service can do one round trip per
+    call.
+    """
+    def get_headers(self, terms):
+        """Returns {term: header} for the given terms.
+
+        Terms without postings may be left out of the result.
+        """
+        raise NotImplementedError()
+
+    def get_chunks(self, keys):
+        """Returns {(term, chunk_id): chunk} for the given chunk keys."""
+        raise NotImplementedError()
+
+    def put_postings(self, headers, chunks, changed):
+        """Stores {term: header} and {(term, chunk_id): chunk}.
+
+        A None header or chunk is deleted.  changed maps the key of every
+        chunk in chunks to the doc_ids whose postings were added to,
+        changed in, moved into or removed from it, for a store that writes
+        postings one at a time.
+        """
+        raise NotImplementedError()
+
+    def get_documents(self, doc_ids):
+        """Returns {doc_id: record} for the indexed documents in doc_ids."""
+        raise NotImplementedError()
+
+    def put_document(self, doc_id, record):
+        """Stores the record of a document, or deletes it if None."""
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """Returns (document_count, total_length) for the whole index."""
+        raise NotImplementedError()
+
+    def update_stats(self, count_delta, length_delta):
+        raise NotImplementedError()
+
+
+class MemoryStore(IndexStore):
+    """An IndexStore that keeps everything in dicts."""
+    def __init__(self):
+        self.headers = {}
+        self.chunks = {}
+        self.documents = {}
+        self.count = 0
+        self.total_length = 0
+
+    def get_headers(self, terms):
+        result = {}
+        for term in terms:
+            if term in self.headers:
+                result[term] = self.headers[term]
+        return result
+
+    def get_chunks(self, keys):
+        result = {}
+        for key in keys:
+            if key in self.chunks:
+                result[key] = self.chunks[key]
+        return result
+
+    def put_postings(self, headers, chunks, changed):
+        for items, values in ((headers, self.headers),
+                              (chunks, self.chunks)):
+            for key, value in items.iteritems():
+                if value is None:
+                    values.pop(key, None)
+                else:
+                    values[key] = value
+
+    def get_documents(self, doc_ids):
+        result = {}
+        for doc_id in doc_ids:
+            if doc_id in self.documents:
+                result[doc_id] = self.documents[doc_id]
+        return result
+
+    def put_document(self, doc_id, record):
+        if record is None:
+            self.documents.pop(doc_id, None)
+        else:
+            self.documents[doc_id] = record
+
+    def get_stats(self):
+        return self.count, self.total_length
+
+    def update_stats(self, count_delta, length_delta):
+        self.count += count_delta
+        self.total_length += length_delta
+
+
+class FileStore(IndexStore):
+    """An IndexStore kept on disk in a shelve database.
+
+    Call close() (or sync()) to make sure changes are written out.
+    """
+    def __init__(self, filename):
+        self.db = shelve.open(filename, protocol=2)
+
+    def _key(self, prefix, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return prefix + name
+
+    def _chunk_key(self, (term, chunk_id)):
+        return self._key('c:%d:' % chunk_id, term)
+
+    def _get(self, keys, key_func):
+        result = {}
+        for key in keys:
+            value = self.db.get(key_func(key))
+            if value is not None:
+                result[key] = value
+        return result
+
+    def _put(self, key, value):
+        if value is not None:
+            self.db[key] = value
+        elif key in self.db:
+            del self.db[key]
+
+    def get_headers(self, terms):
+        return self._get(terms, lambda term: self._key('t:', term))
+
+    def get_chunks(self, keys):
+        return self._get(keys, self._chunk_key)
+
+    def put_postings(self, headers, chunks, changed):
+        for term, header in headers.iteritems():
+            self._put(self._key('t:', term), header)
+        for key, chunk in chunks.iteritems():
+            self._put(self._chunk_key(key), chunk)
+
+    def get_documents(self, doc_ids):
+        return self._get(doc_ids, lambda doc_id: self._key('d:', doc_id))
+
+    def put_document(self, doc_id, record):
+        self._put(self._key('d:', doc_id), record)
+
+    def get_stats(self):
+        return self.db.get('stats', (0, 0))
+
+    def update_stats(self, count_delta, length_delta):
+        count, total_length = self.get_stats()
+        self.db['stats'] = (count + count_delta, total_length + length_delta)
+
+    def sync(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+
+def impact(tf, length, reference_length):
+    """Returns the BM25 term frequency factor, divided by K1 + 1, of a
+    posting in an index whose documents are reference_length terms long
+    on average."""
+    return tf / (tf + K1 * (1.0 - B + B * length / reference_length))
+
+
+def _impact_bound(max_impact, reference_length, average_length):
+    # The largest tf / (tf + K1 * (1 - B + B * length / average_length))
+    # of any posting whose impact() is at most max_impact: a longer average
+    # raises the factor of every posting, but by at most this much.
+    if average_length <= reference_length:
+        return max_impact
+    ratio = reference_length / average_length
+    return max_impact / (max_impact + ratio * (1.0 - max_impact))
+
+
+def _sort_key(reference_length, doc_id, (tf, length)):
+    # Highest impact first, ties in doc_id order
+    return (-impact(tf, length, reference_length), doc_id)
+
+
+class InvertedIndex(object):
+    """Indexes documents into an IndexStore and ranks them with BM25.
+
+    Postings lists are split into chunks of at most chunk_size postings,
+    so that no stored value grows with the number of documents.  Postings
+    are ordered by impact(), computed with the average document length of
+    the index when the term's list outgrew its first chunk, which ranks
+    them as BM25 does while the average stays close; so the best documents
+    for a term are in its first chunks.  A query reads chunks best first
+    and stops once no unread chunk can change the top results, so each
+    query term costs a few chunk reads however long its postings list is.
+    """
+    def __init__(self, store, stemming=True, chunk_size=CHUNK_SIZE):
+        self.store = store
+        self.stemming = stemming
+        self.chunk_size = chunk_size
+
+    def add(self, doc_id, text, title=None):
+        """Indexes text as the content of doc_id, replacing any previous
+        content of that document."""
+        terms = analyze(text, self.stemming)
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        length = len(terms)
+        old = self.store.get_documents([doc_id]).get(doc_id)
+        changes = {}
+        if old is not None:
+            for term, tf in old[1].iteritems():
+                if old[0] != length or frequencies.get(term) != tf:
+                    changes[term] = ({}, {doc_id: (tf, old[0])})
+        for term, tf in frequencies.iteritems():
+            if old is None or old[0] != length or old[1].get(term) != tf:
+                changes.setdefault(term, ({}, {}))[0][doc_id] = (tf, length)
+        self._update_postings(changes)
+        self.store.put_document(doc_id, (length, frequencies, title))
+        if old is None:
+            self.store.update_stats(1, length)
+        else:
+            self.store.update_stats(0, length - old[0])
+
+    def remove(self, doc_id):
+        """Drops doc_id from the index."""
+        old = self.store.get_documents([doc_id]).get(doc_id)
+        if old is None:
+            return
+        self._update_postings(dict(
+            (term, ({}, {doc_id: (tf, old[0])}))
+            for term, tf in old[1].iteritems()))
+        self.store.put_document(doc_id, None)
+        self.store.update_stats(-1, -old[0])
+
+    def _update_postings(self, changes):
+        """Applies {term: (added, removed)} to the postings lists.
+
+        added and removed are {doc_id: (tf, length)} dicts; removed holds
+        the postings as they were stored, to find their chunks.
+        """
+        headers = self.store.get_headers(changes.keys())
+        count, total_length = self.store.get_stats()
+        average_length = float(total_length) / (count or 1) or 1.0
+        # Find the chunk of every posting first, to read them in one batch
+        placed = {}  # (term, doc_id, posting) -> position in the header
+        keys = set()
+        for term, (added, removed) in changes.iteritems():
+            reference_length, header = headers.get(term, (None, []))
+            if not header:
+                continue
+            last_keys = [descriptor[3] for descriptor in header]
+            for doc_id, posting in removed.items() + added.items():
+                i = bisect.bisect_left(last_keys, _sort_key(
+                    reference_length, doc_id, posting))
+                i = min(i, len(header) - 1)
+                placed[term, doc_id, posting] = i
+                keys.add((term, header[i][0]))
+        chunks = self.store.get_chunks(keys)
+        new_headers = {}
+        new_chunks = {}
+        changed = {}
+        for term, (added, removed) in changes.iteritems():
+            reference_length, header = headers.get(
+                term, (average_length, []))
+            header = list(header)
+            touched = {}  # position -> chunk
+            for doc_id, posting in removed.iteritems():
+                i = placed.get((term, doc_id, posting))
+                if i is None:
+                    continue
+                chunk_id, count, max_impact, last_key = header[i]
+                chunk = touched.get(i, chunks.get((term, chunk_id)))
+                if chunk and chunk.pop(doc_id, None):
+                    # max_impact and last_key stay valid bounds
+                    header[i] = (chunk_id, count - 1, max_impact, last_key)
+                    touched[i] = chunk
+                    changed.setdefault((term, chunk_id), set()).add(doc_id)
+            for doc_id, posting in added.iteritems():
+                key = _sort_key(reference_length, doc_id, posting)
+                i = placed.get((term, doc_id, posting), 0)
+                if not header:
+                    header.append((0, 0, -key[0], key))
+                chunk_id, count, max_impact, last_key = header[i]
+                chunk = touched.get(i, chunks.get((term, chunk_id)))
+                if chunk is None:
+                    chunk = {}
+                if doc_id not in chunk:
+                    count += 1
+                chunk[doc_id] = posting
+                # A key past last_key can only go to the last chunk, so
+                # the chunks stay in order
+                header[i] = (chunk_id, count, max(max_impact, -key[0]),
+                             max(last_key, key))
+                touched[i] = chunk
+                changed.setdefault((term, chunk_id), set()).add(doc_id)
+            # Later chunks first, so that the positions of the others hold
+            for i in sorted(touched, reverse=True):
+                chunk_id = header[i][0]
+                chunk = touched[i]
+                new_chunks[term, chunk_id] = chunk or None
+                if not chunk:
+                    del header[i]
+                elif len(chunk) > self.chunk_size:
+                    if len(header) == 1:
+                        # The whole list is split, so it can be reordered
+                        reference_length = average_length
+                    next_id = max([descriptor[0] for descriptor in header]) + 1
+                    items = sorted(chunk.iteritems(),
+                                   key=lambda item: _sort_key(
+                                       reference_length, *item))
+                    parts = max(2, -(-len(items) // self.chunk_size))
+                    size = -(-len(items) // parts)
+                    descriptors = []
+                    for j in xrange(0, len(items), size):
+                        part = items[j:j + size]
+                        if j:
+                            chunk_id = next_id
+                            next_id += 1
+                            changed[term, chunk_id] = set(
+                                doc_id for doc_id, posting in part)
+                        new_chunks[term, chunk_id] = dict(part)
+                        first_key = _sort_key(reference_length, *part[0])
+                        descriptors.append((
+                            chunk_id, len(part), -first_key[0],
+                            _sort_key(reference_length, *part[-1])))
+                    header[i:i + 1] = descriptors
+            if touched:
+                new_headers[term] = header and (reference_length, header) \
+                    or None
+        self.store.put_postings(new_headers, new_chunks, changed)
+
+    def search(self, query, limit=10):
+        """Returns up to limit (doc_id, score) pairs, best match first."""
+        terms = set(analyze(query, self.stemming))
+        if not terms:
+            return []
+        count, total_length = self.store.get_stats()
+        if not count:
+            return []
+        average_length = float(total_length) / count or 1.0
+        # A posting in a chunk adds at most idf * (K1 + 1) * _impact_bound()
+        # of the chunk's max_impact to a score.  Chunks are read in rounds,
+        # the next chunk of every term at a time, until the documents
+        # already found are sure to fill the top results: no unseen
+        # document can reach the limit-th best partial score with what the
+        # unread chunks can add.  The scores of the documents that may
+        # still be among the top results are then completed from their
+        # records (MaxScore over impact-ordered chunks).
+        weighted = []
+        for term, (reference_length, header) in \
+                self.store.get_headers(terms).iteritems():
+            df = sum(descriptor[1] for descriptor in header)
+            idf = math.log(1.0 + (count - df + 0.5) / (df + 0.5))
+            # The most any unread chunk can add, by read position
+            unread_max = [0.0]
+            for descriptor in reversed(header):
+                impact_bound = _impact_bound(descriptor[2], reference_length,
+                                             average_length)
+                unread_max.append(max(unread_max[-1],
+                                      idf * (K1 + 1.0) * impact_bound))
+            unread_max.reverse()
+            weighted.append((idf, term, header, unread_max))
+        weighted.sort(reverse=True)
+        def score(i, tf, length):
+            norm = K1 * (1.0 - B + B * length / average_length)
+            return weighted[i][0] * tf * (K1 + 1.0) / (tf + norm)
+        def bound(i, position):
+            return weighted[i][3][position]
+        positions = [0] * len(weighted)
+        read = [[] for i in weighted]  # the chunks read of every term
+        partial = {}  # doc_id -> sum of the scores read so far
+        while True:
+            bounds = [bound(i, position)
+                      for i, position in enumerate(positions)]
+            if not sum(bounds):
+                break
+            if len(partial) >= limit:
+                # Unseen documents may still tie with the last result
+                threshold = heapq.nlargest(limit, partial.itervalues())[-1]
+                if threshold > sum(bounds):
+                    break
+            reading = [i for i in xrange(len(bounds)) if bounds[i]]
+            chunks = self.store.get_chunks(
+                [(weighted[i][1], weighted[i][2][positions[i]][0])
+                 for i in reading])
+            for i in reading:
+                term, header = weighted[i][1:3]
+                chunk = chunks.get((term, header[positions[i]][0]), {})
+                positions[i] += 1
+                read[i].append(chunk)
+                for doc_id, (tf, length) in chunk.iteritems():
+                    partial[doc_id] = partial.get(doc_id, 0.0) + \
+                        score(i, tf, length)
+        # Documents whose partial score plus what they may have in unread
+        # chunks cannot reach the limit-th best partial score are out
+        threshold = 0.0
+        if len(partial) > limit:
+            threshold = heapq.nlargest(limit, partial.itervalues())[-1]
+        unread = [i for i, position in enumerate(positions)
+                  if bound(i, position)]
+        unread_total = sum(bound(i, positions[i]) for i in unread)
+        def find(i, doc_id):
+            for chunk in read[i]:
+                if doc_id in chunk:
+                    return chunk[doc_id]
+            return None
+        candidates = []  # (upper bound, doc_id, complete)
+        for doc_id, partial_score in partial.iteritems():
+            if partial_score + unread_total < threshold:
+                continue
+            upper = partial_score
+            for i in unread:
+                if find(i, doc_id) is None:
+                    upper += bound(i, positions[i])
+            if upper >= threshold:
+                candidates.append((upper, doc_id, upper == partial_score))
+        # Score the candidates best upper bound first, reading the records
+        # of a batch of them at a time (each batch twice the size of the
+        # last), until no upper bound left can reach the limit-th best score
+        candidates.sort(reverse=True)
+        results = []
+        batch_size = limit
+        while candidates:
+            if len(results) >= limit and candidates[0][0] < heapq.nlargest(
+                    limit, [total for doc_id, total in results])[-1]:
+                break
+            batch = candidates[:batch_size]
+            del candidates[:batch_size]
+            batch_size *= 2
+            records = self.store.get_documents(
+                [doc_id for upper, doc_id, complete in batch
+                 if not complete])
+            for upper, doc_id, complete in batch:
+                # Sum in term order, the same whichever chunks were read
+                total = 0.0
+                for i in xrange(len(weighted)):
+                    posting = find(i, doc_id)
+                    if posting is None and doc_id in records:
+                        length, frequencies = records[doc_id][:2]
+                        tf = frequencies.get(weighted[i][1])
+                        posting = tf and (tf, length)
+                    if posting:
+                        total += score(i, *posting)
+                results.append((doc_id, total))
+        # Equal scores rank in doc_id order
+        results.sort(key=lambda item: (-item[1], item[0]))
+        return results[:limit]
+
+    def titles(self, doc_ids):
+        """Returns {doc_id: title} for the given indexed documents."""
+        records = self.store.get_documents(doc_ids)
+        return dict((doc_id, record[2])
+                    for doc_id, record in records.iteritems())
+
+
+if __name__ == '__main__':
+    import doctest
+    import os
+    import tempfile
+    import unittest
+
+    class InvertedIndexTest(unittest.TestCase):
+        chunk_size = CHUNK_SIZE
+
+        def make_store(self):
+            return MemoryStore()
+
+        def setUp(self):
+            self.store = self.make_store()
+            self.index = InvertedIndex(self.store, chunk_size=self.chunk_size)
+            self.index.add('1', u'The IOLoop polls sockets for events.',
+                           title=u'IOLoop')
+            self.index.add('2', u'Templates are compiled once and rendered '
+                           u'many times; compiled templates render fast.')
+            self.index.add('3', u'Sockets, sockets and more sockets: '
+                           u'non-blocking sockets with the IOLoop.')
+
+        def ids(self, query):
+            return [doc_id for doc_id, score in self.index.search(query)]
+
+        def testRanking(self):
+            self.assertEqual(self.ids(u'sockets'), ['3', '1'])
+            self.assertEqual(self.ids(u'compiling templates'), ['2'])
+            # Matching every query term beats repeating one of them
+            self.assertEqual(self.ids(u'polling sockets')[0], '1')
+            self.assertEqual(self.ids(u'nothing here'), [])
+            self.assertEqual(self.ids(u'the'), [])
+
+        def testLimit(self):
+            self.assertEqual(len(self.index.search(u'ioloop', limit=1)), 1)
+
+        def testPruningKeepsRanking(self):
+            import random
+            words = u'alpha beta gamma delta epsilon zeta theta kappa'.split()
+            rand = random.Random(1)
+            for i in xrange(200):
+                self.index.add('r%d' % i, u' '.join(
+                    words[int(rand.paretovariate(1.0)) % len(words)]
+                    for j in xrange(rand.randint(5, 50))))
+            for query in (u'alpha', u'alpha kappa', u'beta theta zeta'):
+                everything = self.index.search(query, limit=1000)
+                self.assertEqual(self.index.search(query, limit=5),
+                                 everything[:5])
+
+        def testReindex(self):
+            self.index.add('1', u'Now about templates only.')
+            self.assertEqual(self.ids(u'ioloop'), ['3'])
+            self.assertEqual(set(self.ids(u'templates')), set(['1', '2']))
+            self.assertEqual(self.store.get_stats()[0], 3)
+
+        def testRemove(self):
+            self.index.remove('3')
+            self.index.remove('3')
+            self.assertEqual(self.ids(u'sockets'), ['1'])
+            self.assertEqual(self.store.get_stats()[0], 2)
+            self.assertEqual(self.store.get_headers([u'nonblock']), {})
+
+        def testTitles(self):
+            self.assertEqual(self.index.titles(['1', '2', '9']),
+                             {'1': u'IOLoop', '2': None})
+
+        def testCJK(self):
+            self.index.add('4', u'\u641c\u7d22\u5f15\u64ce')
+            self.assertEqual(self.ids(u'\u5f15\u64ce'), ['4'])
+            self.assertEqual(self.ids(u'\u7d22'), [])
+
+    class SmallChunksTest(InvertedIndexTest):
+        chunk_size = 4
+
+        def add_random(self, count):
+            import random
+            words = u'alpha beta gamma delta'.split()
+            rand = random.Random(2)
+            for i in xrange(count):
+                self.index.add('r%d' % i, u' '.join(
+                    rand.choice(words) for j in xrange(rand.randint(1, 20))))
+
+        def testChunks(self):
+            self.add_random(100)
+            for i in xrange(0, 100, 3):
+                self.index.add('r%d' % i, u'alpha ' * (i % 7 + 1))
+            for i in xrange(0, 100, 5):
+                self.index.remove('r%d' % i)
+            count = self.store.get_stats()[0]
+            for term in (u'alpha', u'beta'):
+                reference_length, header = \
+                    self.store.get_headers([term])[term]
+                postings = []
+                for chunk_id, size, max_impact, last_key in header:
+                    chunk = self.store.get_chunks([(term, chunk_id)])[
+                        (term, chunk_id)]
+                    self.assertEqual(len(chunk), size)
+                    self.assertTrue(0 < size <= self.chunk_size)
+                    keys = sorted(_sort_key(reference_length, *item)
+                                  for item in chunk.iteritems())
+                    # Removals leave the bounds of a chunk loose
+                    self.assertTrue(-keys[0][0] <= max_impact)
+                    self.assertTrue(keys[-1] <= last_key)
+                    self.assertTrue(not postings or postings[-1] < keys[0])
+                    postings.extend(keys)
+                # Chunks are ordered and hold every document once
+                self.assertEqual(postings, sorted(postings))
+                self.assertEqual(len(set(key[1] for key in postings)),
+                                 len(postings))
+                self.assertTrue(len(postings) <= count)
+
+        def testReadsFewChunks(self):
+            self.add_random(400)
+            header = self.store.get_headers([u'alpha'])[u'alpha'][1]
+            self.assertTrue(len(header) > 50)
+            read = []
+            get_chunks = self.store.get_chunks
+            def counting_get_chunks(keys):
+                read.extend(keys)
+                return get_chunks(keys)
+            self.store.get_chunks = counting_get_chunks
+            self.assertEqual(self.index.search(u'alpha', limit=3),
+                             self.index.search(u'alpha', limit=1000)[:3])
+            self.assertTrue(len(read) - len(header) < 10)
+
+    class FileStoreTest(InvertedIndexTest):
+        def make_store(self):
+            self.dirname = tempfile.mkdtemp()
+            return FileStore(os.path.join(self.dirname, 'index'))
+
+        def tearDown(self):
+            self.store.close()
+            for name in os.listdir(self.dirname):
+                os.remove(os.path.join(self.dirname, name))
+            os.rmdir(self.dirname)
+
+    doctest.testmod()
+    unittest.main()
@@ -285,6 +285,75 @@ def version ():
     """
     return '1.0.0'
 
+class StemCache(object):
+    """A bounded, least-recently-used mapping from words to their stems.
+
+    A single cache may be shared by any number of Stemmer instances. The
+    hits and misses attributes count lookups since the cache was created
+    (or last cleared).
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._map = {}
+        # Circular doubly linked list of [prev, next, key, value] links;
+        # the most recently used entry is next to the root.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def get(self, word):
+        """Returns the cached stem of word, or None on a miss."""
+        link = self._map.get(word)
+        if link is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(link)
+        self._link_front(link)
+        return link[3]
+
+    def put(self, word, stemmed):
+        """Stores the stem of word, evicting the least recently used entry
+        if the cache is full."""
+        link = self._map.get(word)
+        if link is not None:
+            link[3] = stemmed
+            self._unlink(link)
+            self._link_front(link)
+            return
+        if len(self._map) >= self.max_size:
+            oldest = self._root[0]
+            self._unlink(oldest)
+            del self._map[oldest[2]]
+        link = [None, None, word, stemmed]
+        self._link_front(link)
+        self._map[word] = link
+
+    def clear(self):
+        """Drops all cached entries and resets the counters."""
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_front(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+
 class Stemmer:
     """An instance of a stemming algorithm.
 
@@ -294,14 +363,35 @@ class Stemmer:
     function in this module. In addition, the appropriate stemming algorithm
     for a given language may be obtained by using the 2 or 3 letter ISO 639
     language codes.
+
+    Stemmed words are memoized in a StemCache. By default all Stemmer
+    instances share one module-wide cache of max_cache_size entries, so
+    creating a Stemmer per request is cheap. Pass cache_size to give an
+    instance a private cache of that size (0 disables caching), or pass
+    an existing StemCache as cache to share it explicitly.
     """
     max_cache_size = 10000
+    _shared_cache = None
 
-    def __init__ (self, algorithm, cache_size=None):
+    def __init__ (self, algorithm, cache_size=None, cache=None):
         if algorithm not in ['english', 'eng', 'en']:
             raise KeyError("Stemming algorithm '%s' not found" % algorithm)
-        if cache_size:
+        if cache is not None:
+            self.cache = cache
+        elif cache_size is None:
+            self.cache = Stemmer.shared_cache()
+        elif cache_size > 0:
             self.max_cache_size = cache_size
+            self.cache = StemCache(cache_size)
+        else:
+            self.cache = None
+
+    @classmethod
+    def shared_cache(cls):
+        """Returns the StemCache shared by default by all instances."""
+        if Stemmer._shared_cache is None:
+            Stemmer._shared_cache = StemCache(Stemmer.max_cache_size)
+        return Stemmer._shared_cache
 
     def stemWord(self, word):
         """Stem a word.
@@ -313,7 +403,18 @@ class Stemmer:
         was a unicode object, the result will be a unicode object: if the
         word supplied was a string, the result will be a UTF-8 encoded string.
         """
-        return Stemmer._stem(word)
+        if self.cache is None:
+            return Stemmer._stem(word)
+        was_unicode = isinstance(word, unicode)
+        if was_unicode:
+            word = word.encode('utf-8')
+        stemmed = self.cache.get(word)
+        if stemmed is None:
+            stemmed = Stemmer._stem(word)
+            self.cache.put(word, stemmed)
+        if was_unicode:
+            return stemmed.decode('utf-8')
+        return stemmed
 
     def stemWords(self, words):
         """Stem a list of words.
@@ -670,6 +771,31 @@ class TestPorter2(unittest.TestCase):
         self.assertEqual(normalize_ys('MiKe'), 'MiKe')
         self.assertEqual(normalize_ys('MDirYol'), 'MDiryol')
 
+    def testCache(self):
+        cache = StemCache(2)
+        stemmer = Stemmer('english', cache=cache)
+        self.assertEqual(stemmer.stemWord('consigned'), 'consign')
+        self.assertEqual(stemmer.stemWord('consigned'), 'consign')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(stemmer.stemWord(u'consisted'), u'consist')
+        self.assertTrue(isinstance(stemmer.stemWord(u'consisted'), unicode))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # 'consigned' is the least recently used entry and gets evicted
+        self.assertEqual(stemmer.stemWord('skies'), 'sky')
+        self.assertEqual(len(cache), 2)
+        stemmer.stemWord('consisted')
+        self.assertEqual(cache.hits, 3)
+        stemmer.stemWord('consigned')
+        self.assertEqual(cache.misses, 4)
+
+        # The cache can be shared between instances
+        other = Stemmer('en', cache=cache)
+        other.stemWord('consigned')
+        self.assertEqual(cache.hits, 4)
+        self.assertTrue(Stemmer('english').cache is Stemmer.shared_cache())
+        self.assertEqual(Stemmer('english', cache_size=0).cache, None)
+
     def testStem(self):
         stemmer = Stemmer('english')
         self.assertEqual(stemmer.stemWord(''), '')
@@ -0,0 +1,124 @@
+"""Storage backends for the blog's entries, comments and search index.
+
+The handlers in blog.py read and write through a BlogStore, found in the
+'blog_store' application setting, instead of using datastore models
+directly. Two backends are provided:
+
+    storage.appengine.AppEngineStore   the App Engine datastore (the models
+                                       blog.py has always used)
+    storage.sql.SQLStore               MySQL or SQLite through
+                                       tornado.database
+
+Entries returned by a store have the attributes of the original Entry
+model (title, slug, html, markdown, categories, published, updated,
+comment_count, the prev_/next_ neighbour links and links_cached) and a
+key() method returning something str() turns into a key usable with
+get_entry(). Comments have author, email, url, body, published and slug.
+"""
+
+import datetime
+
+
+def archive_list(months):
+    """Turns "YYYY-MM" months into (year, "MM", "Month YYYY") tuples."""
+    archives = []
+    for month in months:
+        year, month = int(month[:4]), int(month[5:])
+        archives.append((year, "%02d" % month,
+            datetime.date(year, month, 1).strftime("%B %Y")))
+    return archives
+
+
+class EntryUpdate(object):
+    """What changed when an entry was written, for cache invalidation.
+
+    entry is the written entry, old_categories the set of categories it
+    had before (empty for a new entry), neighbours the slugs of the
+    entries whose neighbour links changed and months_changed whether the
+    list of archive months changed.
+    """
+    def __init__(self, entry, old_categories, neighbours, months_changed):
+        self.entry = entry
+        self.old_categories = old_categories
+        self.neighbours = neighbours
+        self.months_changed = months_changed
+
+
+class BlogStore(object):
+    """Interface of a blog storage backend.
+
+    Lists of entries are ordered newest first.
+    """
+    def get_entry(self, key):
+        """Returns the entry with the given key, or None."""
+        raise NotImplementedError()
+
+    def get_entry_by_slug(self, slug):
+        raise NotImplementedError()
+
+    def refresh_links(self, entry):
+        """Recomputes the neighbour links of an entry that has
+        links_cached set to False."""
+        raise NotImplementedError()
+
+    def latest_entries(self, limit):
+        raise NotImplementedError()
+
+    def get_page(self, page, page_size):
+        """Returns (entries, has_next_page) for the 1-based page number."""
+        raise NotImplementedError()
+
+    def entries_between(self, start, end):
+        """Returns the entries published in [start, end)."""
+        raise NotImplementedError()
+
+    def entries_in_category(self, category):
+        raise NotImplementedError()
+
+    def create_entry(self, author, title, slug, markdown, html, categories):
+        """Stores a new entry after the latest one. Returns an EntryUpdate."""
+        raise NotImplementedError()
+
+    def update_entry(self, entry, title, markdown, html, categories):
+        """Changes an existing entry. Returns an EntryUpdate."""
+        raise NotImplementedError()
+
+    def iter_entries(self):
+        """Iterates over every entry, oldest first.
+
+        Entries are read in batches as the iterator advances, so that a
+        full export runs in constant memory.
+        """
+        raise NotImplementedError()
+
+    def iter_comments(self):
+        """Iterates over every comment by entry slug, then oldest first."""
+        raise NotImplementedError()
+
+    def get_comments(self, slug, limit, offset=0):
+        """Returns comments on the entry with the given slug, oldest first."""
+        raise NotImplementedError()
+
+    def add_comment(self, entry, author, email, url, body):
+        """Stores a comment and increments the entry's comment_count."""
+        raise NotImplementedError()
+
+    def archive_months(self):
+        """Returns (year, "MM", "Month YYYY") tuples, newest first."""
+        raise NotImplementedError()
+
+    def categories(self):
+        """Returns the sorted names of the categories in use."""
+        raise NotImplementedError()
+
+    def search(self, keywords):
+        """Returns the entries best matching the keywords, best first."""
+        raise NotImplementedError()
+
+    def enqueue_indexing(self, entry):
+        """Arranges for an entry to be (re)indexed for search."""
+        raise NotImplementedError()
+
+    def index_entry(self, key):
+        """Indexes the entry with the given key for search."""
+        raise NotImplementedError()
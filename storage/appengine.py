@@ -0,0 +1,298 @@
+"""The App Engine datastore backend of the blog (see storage.BlogStore)."""
+
+import datetime
+
+from google.appengine.ext import db
+from paging import PagedQuery
+import search
+import storage
+
+
+class Entry(search.Searchable, db.Model):
+    """A single blog entry."""
+    author = db.UserProperty()
+    title = db.StringProperty(required=True)
+    slug = db.StringProperty(required=True)
+    markdown = db.TextProperty(required=True)
+    html = db.TextProperty(required=True)
+    categories = db.ListProperty(db.Category)
+    published = db.DateTimeProperty(auto_now_add=True)
+    # Set by AppEngineStore when the entry is written, not on every put(),
+    # so comment counts and neighbour links leave the feed's dates alone
+    updated = db.DateTimeProperty()
+    # Denormalized so an entry page needs no extra queries; see
+    # set_neighbours() and update_neighbours().
+    prev_slug = db.StringProperty()
+    prev_title = db.StringProperty()
+    next_slug = db.StringProperty()
+    next_title = db.StringProperty()
+    comment_count = db.IntegerProperty(default=0)
+    links_cached = db.BooleanProperty(default=False)
+    INDEX_TITLE_FROM_PROP = 'slug'
+    INDEX_ONLY = ['title', 'markdown']
+    SEARCH_CACHE_TIME = 3600
+    INDEX_RANKED = True
+
+    @classmethod
+    def get_by_slug(cls, slug):
+        return db.Query(cls).filter("slug =", slug).get()
+
+    def set_neighbours(self, prev_entry, next_entry):
+        """Stores the slugs and titles of the adjacent entries."""
+        self.prev_slug = prev_entry.slug if prev_entry else None
+        self.prev_title = prev_entry.title if prev_entry else None
+        self.next_slug = next_entry.slug if next_entry else None
+        self.next_title = next_entry.title if next_entry else None
+        self.links_cached = True
+
+    def update_neighbours(self):
+        """Points the adjacent entries' links at this entry's slug and title.
+
+        Call after a put() that created this entry or changed its title.
+        Returns the entries that were updated.
+        """
+        changed = []
+        if self.prev_slug:
+            prev_entry = Entry.get_by_slug(self.prev_slug)
+            if prev_entry and (prev_entry.next_slug, prev_entry.next_title) \
+                    != (self.slug, self.title):
+                prev_entry.next_slug = self.slug
+                prev_entry.next_title = self.title
+                changed.append(prev_entry)
+        if self.next_slug:
+            next_entry = Entry.get_by_slug(self.next_slug)
+            if next_entry and (next_entry.prev_slug, next_entry.prev_title) \
+                    != (self.slug, self.title):
+                next_entry.prev_slug = self.slug
+                next_entry.prev_title = self.title
+                changed.append(next_entry)
+        if changed:
+            db.put(changed)
+            # These writes are not re-indexed, which would drop the cached
+            # search results
+            for entry in changed:
+                entry.uncache()
+        return changed
+
+    def refresh_links(self):
+        """Recomputes the neighbour links and comment count from queries.
+
+        Only needed once for entries written before they were stored.
+        """
+        next_entry = db.Query(Entry).filter('published >', self.published).order('published').get()
+        prev_entry = db.Query(Entry).filter('published <', self.published).order('-published').get()
+        self.set_neighbours(prev_entry, next_entry)
+        self.comment_count = db.Query(Comment).filter("slug =", self.slug).count()
+        self.put()
+        self.uncache()
+
+    @staticmethod
+    def increment_comment_count(key):
+        """Transaction function adding one comment to the entry at key."""
+        entry = db.get(key)
+        entry.comment_count = (entry.comment_count or 0) + 1
+        entry.put()
+
+class Comment(db.Model):
+    # the comment associated with an entry.
+    author = db.TextProperty(True)
+    email = db.EmailProperty(True)
+    url = db.LinkProperty(True)
+    body = db.TextProperty(True)
+    published = db.DateTimeProperty(auto_now_add=True)
+    slug = db.StringProperty(required=True)
+
+class ArchiveSummary(db.Model):
+    """Entry counts per publishing month and per category.
+
+    A single instance is kept up to date by AppEngineStore whenever an
+    entry is written, so the archive sidebar and the /archive page read
+    one entity instead of scanning every Entry.
+    """
+    KEY_NAME = "summary"
+    months = db.StringListProperty()     # "YYYY-MM", newest first
+    month_counts = db.ListProperty(int)
+    categories = db.StringListProperty()
+    category_counts = db.ListProperty(int)
+
+    @classmethod
+    def get_summary(cls):
+        summary = cls.get_by_key_name(cls.KEY_NAME)
+        if summary is None:
+            summary = cls.rebuild()
+        return summary
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes the summary from all entries.
+
+        Only needed once, for blogs that have entries written before the
+        summary existed.
+        """
+        months = {}
+        categories = {}
+        for entry in Entry.all():
+            month = entry.published.strftime("%Y-%m")
+            months[month] = months.get(month, 0) + 1
+            for cat in entry.categories:
+                categories[cat] = categories.get(cat, 0) + 1
+        summary = cls(key_name=cls.KEY_NAME)
+        summary._set_counts(months, categories)
+        summary.put()
+        return summary
+
+    @classmethod
+    def record_entry(cls, published=None, added_categories=(),
+                     removed_categories=()):
+        """Updates the summary after an entry has been written.
+
+        published is the publishing date of a newly created entry, or None
+        if an existing entry was edited.
+
+        Returns True if the list of months changed.
+        """
+        def txn():
+            summary = cls.get_by_key_name(cls.KEY_NAME)
+            old_months = summary.months
+            months = dict(zip(summary.months, summary.month_counts))
+            categories = dict(zip(summary.categories,
+                                  summary.category_counts))
+            if published:
+                month = published.strftime("%Y-%m")
+                months[month] = months.get(month, 0) + 1
+            for cat in added_categories:
+                categories[cat] = categories.get(cat, 0) + 1
+            for cat in removed_categories:
+                categories[cat] = categories.get(cat, 0) - 1
+            summary._set_counts(months, categories)
+            summary.put()
+            return summary.months != old_months
+        if cls.get_by_key_name(cls.KEY_NAME) is None:
+            # The entry is already stored, so a full rebuild includes it
+            cls.rebuild()
+            months_changed = True
+        else:
+            months_changed = db.run_in_transaction(txn)
+        return months_changed
+
+    def archive_list(self):
+        """Returns (year, "MM", "Month YYYY") tuples, newest first."""
+        return storage.archive_list(self.months)
+
+    def _set_counts(self, months, categories):
+        self.months = sorted([m for m in months if months[m] > 0],
+                             reverse=True)
+        self.month_counts = [months[m] for m in self.months]
+        self.categories = sorted([c for c in categories if categories[c] > 0])
+        self.category_counts = [categories[c] for c in self.categories]
+
+
+def _category(name):
+    if isinstance(name, db.Category):
+        return name
+    return db.Category(unicode(name))
+
+
+class AppEngineStore(storage.BlogStore):
+    """A BlogStore on the Entry, Comment and ArchiveSummary models.
+
+    Entries are indexed for search by a task posted to indexing_url, whose
+    handler calls index_entry().
+    """
+    def __init__(self, indexing_url="/tasks/searchindexing"):
+        self.indexing_url = indexing_url
+
+    def get_entry(self, key):
+        try:
+            return Entry.get(key)
+        except db.BadKeyError:
+            return None
+
+    def get_entry_by_slug(self, slug):
+        return Entry.get_by_slug(slug)
+
+    def refresh_links(self, entry):
+        entry.refresh_links()
+
+    def latest_entries(self, limit):
+        return db.Query(Entry).order('-published').fetch(limit=limit)
+
+    def get_page(self, page, page_size):
+        paged_query = PagedQuery(Entry.all().order('-published'), page_size)
+        return paged_query.fetch_page(page), paged_query.has_page(page + 1)
+
+    def entries_between(self, start, end):
+        return Entry.all().filter('published >=', start).filter(
+            'published <', end).order('-published')
+
+    def entries_in_category(self, category):
+        return Entry.all().order("-published").filter("categories =",
+                                                      category)
+
+    def create_entry(self, author, title, slug, markdown, html, categories):
+        now = datetime.datetime.utcnow()
+        entry = Entry(author=author, title=title, slug=slug,
+                      markdown=markdown, html=html,
+                      categories=[_category(c) for c in categories],
+                      published=now, updated=now)
+        entry.set_neighbours(db.Query(Entry).order('-published').get(), None)
+        entry.put()
+        neighbours = entry.update_neighbours()
+        months_changed = ArchiveSummary.record_entry(
+            published=entry.published, added_categories=entry.categories)
+        return storage.EntryUpdate(entry, set(),
+                                   [e.slug for e in neighbours],
+                                   months_changed)
+
+    def update_entry(self, entry, title, markdown, html, categories):
+        old_categories = set(entry.categories)
+        entry.title = title
+        entry.markdown = markdown
+        entry.html = html
+        entry.categories = [_category(c) for c in categories]
+        entry.updated = datetime.datetime.utcnow()
+        entry.put()
+        neighbours = entry.update_neighbours()
+        new_categories = set(entry.categories)
+        months_changed = ArchiveSummary.record_entry(
+            added_categories=new_categories - old_categories,
+            removed_categories=old_categories - new_categories)
+        return storage.EntryUpdate(entry, old_categories,
+                                   [e.slug for e in neighbours],
+                                   months_changed)
+
+    def iter_entries(self):
+        # Query iterators fetch their results in batches
+        return iter(db.Query(Entry).order("published"))
+
+    def iter_comments(self):
+        return iter(db.Query(Comment).order("slug").order("published"))
+
+    def get_comments(self, slug, limit, offset=0):
+        return db.Query(Comment).filter("slug =", slug).order(
+            "published").fetch(limit, offset)
+
+    def add_comment(self, entry, author, email, url, body):
+        comment = Comment(author=author, email=email, url=url, body=body,
+                          slug=entry.slug)
+        comment.put()
+        db.run_in_transaction(Entry.increment_comment_count, entry.key())
+        entry.uncache()
+        return comment
+
+    def archive_months(self):
+        return ArchiveSummary.get_summary().archive_list()
+
+    def categories(self):
+        return ArchiveSummary.get_summary().categories
+
+    def search(self, keywords):
+        return Entry.search(keywords)
+
+    def enqueue_indexing(self, entry):
+        entry.enqueue_indexing(url=self.indexing_url)
+
+    def index_entry(self, key):
+        entity = db.get(db.Key(key))
+        if entity:
+            entity.index()
@@ -0,0 +1,538 @@
+"""The SQL backend of the blog (see storage.BlogStore).
+
+Runs on MySQL through tornado.database.Connection, and on SQLite through
+tornado.database.SQLiteConnection:
+
+    store = SQLStore(database.Connection("localhost", "blog", "blog"))
+    store.create_tables()
+
+Every query the handlers make is answered from an index: entries by slug
+(unique) and by published, the entries of a category by (category,
+published) and the comments of an entry by (slug, published). Category
+and month counts for the archive sidebar come from the category index and
+a small table of per-month counters.
+
+Search uses the ranked engine of the search package over postings kept in
+the database; entries are indexed as soon as they are written.
+
+The tests are in tornado/test/sql_store_test.py and run against SQLite
+with the rest of the suite.
+"""
+
+import datetime
+import itertools
+import os
+import sys
+
+from tornado import database
+import storage
+
+# The search package needs App Engine, but its ranking engine does not
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "search"))
+import engine
+
+# Column types and index definitions that differ between the databases
+MYSQL_DIALECT = {
+    "id": "INT NOT NULL AUTO_INCREMENT PRIMARY KEY",
+    "text": "MEDIUMTEXT",
+    "datetime": "DATETIME",
+    "table_options": " ENGINE=InnoDB DEFAULT CHARSET=utf8",
+    "table_exists": "SHOW TABLES LIKE %s",
+}
+
+SQLITE_DIALECT = {
+    "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+    "text": "TEXT",
+    # Returned as datetime objects by SQLiteConnection
+    "datetime": "TIMESTAMP",
+    "table_options": "",
+    "table_exists": "SELECT name FROM sqlite_master "
+                    "WHERE type = 'table' AND name = %s",
+}
+
+SCHEMA = [
+    """CREATE TABLE entries (
+        id %(id)s,
+        author VARCHAR(255),
+        title VARCHAR(512) NOT NULL,
+        slug VARCHAR(255) NOT NULL,
+        markdown %(text)s NOT NULL,
+        html %(text)s NOT NULL,
+        published %(datetime)s NOT NULL,
+        updated %(datetime)s NOT NULL,
+        prev_slug VARCHAR(255),
+        prev_title VARCHAR(512),
+        next_slug VARCHAR(255),
+        next_title VARCHAR(512),
+        comment_count INT NOT NULL DEFAULT 0
+    )%(table_options)s""",
+    "CREATE UNIQUE INDEX entries_slug ON entries (slug)",
+    "CREATE INDEX entries_published ON entries (published)",
+
+    # Published is copied here so that a category page is one index scan
+    """CREATE TABLE entry_categories (
+        category VARCHAR(255) NOT NULL,
+        published %(datetime)s NOT NULL,
+        entry_id INT NOT NULL,
+        position INT NOT NULL,
+        PRIMARY KEY (category, published, entry_id)
+    )%(table_options)s""",
+    "CREATE INDEX entry_categories_entry ON entry_categories (entry_id)",
+
+    """CREATE TABLE comments (
+        id %(id)s,
+        slug VARCHAR(255) NOT NULL,
+        author %(text)s NOT NULL,
+        email VARCHAR(255) NOT NULL,
+        url VARCHAR(1024) NOT NULL,
+        body %(text)s NOT NULL,
+        published %(datetime)s NOT NULL
+    )%(table_options)s""",
+    "CREATE INDEX comments_slug ON comments (slug, published)",
+
+    """CREATE TABLE archive_months (
+        month CHAR(7) NOT NULL PRIMARY KEY,
+        entry_count INT NOT NULL
+    )%(table_options)s""",
+
+    # The chunk lists and postings of the search engine's postings lists
+    # (see engine.IndexStore)
+    """CREATE TABLE search_terms (
+        term VARCHAR(128) NOT NULL PRIMARY KEY,
+        reference_length DOUBLE NOT NULL
+    )%(table_options)s""",
+
+    """CREATE TABLE search_chunks (
+        term VARCHAR(128) NOT NULL,
+        chunk_id INT NOT NULL,
+        posting_count INT NOT NULL,
+        max_impact DOUBLE NOT NULL,
+        last_impact DOUBLE NOT NULL,
+        last_doc_id VARCHAR(64) NOT NULL,
+        PRIMARY KEY (term, chunk_id)
+    )%(table_options)s""",
+
+    """CREATE TABLE search_postings (
+        term VARCHAR(128) NOT NULL,
+        doc_id VARCHAR(64) NOT NULL,
+        chunk_id INT NOT NULL,
+        tf INT NOT NULL,
+        length INT NOT NULL,
+        PRIMARY KEY (term, doc_id)
+    )%(table_options)s""",
+    "CREATE INDEX search_postings_chunk ON search_postings (term, chunk_id)",
+    "CREATE INDEX search_postings_doc ON search_postings (doc_id)",
+
+    """CREATE TABLE search_documents (
+        doc_id VARCHAR(64) NOT NULL PRIMARY KEY,
+        length INT NOT NULL,
+        title VARCHAR(512)
+    )%(table_options)s""",
+
+    """CREATE TABLE search_stats (
+        name VARCHAR(64) NOT NULL PRIMARY KEY,
+        doc_count INT NOT NULL,
+        total_length INT NOT NULL
+    )%(table_options)s""",
+]
+
+# Longer terms are truncated to fit search_postings.term
+MAX_TERM_LENGTH = 128
+
+
+def dialect(db):
+    """Returns the dialect of the given tornado.database connection."""
+    if isinstance(db, database.SQLiteConnection):
+        return SQLITE_DIALECT
+    return MYSQL_DIALECT
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+class Entry(object):
+    """An entry row, with the attributes of the App Engine Entry model."""
+    # Neighbour links are kept up to date on every write
+    links_cached = True
+
+    def __init__(self, row, categories):
+        self.__dict__.update(row)
+        self.categories = categories
+
+    def key(self):
+        return str(self.id)
+
+
+class SQLIndexStore(engine.IndexStore):
+    """An engine.IndexStore kept in the search_* tables."""
+    STATS_NAME = "entries"
+
+    def __init__(self, db):
+        self.db = db
+
+    def _term(self, term):
+        return term[:MAX_TERM_LENGTH]
+
+    def get_headers(self, terms):
+        terms = dict((self._term(term), term) for term in terms)
+        if not terms:
+            return {}
+        result = {}
+        for row in self.db.query(
+                "SELECT term, reference_length FROM search_terms "
+                "WHERE term IN (%s)" % _placeholders(terms), *terms.keys()):
+            result[terms[row.term]] = (row.reference_length, [])
+        for row in self.db.query(
+                "SELECT term, chunk_id, posting_count, max_impact, "
+                "last_impact, last_doc_id FROM search_chunks "
+                "WHERE term IN (%s)" % _placeholders(terms), *terms.keys()):
+            header = result.get(terms[row.term])
+            if header is not None:
+                header[1].append((row.chunk_id, row.posting_count,
+                                  row.max_impact,
+                                  (-row.last_impact, row.last_doc_id)))
+        for reference_length, header in result.itervalues():
+            header.sort(key=lambda descriptor: descriptor[3])
+        return result
+
+    def get_chunks(self, keys):
+        keys = dict(((self._term(term), chunk_id), (term, chunk_id))
+                    for term, chunk_id in keys)
+        if not keys:
+            return {}
+        parameters = []
+        for key in keys:
+            parameters.extend(key)
+        result = {}
+        for row in self.db.query(
+                "SELECT term, chunk_id, doc_id, tf, length "
+                "FROM search_postings WHERE " +
+                " OR ".join(["(term = %s AND chunk_id = %s)"] * len(keys)),
+                *parameters):
+            chunk = result.setdefault(keys[row.term, row.chunk_id], {})
+            chunk[row.doc_id] = (row.tf, row.length)
+        return result
+
+    def put_postings(self, headers, chunks, changed):
+        # Only the postings that changed are written
+        removed = []
+        added = []
+        for (term, chunk_id), doc_ids in changed.iteritems():
+            chunk = chunks.get((term, chunk_id)) or {}
+            for doc_id in doc_ids:
+                if doc_id in chunk:
+                    tf, length = chunk[doc_id]
+                    added.append((self._term(term), doc_id, chunk_id, tf,
+                                  length))
+                else:
+                    removed.append((self._term(term), doc_id))
+        # A posting that moved to another chunk is removed, then added
+        if removed:
+            self.db.executemany("DELETE FROM search_postings "
+                                "WHERE term = %s AND doc_id = %s", removed)
+        if added:
+            self.db.executemany("REPLACE INTO search_postings "
+                                "(term, doc_id, chunk_id, tf, length) "
+                                "VALUES (%s, %s, %s, %s, %s)", added)
+        terms = [(self._term(term),) for term in headers]
+        if not terms:
+            return
+        self.db.executemany("DELETE FROM search_terms WHERE term = %s", terms)
+        self.db.executemany("DELETE FROM search_chunks WHERE term = %s",
+                            terms)
+        term_rows = []
+        chunk_rows = []
+        for term, header in headers.iteritems():
+            if header is None:
+                continue
+            reference_length, descriptors = header
+            term_rows.append((self._term(term), reference_length))
+            chunk_rows.extend(
+                (self._term(term), chunk_id, count, max_impact,
+                 -last_key[0], last_key[1])
+                for chunk_id, count, max_impact, last_key in descriptors)
+        if term_rows:
+            self.db.executemany("INSERT INTO search_terms "
+                                "(term, reference_length) VALUES (%s, %s)",
+                                term_rows)
+            self.db.executemany("INSERT INTO search_chunks "
+                                "(term, chunk_id, posting_count, max_impact, "
+                                "last_impact, last_doc_id) "
+                                "VALUES (%s, %s, %s, %s, %s, %s)", chunk_rows)
+
+    def get_documents(self, doc_ids):
+        if not doc_ids:
+            return {}
+        result = {}
+        for row in self.db.query(
+                "SELECT doc_id, length, title FROM search_documents "
+                "WHERE doc_id IN (%s)" % _placeholders(doc_ids), *doc_ids):
+            result[row.doc_id] = (row.length, {}, row.title)
+        if result:
+            for row in self.db.query(
+                    "SELECT doc_id, term, tf FROM search_postings "
+                    "WHERE doc_id IN (%s)" % _placeholders(result),
+                    *result.keys()):
+                result[row.doc_id][1][row.term] = row.tf
+        return result
+
+    def put_document(self, doc_id, record):
+        if record is None:
+            self.db.execute("DELETE FROM search_documents WHERE doc_id = %s",
+                            doc_id)
+        else:
+            length, terms, title = record
+            self.db.execute("REPLACE INTO search_documents "
+                            "(doc_id, length, title) VALUES (%s, %s, %s)",
+                            doc_id, length, title)
+
+    def get_stats(self):
+        row = self.db.get("SELECT doc_count, total_length FROM search_stats "
+                          "WHERE name = %s", self.STATS_NAME)
+        if row is None:
+            return 0, 0
+        return row.doc_count, row.total_length
+
+    def update_stats(self, count_delta, length_delta):
+        if self.db.get("SELECT name FROM search_stats WHERE name = %s",
+                       self.STATS_NAME) is None:
+            self.db.execute("INSERT INTO search_stats "
+                            "(name, doc_count, total_length) "
+                            "VALUES (%s, 0, 0)", self.STATS_NAME)
+        self.db.execute("UPDATE search_stats SET "
+                        "doc_count = doc_count + %s, "
+                        "total_length = total_length + %s WHERE name = %s",
+                        count_delta, length_delta, self.STATS_NAME)
+
+
+class SQLStore(storage.BlogStore):
+    """A BlogStore in a MySQL or SQLite database.
+
+    With a cache_ttl, entry and comment reads go through a
+    tornado.database.ResultCache, which this store invalidates when it
+    writes. Writes made by other processes show after cache_ttl seconds.
+
+    iter_entries() and iter_comments() stream rows from an unbuffered
+    cursor, and a MySQL connection can't run other queries until it is
+    exhausted. Give the store a tornado.database.ConnectionPool if other
+    requests may run while an export is being sent.
+    """
+    def __init__(self, db, cache_ttl=0):
+        self.db = db
+        self.index = engine.InvertedIndex(SQLIndexStore(db))
+        self.cache = None
+        if cache_ttl:
+            self.cache = database.ResultCache(db, ttl=cache_ttl)
+
+    def _query(self, keys, query, *parameters):
+        if self.cache is None:
+            return self.db.query(query, *parameters)
+        return self.cache.query(keys, query, *parameters)
+
+    def _invalidate(self, *keys):
+        if self.cache is not None:
+            self.cache.invalidate(*keys)
+
+    def create_tables(self):
+        """Creates the tables and indexes unless they already exist."""
+        types = dialect(self.db)
+        if self.db.query(types["table_exists"], "entries"):
+            return
+        for statement in SCHEMA:
+            self.db.execute(statement % types)
+
+    def _entries(self, where, *parameters):
+        rows = self._query("entries", "SELECT * FROM entries " + where,
+                           *parameters)
+        if not rows:
+            return []
+        categories = {}
+        for row in self._query("entries",
+                "SELECT entry_id, category FROM entry_categories "
+                "WHERE entry_id IN (%s) ORDER BY position" %
+                _placeholders(rows), *[row.id for row in rows]):
+            categories.setdefault(row.entry_id, []).append(row.category)
+        return [Entry(row, categories.get(row.id, [])) for row in rows]
+
+    def get_entry(self, key):
+        try:
+            entry_id = int(key)
+        except (TypeError, ValueError):
+            return None
+        entries = self._entries("WHERE id = %s", entry_id)
+        return entries and entries[0] or None
+
+    def get_entry_by_slug(self, slug):
+        entries = self._entries("WHERE slug = %s", slug)
+        return entries and entries[0] or None
+
+    def refresh_links(self, entry):
+        pass
+
+    def latest_entries(self, limit):
+        return self._entries("ORDER BY published DESC LIMIT %s", limit)
+
+    def get_page(self, page, page_size):
+        if page < 1:
+            return [], False
+        entries = self._entries("ORDER BY published DESC LIMIT %s OFFSET %s",
+                                page_size + 1, (page - 1) * page_size)
+        return entries[:page_size], len(entries) > page_size
+
+    def entries_between(self, start, end):
+        return self._entries("WHERE published >= %s AND published < %s "
+                             "ORDER BY published DESC", start, end)
+
+    def entries_in_category(self, category):
+        ids = [row.entry_id for row in self._query("entries",
+            "SELECT entry_id FROM entry_categories WHERE category = %s "
+            "ORDER BY published DESC", category)]
+        return self._ordered_entries(ids)
+
+    def _ordered_entries(self, ids):
+        if not ids:
+            return []
+        entries = dict((entry.id, entry) for entry in self._entries(
+            "WHERE id IN (%s)" % _placeholders(ids), *ids))
+        return [entries[entry_id] for entry_id in ids if entry_id in entries]
+
+    def _set_categories(self, entry_id, categories, published):
+        self.db.execute("DELETE FROM entry_categories WHERE entry_id = %s",
+                        entry_id)
+        seen = set()
+        rows = []
+        for category in categories:
+            if category not in seen:
+                seen.add(category)
+                rows.append((category, published, entry_id, len(rows)))
+        if rows:
+            self.db.executemany("INSERT INTO entry_categories "
+                                "(category, published, entry_id, position) "
+                                "VALUES (%s, %s, %s, %s)", rows)
+
+    def _count_month(self, published):
+        """Counts a new entry in its month. Returns True if the month is
+        new to the archive."""
+        month = published.strftime("%Y-%m")
+        if self.db.get("SELECT month FROM archive_months WHERE month = %s",
+                       month) is None:
+            self.db.execute("INSERT INTO archive_months (month, entry_count) "
+                            "VALUES (%s, 1)", month)
+            return True
+        self.db.execute("UPDATE archive_months SET entry_count = "
+                        "entry_count + 1 WHERE month = %s", month)
+        return False
+
+    def create_entry(self, author, title, slug, markdown, html, categories):
+        if hasattr(author, "email"):
+            author = author.email()
+        now = datetime.datetime.utcnow()
+        self._invalidate("entries")
+        latest = self.latest_entries(1)
+        prev_entry = latest and latest[0] or None
+        entry_id = self.db.execute(
+            "INSERT INTO entries (author, title, slug, markdown, html, "
+            "published, updated, prev_slug, prev_title) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            author, title, slug, markdown, html, now, now,
+            prev_entry and prev_entry.slug, prev_entry and prev_entry.title)
+        self._set_categories(entry_id, categories, now)
+        neighbours = []
+        if prev_entry:
+            self.db.execute("UPDATE entries SET next_slug = %s, "
+                            "next_title = %s WHERE id = %s",
+                            slug, title, prev_entry.id)
+            neighbours.append(prev_entry.slug)
+        months_changed = self._count_month(now)
+        self._invalidate("entries")
+        return storage.EntryUpdate(self.get_entry(entry_id), set(),
+                                   neighbours, months_changed)
+
+    def update_entry(self, entry, title, markdown, html, categories):
+        self.db.execute("UPDATE entries SET title = %s, markdown = %s, "
+                        "html = %s, updated = %s WHERE id = %s",
+                        title, markdown, html, datetime.datetime.utcnow(),
+                        entry.id)
+        self._set_categories(entry.id, categories, entry.published)
+        neighbours = []
+        if title != entry.title:
+            # The given entry may predate a newer entry's link to it
+            links = self.db.get("SELECT prev_slug, next_slug FROM entries "
+                                "WHERE id = %s", entry.id)
+            if links.prev_slug:
+                self.db.execute("UPDATE entries SET next_title = %s "
+                                "WHERE slug = %s", title, links.prev_slug)
+                neighbours.append(links.prev_slug)
+            if links.next_slug:
+                self.db.execute("UPDATE entries SET prev_title = %s "
+                                "WHERE slug = %s", title, links.next_slug)
+                neighbours.append(links.next_slug)
+        self._invalidate("entries")
+        return storage.EntryUpdate(self.get_entry(entry.id),
+                                   set(entry.categories), neighbours, False)
+
+    def iter_entries(self):
+        # One query, so that the rows stream from a single cursor; the
+        # categories of an entry are on consecutive rows
+        rows = self.db.iter(
+            "SELECT entries.*, entry_categories.category AS _category "
+            "FROM entries LEFT JOIN entry_categories "
+            "ON entry_categories.entry_id = entries.id "
+            "ORDER BY entries.published, entries.id, "
+            "entry_categories.position")
+        for entry_id, group in itertools.groupby(rows, lambda row: row.id):
+            categories = []
+            for row in group:
+                if row._category is not None:
+                    categories.append(row._category)
+            row = dict(row)
+            del row["_category"]
+            yield Entry(row, categories)
+
+    def iter_comments(self):
+        return self.db.iter("SELECT * FROM comments ORDER BY slug, published")
+
+    def get_comments(self, slug, limit, offset=0):
+        return self._query("comments", "SELECT * FROM comments "
+                           "WHERE slug = %s ORDER BY published "
+                           "LIMIT %s OFFSET %s", slug, limit, offset)
+
+    def add_comment(self, entry, author, email, url, body):
+        published = datetime.datetime.utcnow()
+        comment_id = self.db.execute(
+            "INSERT INTO comments (slug, author, email, url, body, "
+            "published) VALUES (%s, %s, %s, %s, %s, %s)",
+            entry.slug, author, email, url, body, published)
+        self.db.execute("UPDATE entries SET comment_count = "
+                        "comment_count + 1 WHERE id = %s", entry.id)
+        self._invalidate("entries", "comments")
+        return database.Row(id=comment_id, slug=entry.slug, author=author,
+                            email=email, url=url, body=body,
+                            published=published)
+
+    def archive_months(self):
+        return storage.archive_list([row.month for row in self._query(
+            "entries", "SELECT month FROM archive_months WHERE entry_count > 0 "
+            "ORDER BY month DESC")])
+
+    def categories(self):
+        return [row.category for row in self._query("entries",
+            "SELECT DISTINCT category FROM entry_categories "
+            "ORDER BY category")]
+
+    def search(self, keywords):
+        return self._ordered_entries([int(doc_id) for doc_id, score
+                                      in self.index.search(keywords)])
+
+    def enqueue_indexing(self, entry):
+        # There is no task queue; indexing an entry takes a few queries
+        self.index_entry(entry.key())
+
+    def index_entry(self, key):
+        entry = self.get_entry(key)
+        if entry:
+            self.index.add(entry.key(), entry.title + u"\n" + entry.markdown,
+                           title=entry.slug)
+
@@ -14,16 +14,28 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-"""A lightweight wrapper around MySQLdb."""
+"""A lightweight wrapper around MySQLdb and sqlite3."""
 
 import copy
-import MySQLdb.constants
-import MySQLdb.converters
-import MySQLdb.cursors
 import itertools
 import logging
+import re
+import sys
+import threading
 import time
 
+try:
+    import MySQLdb.constants
+    import MySQLdb.converters
+    import MySQLdb.cursors
+except ImportError:
+    MySQLdb = None
+
+try:
+    import sqlite3 # Python 2.5+
+except ImportError:
+    sqlite3 = None
+
 class Connection(object):
     """A lightweight wrapper around MySQLdb DB-API connections.
 
@@ -39,12 +51,17 @@ class Connection(object):
 
     We explicitly set the timezone to UTC and the character encoding to
     UTF-8 on all connections to avoid time zone and encoding errors.
+
+    Rows are Row dicts. With compact_rows=True they are read-only
+    CompactRow tuples instead, which take a third of the memory in large
+    listing queries; see CompactRow for how they differ from dicts.
     """
     def __init__(self, host, database, user=None, password=None,
-                 max_idle_time=7*3600):
+                 max_idle_time=7*3600, compact_rows=False):
         self.host = host
         self.database = database
         self.max_idle_time = max_idle_time
+        self.compact_rows = compact_rows
 
         args = dict(conv=CONVERSIONS, use_unicode=True, charset="utf8",
                     db=database, init_command='SET time_zone = "+0:00"',
@@ -97,9 +114,9 @@ class Connection(object):
         cursor = MySQLdb.cursors.SSCursor(self._db)
         try:
             self._execute(cursor, query, parameters)
-            column_names = [d[0] for d in cursor.description]
+            make_row = self._row_factory(cursor.description)
             for row in cursor:
-                yield Row(zip(column_names, row))
+                yield make_row(row)
         finally:
             cursor.close()
 
@@ -108,8 +125,8 @@ class Connection(object):
         cursor = self._cursor()
         try:
             self._execute(cursor, query, parameters)
-            column_names = [d[0] for d in cursor.description]
-            return [Row(itertools.izip(column_names, row)) for row in cursor]
+            return map(self._row_factory(cursor.description),
+                       cursor.fetchall())
         finally:
             cursor.close()
 
@@ -159,6 +176,12 @@ class Connection(object):
         self._ensure_connected()
         return self._db.cursor()
 
+    def _row_factory(self, description):
+        if self.compact_rows:
+            return _row_class(description)
+        column_names = [d[0] for d in description]
+        return lambda row: Row(itertools.izip(column_names, row))
+
     def _execute(self, cursor, query, parameters):
         try:
             return cursor.execute(query, parameters)
@@ -168,6 +191,482 @@ class Connection(object):
             raise
 
 
+class SQLiteConnection(Connection):
+    """A Connection to an SQLite database, with the same interface.
+
+    Queries are written with MySQLdb's "%s" parameter markers, so code
+    written for Connection runs against SQLite as long as its SQL is
+    portable, e.g. in tests. Columns declared as TIMESTAMP are returned as
+    datetime objects.
+
+        db = database.SQLiteConnection(":memory:")
+
+    The connection is in autocommit mode, like Connection.
+
+    SQLite compiles each query into a prepared statement, and the
+    connection keeps the last cached_statements of them ready for reuse,
+    so a query that is run again with different parameters is not parsed
+    and planned again. Pass the parameters rather than formatting them
+    into the query to benefit.
+    """
+    def __init__(self, path, cached_statements=256, compact_rows=False):
+        self.host = path
+        self.database = path
+        self.cached_statements = cached_statements
+        self.compact_rows = compact_rows
+        self._db = None
+        self._last_use_time = time.time()
+        self.reconnect()
+
+    def reconnect(self):
+        """Closes the existing database connection and re-opens it.
+
+        An in-memory database is lost when its connection is closed.
+        """
+        self.close()
+        # A ConnectionPool hands connections to one thread at a time
+        self._db = sqlite3.connect(self.database, isolation_level=None,
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+
+    def iter(self, query, *parameters):
+        """Returns an iterator for the given query and parameters."""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters)
+            make_row = self._row_factory(cursor.description)
+            for row in cursor:
+                yield make_row(row)
+        finally:
+            cursor.close()
+
+    def executemany(self, query, parameters):
+        """Executes the given query against all the given param sequences.
+
+        We return the lastrowid from the query.
+        """
+        cursor = self._cursor()
+        try:
+            try:
+                cursor.executemany(_qmark(query), parameters)
+            except sqlite3.Error:
+                _reraise_sqlite_error()
+            return cursor.lastrowid
+        finally:
+            cursor.close()
+
+    def _ensure_connected(self):
+        # SQLite connections never time out, and reconnecting would lose
+        # an in-memory database
+        if self._db is None:
+            self.reconnect()
+        self._last_use_time = time.time()
+
+    def _execute(self, cursor, query, parameters):
+        try:
+            return cursor.execute(_qmark(query), parameters)
+        except sqlite3.Error:
+            _reraise_sqlite_error()
+
+
+_FORMAT_MARKER = re.compile(r"%([s%])")
+_QMARK_CACHE_SIZE = 1024
+_qmark_cache = {}
+
+def _qmark(query):
+    """Converts a query from the "format" to the "qmark" parameter style.
+
+    Conversions are cached: the converted text is the key of SQLite's
+    prepared statement cache, so a hot query costs one dict lookup here.
+    """
+    converted = _qmark_cache.get(query)
+    if converted is None:
+        converted = _FORMAT_MARKER.sub(
+            lambda match: match.group(1) == "s" and "?" or "%", query)
+        if len(_qmark_cache) >= _QMARK_CACHE_SIZE:
+            _qmark_cache.clear()
+        _qmark_cache[query] = converted
+    return converted
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the timeout."""
+    pass
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections.
+
+    The pool has the query/get/execute/executemany/iter methods of
+    Connection; each call checks a connection out for its duration. It
+    takes a function that opens a new connection:
+
+        pool = database.ConnectionPool(
+            functools.partial(database.Connection, "localhost", "mydb"),
+            min_size=2, max_size=20)
+        for article in pool.query("SELECT * FROM articles"):
+            print article.title
+
+    Connections are opened on demand, up to max_size; min_size of them
+    are opened up front and kept even when idle. A call that finds every
+    connection in use waits for one to be checked in, for at most
+    checkout_timeout seconds, and then raises PoolTimeoutError.
+
+    Idle connections are reused most recently used first, so that the
+    pool shrinks back when load drops: connections beyond min_size that
+    have been idle for more than max_idle_time seconds are closed. A
+    connection that has been idle for more than check_interval seconds is
+    tested with "SELECT 1" before it is handed out, and replaced if the
+    test fails.
+
+    stats() returns counters for sizing the pool under load.
+    """
+    def __init__(self, connect, min_size=1, max_size=10,
+                 checkout_timeout=10.0, max_idle_time=600,
+                 check_interval=30):
+        assert 0 <= min_size <= max_size
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_idle_time = max_idle_time
+        self.check_interval = check_interval
+        self._condition = threading.Condition()
+        self._idle = []  # (connection, checkin time), most recent last
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = dict(checkouts=0, waits=0, wait_time=0.0,
+                           max_wait_time=0.0, timeouts=0, opened=0,
+                           recycled=0, failed_checks=0)
+        for i in range(min_size):
+            self._size += 1
+            self._idle.append((self._open(), time.time()))
+
+    def query(self, query, *parameters):
+        """Returns a row list for the given query and parameters."""
+        connection = self.checkout()
+        try:
+            return connection.query(query, *parameters)
+        finally:
+            self.checkin(connection)
+
+    def get(self, query, *parameters):
+        """Returns the first row returned for the given query."""
+        connection = self.checkout()
+        try:
+            return connection.get(query, *parameters)
+        finally:
+            self.checkin(connection)
+
+    def execute(self, query, *parameters):
+        """Executes the given query, returning the lastrowid from the query."""
+        connection = self.checkout()
+        try:
+            return connection.execute(query, *parameters)
+        finally:
+            self.checkin(connection)
+
+    def executemany(self, query, parameters):
+        """Executes the given query against all the given param sequences."""
+        connection = self.checkout()
+        try:
+            return connection.executemany(query, parameters)
+        finally:
+            self.checkin(connection)
+
+    def iter(self, query, *parameters):
+        """Returns an iterator for the given query and parameters.
+
+        The connection stays checked out until the iterator is exhausted
+        or closed.
+        """
+        connection = self.checkout()
+        try:
+            for row in connection.iter(query, *parameters):
+                yield row
+        finally:
+            self.checkin(connection)
+
+    def checkout(self, timeout=None):
+        """Takes a connection out of the pool.
+
+        The connection must be given back with checkin().
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+        start = time.time()
+        waited = False
+        self._condition.acquire()
+        try:
+            while True:
+                assert not self._closed, "Pool closed"
+                self._recycle_idle()
+                if self._idle:
+                    connection, checkin_time = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Open the connection outside the lock
+                    connection, checkin_time = None, None
+                    self._size += 1
+                    break
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        "No connection free after %.3f seconds" % timeout)
+                waited = True
+                self._condition.wait(remaining)
+            self._in_use += 1
+            wait_time = time.time() - start
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time"] += wait_time
+                self._stats["max_wait_time"] = max(
+                    self._stats["max_wait_time"], wait_time)
+        finally:
+            self._condition.release()
+        try:
+            if connection is None:
+                connection = self._open()
+            elif time.time() - checkin_time > self.check_interval:
+                connection = self._check(connection)
+        except:
+            self._discard()
+            raise
+        return connection
+
+    def checkin(self, connection):
+        """Returns a connection taken with checkout() to the pool."""
+        self._condition.acquire()
+        try:
+            self._in_use -= 1
+            if self._closed:
+                self._size -= 1
+                connection.close()
+            else:
+                self._idle.append((connection, time.time()))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """Closes the idle connections, and the others when checked in."""
+        self._condition.acquire()
+        try:
+            self._closed = True
+            for connection, checkin_time in self._idle:
+                connection.close()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        """Returns a dict of pool metrics.
+
+        size, in_use and idle count connections now. The rest are totals:
+        checkouts, waits (checkouts that found no free connection) and the
+        total and maximum time they waited, timeouts, connections opened,
+        recycled for being idle and replaced after failed_checks.
+        """
+        self._condition.acquire()
+        try:
+            stats = dict(self._stats)
+            stats.update(size=self._size, in_use=self._in_use,
+                         idle=len(self._idle), max_size=self.max_size)
+            return stats
+        finally:
+            self._condition.release()
+
+    def _open(self):
+        connection = self.connect()
+        self._count("opened")
+        return connection
+
+    def _count(self, name):
+        self._condition.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._condition.release()
+
+    def _check(self, connection):
+        try:
+            connection.query("SELECT 1")
+            return connection
+        except Exception:
+            logging.warning("Replacing pooled connection to %s",
+                            connection.host, exc_info=True)
+            self._count("failed_checks")
+            connection.close()
+            return self._open()
+
+    def _discard(self):
+        self._condition.acquire()
+        try:
+            self._size -= 1
+            self._in_use -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _recycle_idle(self):
+        # Called with the lock held. The oldest idle connections come first.
+        now = time.time()
+        while (self._idle and self._size > self.min_size and
+               now - self._idle[0][1] > self.max_idle_time):
+            connection, checkin_time = self._idle.pop(0)
+            connection.close()
+            self._size -= 1
+            self._stats["recycled"] += 1
+
+
+class ResultCache(object):
+    """An opt-in, in-memory read-through cache of query results.
+
+    It wraps a Connection or ConnectionPool. Each cached query names the
+    invalidation keys its result depends on, and writers invalidate those
+    keys after changing the data; results also expire after ttl seconds,
+    which bounds how stale they get when another process writes:
+
+        cache = database.ResultCache(db, ttl=60)
+        entries = cache.query(["entries"], "SELECT * FROM entries "
+                              "ORDER BY published DESC LIMIT %s", 10)
+        ...
+        db.execute("UPDATE entries SET title = %s WHERE id = %s", ...)
+        cache.invalidate("entries")
+
+    Results are keyed by the query text and parameters, which must be
+    hashable; other queries are passed through. The same rows are handed
+    to every caller, so they must not be changed (compact_rows
+    connections make them read-only). At most max_size results are kept. A
+    query that is running when one of its keys is invalidated does not
+    cache its result. The cache is thread-safe.
+    """
+    def __init__(self, db, ttl=60, max_size=1000):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._results = {}  # (query, parameters) -> (expiry, rows, keys)
+        self._keyed = {}  # invalidation key -> set of (query, parameters)
+        self._generations = {}  # invalidation key -> invalidation count
+        self._epoch = 0  # clear() count
+        self._stats = dict(hits=0, misses=0, invalidations=0)
+
+    def query(self, keys, query, *parameters):
+        """Returns a row list for the given query and parameters."""
+        return list(self._rows(keys, query, parameters))
+
+    def get(self, keys, query, *parameters):
+        """Returns the first row returned for the given query."""
+        rows = self._rows(keys, query, parameters)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise Exception("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
+
+    def invalidate(self, *keys):
+        """Drops the cached results that depend on any of the given keys."""
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._stats["invalidations"] += 1
+                for cache_key in self._keyed.pop(key, ()):
+                    self._drop(cache_key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Drops every cached result."""
+        self._lock.acquire()
+        try:
+            self._epoch += 1
+            self._results.clear()
+            self._keyed.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a dict of hits, misses, invalidations and size."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats["size"] = len(self._results)
+            return stats
+        finally:
+            self._lock.release()
+
+    def _rows(self, keys, query, parameters):
+        if isinstance(keys, basestring):
+            keys = (keys,)
+        cache_key = (query, parameters)
+        try:
+            hash(cache_key)
+        except TypeError:
+            return self.db.query(query, *parameters)
+        self._lock.acquire()
+        try:
+            cached = self._results.get(cache_key)
+            if cached is not None and cached[0] > time.time():
+                self._stats["hits"] += 1
+                return cached[1]
+            self._stats["misses"] += 1
+            generations = self._generation(keys)
+        finally:
+            self._lock.release()
+        rows = self.db.query(query, *parameters)
+        self._lock.acquire()
+        try:
+            if generations == self._generation(keys):
+                self._store(cache_key, rows, keys)
+        finally:
+            self._lock.release()
+        return rows
+
+    def _generation(self, keys):
+        # Called with the lock held. Changes if any of the keys is
+        # invalidated or the cache is cleared.
+        return [self._epoch] + [self._generations.get(key, 0)
+                                for key in keys]
+
+    def _store(self, cache_key, rows, keys):
+        # Called with the lock held
+        if cache_key not in self._results and \
+           len(self._results) >= self.max_size:
+            now = time.time()
+            for old_key, (expiry, old_rows, old_keys) in \
+                    self._results.items():
+                if expiry <= now:
+                    self._drop(old_key)
+            if len(self._results) >= self.max_size:
+                self._results.clear()
+                self._keyed.clear()
+        self._drop(cache_key)
+        keys = tuple(keys)
+        self._results[cache_key] = (time.time() + self.ttl, rows, keys)
+        for key in keys:
+            self._keyed.setdefault(key, set()).add(cache_key)
+
+    def _drop(self, cache_key):
+        # Called with the lock held
+        cached = self._results.pop(cache_key, None)
+        if cached is not None:
+            for key in cached[2]:
+                keyed = self._keyed.get(key)
+                if keyed is not None:
+                    keyed.discard(cache_key)
+                    if not keyed:
+                        del self._keyed[key]
+
+
 class Row(dict):
     """A dict that allows for object-like property access syntax."""
     def __getattr__(self, name):
@@ -177,19 +676,136 @@ class Row(dict):
             raise AttributeError(name)
 
 
-# Fix the access conversions to properly recognize unicode/binary
-FIELD_TYPE = MySQLdb.constants.FIELD_TYPE
-FLAG = MySQLdb.constants.FLAG
-CONVERSIONS = copy.deepcopy(MySQLdb.converters.conversions)
+class CompactRow(tuple):
+    """A read-only row stored as a tuple, returned by compact_rows queries.
+
+    It reads like a Row: columns are attributes and keys, and keys(),
+    values(), items(), get(), iteration and "in" behave as for a dict, so
+    dict(row) copies it. Each set of column names gets its own subclass
+    with a property per column, so a row costs one tuple rather than a
+    dict, which matters for large listing queries.
+
+    It is not a dict, though: convert it with dict(row) before modifying
+    it or passing it to json_encode or RequestHandler.write.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        # Columns whose names are not identifiers or clash with methods
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return tuple.__hash__(self)
+
+    def __repr__(self):
+        return "Row(%s)" % ", ".join(["%s=%r" % item for item in self.items()])
+
+    def __reduce__(self):
+        # The subclasses are made at runtime and can't be pickled by name
+        return (Row, (self.items(),))
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return zip(self._fields, tuple.__iter__(self))
+
+    def iterkeys(self):
+        return iter(self._fields)
+
+    def itervalues(self):
+        return tuple.__iter__(self)
+
+    def iteritems(self):
+        return itertools.izip(self._fields, tuple.__iter__(self))
+
+    def has_key(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            return default
+
+
+_row_classes = {}
+
+def _row_class(description):
+    """Returns the CompactRow subclass for a cursor's column names."""
+    fields = tuple([d[0] for d in description])
+    row_class = _row_classes.get(fields)
+    if row_class is None:
+        namespace = dict(__slots__=(), _fields=fields, _index={})
+        for i, name in enumerate(fields):
+            namespace["_index"][name] = i
+            if not name.startswith("_") and name not in vars(CompactRow):
+                namespace[name] = property(
+                    lambda self, i=i: tuple.__getitem__(self, i))
+        row_class = type("Row", (CompactRow,), namespace)
+        _row_classes[fields] = row_class
+    return row_class
+
+
+if MySQLdb is not None:
+    # Fix the access conversions to properly recognize unicode/binary
+    FIELD_TYPE = MySQLdb.constants.FIELD_TYPE
+    FLAG = MySQLdb.constants.FLAG
+    CONVERSIONS = copy.deepcopy(MySQLdb.converters.conversions)
+
+    field_types = [FIELD_TYPE.BLOB, FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING]
+    if 'VARCHAR' in vars(FIELD_TYPE):
+        field_types.append(FIELD_TYPE.VARCHAR)
+
+    for field_type in field_types:
+        CONVERSIONS[field_type].insert(0, (FLAG.BINARY, str))
 
-field_types = [FIELD_TYPE.BLOB, FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING]
-if 'VARCHAR' in vars(FIELD_TYPE):
-    field_types.append(FIELD_TYPE.VARCHAR)
 
-for field_type in field_types:
-    CONVERSIONS[field_type].insert(0, (FLAG.BINARY, str))
+# Alias some common MySQL exceptions. Without MySQLdb they are sqlite3's;
+# otherwise SQLiteConnection re-raises sqlite3 errors as MySQLdb's.
+if MySQLdb is not None:
+    IntegrityError = MySQLdb.IntegrityError
+    OperationalError = MySQLdb.OperationalError
+else:
+    IntegrityError = sqlite3.IntegrityError
+    OperationalError = sqlite3.OperationalError
 
 
-# Alias some common MySQL exceptions
-IntegrityError = MySQLdb.IntegrityError
-OperationalError = MySQLdb.OperationalError
+def _reraise_sqlite_error():
+    """Re-raises the sqlite3 error being handled as our alias for it."""
+    error_type, error, traceback = sys.exc_info()
+    for driver_error, alias in ((sqlite3.IntegrityError, IntegrityError),
+                                (sqlite3.OperationalError, OperationalError)):
+        if isinstance(error, driver_error) and alias is not driver_error:
+            raise alias, alias(*error.args), traceback
+    raise error_type, error, traceback
@@ -21,8 +21,10 @@ import errno
 import logging
 import os
 import socket
+import sys
 import time
 import urlparse
+import weakref
 
 from tornado import httputil
 from tornado import ioloop
@@ -47,6 +49,18 @@ try:
 except ImportError:
     multiprocessing = None
 
+# Unsent response bytes up to which HTTPConnection goes on to the next
+# request before the previous response has been sent
+_MAX_PIPELINED_OUTPUT = 64 * 1024
+
+# Linux 3.9+ supports SO_REUSEPORT, but Python 2 doesn't export the constant
+if hasattr(socket, "SO_REUSEPORT"):
+    _SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith("linux"):
+    _SO_REUSEPORT = 15
+else:
+    _SO_REUSEPORT = None
+
 def _cpu_count():
     if multiprocessing is not None:
         try:
@@ -125,9 +139,18 @@ class HTTPServer(object):
     all with their own IOLoop. You can also pass in the specific number of
     child processes you want to run with if you want to override this
     auto-detection.
+
+    start() does not restart child processes that die. For production use,
+    tornado.process.Supervisor runs a supervised pool of workers that each
+    bind their own socket with SO_REUSEPORT.
+
+    If edge_triggered is True, connections are registered with the IOLoop
+    once rather than switched between reading and writing for every
+    request (see IOStream). It has no effect on SSL connections or where
+    the IOLoop doesn't use epoll.
     """
     def __init__(self, request_callback, no_keep_alive=False, io_loop=None,
-                 xheaders=False, ssl_options=None):
+                 xheaders=False, ssl_options=None, edge_triggered=False):
         """Initializes the server with the given request callback.
 
         If you use pre-forking/start() instead of the listen() method to
@@ -140,8 +163,11 @@ class HTTPServer(object):
         self.io_loop = io_loop
         self.xheaders = xheaders
         self.ssl_options = ssl_options
+        self.edge_triggered = edge_triggered
         self._socket = None
         self._started = False
+        self.request_count = 0
+        self._requests = weakref.WeakKeyDictionary()
 
     def listen(self, port, address=""):
         """Binds to the given port and starts the server in a single process.
@@ -155,12 +181,17 @@ class HTTPServer(object):
         self.bind(port, address)
         self.start(1)
 
-    def bind(self, port, address=""):
+    def bind(self, port, address="", reuse_port=False):
         """Binds this server to the given port on the given IP address.
 
         To start the server, call start(). If you want to run this server
         in a single process, you can call listen() as a shortcut to the
         sequence of bind() and start() calls.
+
+        If reuse_port is True, the socket is bound with SO_REUSEPORT, so
+        that several processes can each bind their own socket to the same
+        port and the kernel balances incoming connections between them.
+        socket.error is raised if the platform does not support it.
         """
         assert not self._socket
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
@@ -168,6 +199,18 @@ class HTTPServer(object):
         flags |= fcntl.FD_CLOEXEC
         fcntl.fcntl(self._socket.fileno(), fcntl.F_SETFD, flags)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            if _SO_REUSEPORT is None:
+                self._socket.close()
+                self._socket = None
+                raise socket.error(errno.ENOPROTOOPT,
+                                   "SO_REUSEPORT is not supported")
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+            except socket.error:
+                self._socket.close()
+                self._socket = None
+                raise
         self._socket.setblocking(0)
         self._socket.bind((address, port))
         self._socket.listen(128)
@@ -232,6 +275,20 @@ class HTTPServer(object):
         self.io_loop.remove_handler(self._socket.fileno())
         self._socket.close()
 
+    def requests_in_progress(self):
+        """Returns the number of requests that have not finished yet.
+
+        Requests whose connection has been closed are not counted.
+        """
+        return len([request for request in self._requests.keys()
+                    if request._finish_time is None
+                    and not request.connection.stream.closed()])
+
+    def _on_request(self, request):
+        self.request_count += 1
+        self._requests[request] = True
+        self.request_callback(request)
+
     def _handle_events(self, fd, events):
         while True:
             try:
@@ -261,8 +318,10 @@ class HTTPServer(object):
                 if self.ssl_options is not None:
                     stream = iostream.SSLIOStream(connection, io_loop=self.io_loop)
                 else:
-                    stream = iostream.IOStream(connection, io_loop=self.io_loop)
-                HTTPConnection(stream, address, self.request_callback,
+                    stream = iostream.IOStream(
+                        connection, io_loop=self.io_loop,
+                        edge_triggered=self.edge_triggered)
+                HTTPConnection(stream, address, self._on_request,
                                self.no_keep_alive, self.xheaders)
             except:
                 logging.error("Error in connection callback", exc_info=True)
@@ -276,6 +335,12 @@ class HTTPConnection(object):
 
     We parse HTTP headers and bodies, and execute the request callback
     until the HTTP conection is closed.
+
+    Requests pipelined by HTTP/1.1 clients are taken from the read buffer
+    as soon as the previous request has finished, without waiting for its
+    response to be sent, so the responses to a batch of requests go out
+    together. One request is executed at a time, which keeps the
+    responses in order.
     """
     def __init__(self, stream, address, request_callback, no_keep_alive=False,
                  xheaders=False):
@@ -286,14 +351,27 @@ class HTTPConnection(object):
         self.xheaders = xheaders
         self._request = None
         self._request_finished = False
+        self._write_callbacks = []
+        # Set while request_callback runs, so that requests that are
+        # already buffered are run by the same loop rather than recursively
+        self._dispatching = False
+        self._dispatch_pending = False
         # Save stack context here, outside of any request.  This keeps
         # contexts from one request from leaking into the next.
         self._header_callback = stack_context.wrap(self._on_headers)
         self.stream.read_until("\r\n\r\n", self._header_callback)
 
-    def write(self, chunk):
+    def write(self, chunk, callback=None):
+        """Writes a chunk of output to the stream.
+
+        If callback is given, it is run once all buffered output has been
+        written to the socket. Callbacks of earlier writes that are still
+        pending run first.
+        """
         assert self._request, "Request closed"
         if not self.stream.closed():
+            if callback is not None:
+                self._write_callbacks.append(stack_context.wrap(callback))
             self.stream.write(chunk, self._on_write_complete)
 
     def finish(self):
@@ -301,23 +379,32 @@ class HTTPConnection(object):
         self._request_finished = True
         if not self.stream.writing():
             self._finish_request()
+        elif (self.stream.write_buffer_size() < _MAX_PIPELINED_OUTPUT and
+              not self._disconnect_after_request()):
+            self._finish_request()
 
     def _on_write_complete(self):
-        if self._request_finished:
+        # The buffer is empty, so every pending write has been sent
+        callbacks, self._write_callbacks = self._write_callbacks, []
+        for callback in callbacks:
+            callback()
+        # The callback may have written more output or finished the request
+        if self._request_finished and not self.stream.writing():
             self._finish_request()
 
-    def _finish_request(self):
+    def _disconnect_after_request(self):
         if self.no_keep_alive:
-            disconnect = True
-        else:
-            connection_header = self._request.headers.get("Connection")
-            if self._request.supports_http_1_1():
-                disconnect = connection_header == "close"
-            elif ("Content-Length" in self._request.headers
-                    or self._request.method in ("HEAD", "GET")):
-                disconnect = connection_header != "Keep-Alive"
-            else:
-                disconnect = True
+            return True
+        connection_header = self._request.headers.get("Connection")
+        if self._request.supports_http_1_1():
+            return connection_header == "close"
+        elif ("Content-Length" in self._request.headers
+                or self._request.method in ("HEAD", "GET")):
+            return connection_header != "Keep-Alive"
+        return True
+
+    def _finish_request(self):
+        disconnect = self._disconnect_after_request()
         self._request = None
         self._request_finished = False
         if disconnect:
@@ -325,6 +412,21 @@ class HTTPConnection(object):
             return
         self.stream.read_until("\r\n\r\n", self._header_callback)
 
+    def _dispatch(self):
+        if self._dispatching:
+            # Read from the buffer by the finish() of the request being run
+            self._dispatch_pending = True
+            return
+        self._dispatching = True
+        try:
+            self.request_callback(self._request)
+            while self._dispatch_pending:
+                self._dispatch_pending = False
+                self.request_callback(self._request)
+        finally:
+            self._dispatching = False
+            self._dispatch_pending = False
+
     def _on_headers(self, data):
         try:
             eol = data.find("\r\n")
@@ -350,7 +452,7 @@ class HTTPConnection(object):
                 self.stream.read_bytes(content_length, self._on_request_body)
                 return
 
-            self.request_callback(self._request)
+            self._dispatch()
         except _BadRequestException, e:
             logging.info("Malformed HTTP request from %s: %s",
                          self.address[0], e)
@@ -377,7 +479,7 @@ class HTTPConnection(object):
                         break
                 else:
                     logging.warning("Invalid multipart/form-data")
-        self.request_callback(self._request)
+        self._dispatch()
 
     def _parse_mime_body(self, boundary, data):
         # The standard allows for the boundary to be quoted in the header,
@@ -485,10 +587,13 @@ class HTTPRequest(object):
         """Returns True if this request supports HTTP/1.1 semantics"""
         return self.version == "HTTP/1.1"
 
-    def write(self, chunk):
-        """Writes the given chunk to the response stream."""
+    def write(self, chunk, callback=None):
+        """Writes the given chunk to the response stream.
+
+        If callback is given, it is run when the chunk has been written.
+        """
         assert isinstance(chunk, str)
-        self.connection.write(chunk)
+        self.connection.write(chunk, callback=callback)
 
     def finish(self):
         """Finishes this HTTP request on the open connection."""
@@ -18,9 +18,13 @@
 
 import bisect
 import errno
+import functools
+import heapq
+import itertools
 import os
 import logging
 import select
+import thread
 import time
 import traceback
 
@@ -94,6 +98,9 @@ class IOLoop(object):
     READ = _EPOLLIN
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP | _EPOLLRDHUP
+    # Added to the events of add_handler for edge-triggered notification;
+    # see supports_edge_triggered()
+    EDGE = _EPOLLET
 
     def __init__(self, impl=None):
         self._impl = impl or _poll()
@@ -102,10 +109,19 @@ class IOLoop(object):
         self._handlers = {}
         self._events = {}
         self._callbacks = []
+        # A heap of (deadline, sequence, _Timeout). Removed timeouts stay
+        # in it with their callback cleared until they reach the top or
+        # the heap is compacted.
         self._timeouts = []
+        self._timeout_sequence = itertools.count()
+        self._cancelled_timeouts = 0
         self._running = False
         self._stopped = False
         self._blocking_signal_threshold = None
+        self._stats = dict(wakeups=0, idle_wakeups=0)
+        self._metrics = None
+        # The thread running start(), if it is running
+        self._thread_ident = None
 
         # Create a pipe that we send bogus data to when we want to wake
         # the I/O loop when it is idle
@@ -151,6 +167,17 @@ class IOLoop(object):
         self._handlers[fd] = stack_context.wrap(handler)
         self._impl.register(fd, events | self.ERROR)
 
+    def supports_edge_triggered(self):
+        """Returns True if handlers may be registered with EDGE.
+
+        An edge-triggered handler is called when its fd becomes readable
+        or writable, rather than for as long as it is, so it must read or
+        write until EAGAIN, and it never needs update_handler to switch
+        between reading and writing. Only epoll supports it.
+        """
+        return hasattr(select, "epoll") and \
+            isinstance(self._impl, select.epoll)
+
     def update_handler(self, fd, events):
         """Changes the events we listen for fd."""
         self._impl.modify(fd, events | self.ERROR)
@@ -209,28 +236,76 @@ class IOLoop(object):
             self._stopped = False
             return
         self._running = True
+        self._thread_ident = thread.get_ident()
+        woke_without_events = False
+        # When the current iteration started, if metrics are recorded
+        busy_start = poll_start = None
         while True:
-            # Never use an infinite timeout here - it can stall epoll
-            poll_timeout = 0.2
+            # Sleep until the next timeout, or for as long as there is
+            # nothing to do: other threads wake the loop up through the
+            # waker pipe and signals interrupt the poll. Never use an
+            # infinite timeout here - it can stall epoll.
+            poll_timeout = _MAX_POLL_TIMEOUT
+            metrics = self._metrics
+            if metrics is not None and busy_start is None:
+                busy_start = time.time()
 
             # Prevent IO event starvation by delaying new callbacks
             # to the next iteration of the event loop.
             callbacks = self._callbacks
             self._callbacks = []
             for callback in callbacks:
-                self._run_callback(callback)
+                if metrics is None:
+                    self._run_callback(callback)
+                else:
+                    start = time.time()
+                    self._run_callback(callback)
+                    metrics.record_handler(callback, time.time() - start)
+            ran = len(callbacks)
 
+            if self._timeouts:
+                now = time.time()
+                while self._timeouts:
+                    deadline, sequence, timeout = self._timeouts[0]
+                    if timeout.callback is None:
+                        heapq.heappop(self._timeouts)
+                        self._cancelled_timeouts -= 1
+                    elif deadline <= now:
+                        heapq.heappop(self._timeouts)
+                        callback = timeout.callback
+                        timeout.callback = None
+                        if metrics is None:
+                            self._run_callback(callback)
+                        else:
+                            start = time.time()
+                            metrics.record_timer_lag(start - deadline)
+                            self._run_callback(callback)
+                            metrics.record_handler(callback,
+                                                   time.time() - start)
+                        ran += 1
+                    else:
+                        # epoll rounds its timeout down to whole
+                        # milliseconds; waking before the deadline would
+                        # spin until it is reached
+                        seconds = deadline - now + _TIMEOUT_ROUNDING
+                        poll_timeout = min(seconds, poll_timeout)
+                        break
+
+            # Callbacks added since (even from this thread, which doesn't
+            # wake the loop) run right after the poll
             if self._callbacks:
                 poll_timeout = 0.0
 
-            if self._timeouts:
-                now = time.time()
-                while self._timeouts and self._timeouts[0].deadline <= now:
-                    timeout = self._timeouts.pop(0)
-                    self._run_callback(timeout.callback)
-                if self._timeouts:
-                    milliseconds = self._timeouts[0].deadline - now
-                    poll_timeout = min(milliseconds, poll_timeout)
+            if woke_without_events and not ran:
+                self._stats["idle_wakeups"] += 1
+            woke_without_events = False
+
+            if metrics is not None:
+                poll_start = time.time()
+                metrics.record_iteration(
+                    poll_start - busy_start, len(callbacks),
+                    len(self._timeouts) - self._cancelled_timeouts)
+                busy_start = None
 
             if not self._running:
                 break
@@ -254,6 +329,13 @@ class IOLoop(object):
                     continue
                 else:
                     raise
+            self._stats["wakeups"] += 1
+            woke_without_events = not event_pairs
+            if metrics is not None:
+                busy_start = time.time()
+                metrics.record_poll(busy_start - poll_start)
+            else:
+                busy_start = None
 
             if self._blocking_signal_threshold is not None:
                 signal.setitimer(signal.ITIMER_REAL,
@@ -267,7 +349,16 @@ class IOLoop(object):
             while self._events:
                 fd, events = self._events.popitem()
                 try:
-                    self._handlers[fd](fd, events)
+                    handler = self._handlers[fd]
+                    if metrics is None:
+                        handler(fd, events)
+                    else:
+                        start = time.time()
+                        try:
+                            handler(fd, events)
+                        finally:
+                            metrics.record_handler(handler,
+                                                   time.time() - start)
                 except (KeyboardInterrupt, SystemExit):
                     raise
                 except (OSError, IOError), e:
@@ -282,6 +373,7 @@ class IOLoop(object):
                                   fd, exc_info=True)
         # reset the stopped flag so another start/stop pair can be issued
         self._stopped = False
+        self._thread_ident = None
         if self._blocking_signal_threshold is not None:
             signal.setitimer(signal.ITIMER_REAL, 0, 0)
 
@@ -306,21 +398,55 @@ class IOLoop(object):
         """Returns true if this IOLoop is currently running."""
         return self._running
 
+    def set_metrics(self, metrics):
+        """Records the loop's timings in an IOLoopMetrics object.
+
+        Pass None to stop recording. Without metrics the loop does not
+        time anything.
+        """
+        self._metrics = metrics
+
+    def stats(self):
+        """Returns a dict of counters of the loop's activity.
+
+        wakeups counts the returns from poll, and idle_wakeups those that
+        found no I/O event, callback or expired timeout to run. An idle
+        loop sleeps until its next timeout, so idle_wakeups should stay
+        near zero.
+        """
+        return dict(self._stats)
+
     def add_timeout(self, deadline, callback):
         """Calls the given callback at the time deadline from the I/O loop.
 
         Returns a handle that may be passed to remove_timeout to cancel.
         """
         timeout = _Timeout(deadline, stack_context.wrap(callback))
-        bisect.insort(self._timeouts, timeout)
+        heapq.heappush(self._timeouts,
+                       (deadline, self._timeout_sequence.next(), timeout))
         return timeout
 
     def remove_timeout(self, timeout):
         """Cancels a pending timeout.
 
-        The argument is a handle as returned by add_timeout.
+        The argument is a handle as returned by add_timeout. Removing a
+        timeout that has already run or been removed does nothing.
+
+        The timeout is only marked as cancelled and is dropped when it
+        reaches the front of the queue, so this takes constant time.
+        When more than half the queue is cancelled timeouts, the queue is
+        rebuilt without them.
         """
-        self._timeouts.remove(timeout)
+        if timeout.callback is None:
+            return
+        timeout.callback = None
+        self._cancelled_timeouts += 1
+        if (self._cancelled_timeouts > _MIN_TIMEOUT_COMPACTION and
+            self._cancelled_timeouts * 2 > len(self._timeouts)):
+            self._timeouts = [entry for entry in self._timeouts
+                              if entry[2].callback is not None]
+            heapq.heapify(self._timeouts)
+            self._cancelled_timeouts = 0
 
     def add_callback(self, callback):
         """Calls the given callback on the next I/O loop iteration.
@@ -332,6 +458,18 @@ class IOLoop(object):
         control from other threads to the IOLoop's thread.
         """
         self._callbacks.append(stack_context.wrap(callback))
+        # The loop's own thread runs new callbacks before it polls again
+        if thread.get_ident() != self._thread_ident:
+            self._wake()
+
+    def add_callback_from_signal(self, callback):
+        """Calls the given callback on the next I/O loop iteration.
+
+        Safe to call from a signal handler. The handler runs in the loop's
+        own thread, but possibly just before it goes to sleep in poll, so
+        unlike add_callback this always wakes the loop.
+        """
+        self._callbacks.append(stack_context.wrap(callback))
         self._wake()
 
     def _wake(self):
@@ -377,8 +515,21 @@ class IOLoop(object):
         fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
 
+# Cancelled timeouts are left in the queue until there are this many
+_MIN_TIMEOUT_COMPACTION = 512
+
+# Longest time the loop sleeps in poll when it has no timeouts
+_MAX_POLL_TIMEOUT = 3600.0
+
+# Added to poll timeouts so that the loop wakes up after the deadline
+_TIMEOUT_ROUNDING = 0.001
+
+
 class _Timeout(object):
-    """An IOLoop timeout, a UNIX timestamp and a callback"""
+    """An IOLoop timeout, a UNIX timestamp and a callback.
+
+    The callback is set to None once the timeout has run or been removed.
+    """
 
     # Reduce memory overhead when there are lots of pending callbacks
     __slots__ = ['deadline', 'callback']
@@ -387,10 +538,6 @@ class _Timeout(object):
         self.deadline = deadline
         self.callback = callback
 
-    def __lt__(self, other):
-        return ((self.deadline, id(self.callback)) <
-                (other.deadline, id(other.callback)))
-
 
 class PeriodicCallback(object):
     """Schedules the given callback to be called periodically.
@@ -423,6 +570,129 @@ class PeriodicCallback(object):
             self.start()
 
 
+class IOLoopMetrics(object):
+    """Timings of an IOLoop's iterations and handlers, for debugging.
+
+        metrics = ioloop.IOLoopMetrics()
+        ioloop.IOLoop.instance().set_metrics(metrics)
+        ...
+        logging.info("IOLoop: %r", metrics.snapshot())
+
+    The loop reports the time each iteration spent running handlers
+    (busy) and waiting in poll, the number of callbacks queued for the
+    iteration, the timeouts pending, how late each timeout ran (timer lag)
+    and the duration of every I/O handler, callback and timeout. A loop
+    that is busy most of the time, with growing timer lag, is CPU-bound;
+    one that mostly waits in poll is waiting on I/O.
+
+    The slowest handlers are kept, with a description of the function
+    called, so that the code blocking the loop can be found.
+    """
+    # Upper bounds in seconds of the histogram buckets; a last bucket
+    # counts longer times
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.reset()
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        self.started = time.time()
+        self.iterations = 0
+        self.busy_time = 0.0
+        self.poll_time = 0.0
+        self.iteration_histogram = [0] * (len(self.BUCKETS) + 1)
+        self.callbacks_run = 0
+        self.max_callbacks_queued = 0
+        self.pending_timeouts = 0
+        self.timeouts_run = 0
+        self.total_timer_lag = 0.0
+        self.max_timer_lag = 0.0
+        self.timer_lag_histogram = [0] * (len(self.BUCKETS) + 1)
+        self.handlers_run = 0
+        self._slowest = []  # heap of (seconds, sequence, handler, time)
+        self._sequence = itertools.count()
+
+    def record_iteration(self, busy, callbacks, timeouts):
+        """Called before each poll with the seconds spent since the last
+        one, the callbacks run and the timeouts pending."""
+        self.iterations += 1
+        self.busy_time += busy
+        self.iteration_histogram[bisect.bisect_left(self.BUCKETS, busy)] += 1
+        self.callbacks_run += callbacks
+        self.max_callbacks_queued = max(self.max_callbacks_queued, callbacks)
+        self.pending_timeouts = timeouts
+
+    def record_poll(self, seconds):
+        self.poll_time += seconds
+
+    def record_timer_lag(self, lag):
+        """Called with how many seconds after its deadline a timeout runs."""
+        lag = max(lag, 0.0)
+        self.timeouts_run += 1
+        self.total_timer_lag += lag
+        self.max_timer_lag = max(self.max_timer_lag, lag)
+        self.timer_lag_histogram[bisect.bisect_left(self.BUCKETS, lag)] += 1
+
+    def record_handler(self, handler, seconds):
+        """Called with the duration of each handler, callback and timeout."""
+        self.handlers_run += 1
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, (seconds, self._sequence.next(),
+                                           _describe(handler), time.time()))
+        elif self._slowest and seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, self._sequence.next(),
+                                              _describe(handler), time.time()))
+
+    def snapshot(self):
+        """Returns what has been recorded as a JSON-serializable dict."""
+        elapsed = self.busy_time + self.poll_time
+        def histogram(counts):
+            bounds = list(self.BUCKETS) + [None]
+            return [[bound, count] for bound, count in zip(bounds, counts)]
+        return {
+            "seconds": time.time() - self.started,
+            "iterations": self.iterations,
+            "busy_time": self.busy_time,
+            "poll_time": self.poll_time,
+            "utilization": elapsed and self.busy_time / elapsed or 0.0,
+            "iteration_histogram": histogram(self.iteration_histogram),
+            "callbacks_run": self.callbacks_run,
+            "mean_callbacks_queued": (self.iterations and
+                float(self.callbacks_run) / self.iterations or 0.0),
+            "max_callbacks_queued": self.max_callbacks_queued,
+            "pending_timeouts": self.pending_timeouts,
+            "timeouts_run": self.timeouts_run,
+            "mean_timer_lag": (self.timeouts_run and
+                self.total_timer_lag / self.timeouts_run or 0.0),
+            "max_timer_lag": self.max_timer_lag,
+            "timer_lag_histogram": histogram(self.timer_lag_histogram),
+            "handlers_run": self.handlers_run,
+            "slowest_handlers": [
+                dict(handler=handler, seconds=seconds, time=when)
+                for seconds, sequence, handler, when
+                in sorted(self._slowest, reverse=True)],
+        }
+
+
+def _describe(handler):
+    """Returns a readable name for a handler wrapped by stack_context."""
+    while isinstance(handler, functools.partial):
+        if getattr(handler, "stack_context_wrapped", False):
+            handler = handler.args[0]
+        else:
+            handler = handler.func
+    instance = getattr(handler, "im_self", None)
+    name = getattr(handler, "__name__", None)
+    if instance is not None and name:
+        return "%s.%s.%s" % (instance.__class__.__module__,
+                             instance.__class__.__name__, name)
+    if name:
+        return "%s.%s" % (getattr(handler, "__module__", "?"), name)
+    return repr(handler)
+
+
 class _EPoll(object):
     """An epoll-based event loop using our C module for Python 2.5 systems"""
     _EPOLL_CTL_ADD = 1
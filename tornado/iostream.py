@@ -20,9 +20,9 @@ from __future__ import with_statement
 
 import collections
 import errno
+import itertools
 import logging
 import socket
-import sys
 
 from tornado import ioloop
 from tornado import stack_context
@@ -75,24 +75,43 @@ class IOStream(object):
         stream.connect(("friendfeed.com", 80), send_request)
         ioloop.IOLoop.instance().start()
 
+    If edge_triggered is True and the IOLoop supports it (see
+    IOLoop.supports_edge_triggered), the socket is registered for reads
+    and writes once, the first time it is read from, written to or
+    connected, rather than its events being switched with update_handler
+    as the stream alternates between reading and writing. Reads always
+    drain the socket until EWOULDBLOCK, and writes are sent from a
+    callback at the end of the IOLoop iteration they were made in.
     """
     def __init__(self, socket, io_loop=None, max_buffer_size=104857600,
-                 read_chunk_size=4096):
+                 read_chunk_size=4096, edge_triggered=False):
         self.socket = socket
         self.socket.setblocking(False)
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         self.max_buffer_size = max_buffer_size
         self.read_chunk_size = read_chunk_size
         self._read_buffer = collections.deque()
+        self._read_buffer_size = 0
         self._write_buffer = collections.deque()
+        self._write_buffer_size = 0
+        self._write_buffer_pos = 0
         self._write_buffer_frozen = False
+        self._pending_write = None
         self._read_delimiter = None
         self._read_bytes = None
+        self._reset_delimiter_scan()
         self._read_callback = None
         self._write_callback = None
         self._close_callback = None
         self._connect_callback = None
         self._connecting = False
+        self._edge_triggered = (edge_triggered and
+                                self.io_loop.supports_edge_triggered())
+        self._write_scheduled = False
+        if self._edge_triggered:
+            # Registered by the first _add_io_state
+            self._state = 0
+            return
         self._state = self.io_loop.ERROR
         with stack_context.NullContext():
             self.io_loop.add_handler(
@@ -127,6 +146,7 @@ class IOStream(object):
         """Call callback when we read the given delimiter."""
         assert not self._read_callback, "Already reading"
         self._read_delimiter = delimiter
+        self._reset_delimiter_scan()
         self._read_callback = stack_context.wrap(callback)
         while True:
             # See if we've already got the data from a previous read
@@ -163,8 +183,17 @@ class IOStream(object):
         """
         self._check_closed()
         self._write_buffer.append(data)
+        self._write_buffer_size += len(data)
         self._add_io_state(self.io_loop.WRITE)
         self._write_callback = stack_context.wrap(callback)
+        if self._edge_triggered and not self._write_scheduled and \
+           not self._connecting:
+            # The socket is probably writable already, so there may be no
+            # edge to wait for. While connecting, the connection's edge
+            # sends the buffer.
+            self._write_scheduled = True
+            with stack_context.NullContext():
+                self.io_loop.add_callback(self._handle_scheduled_write)
 
     def set_close_callback(self, callback):
         """Call the given callback when the stream is closed."""
@@ -173,7 +202,8 @@ class IOStream(object):
     def close(self):
         """Close this stream."""
         if self.socket is not None:
-            self.io_loop.remove_handler(self.socket.fileno())
+            if self._state:
+                self.io_loop.remove_handler(self.socket.fileno())
             self.socket.close()
             self.socket = None
             if self._close_callback:
@@ -187,6 +217,10 @@ class IOStream(object):
         """Returns true if we are currently writing to the stream."""
         return bool(self._write_buffer)
 
+    def write_buffer_size(self):
+        """Returns the number of bytes written but not yet sent."""
+        return self._write_buffer_size
+
     def closed(self):
         return self.socket is None
 
@@ -196,7 +230,10 @@ class IOStream(object):
             return
         try:
             if events & self.io_loop.READ:
-                self._handle_read()
+                # Edge-triggered streams are told about data they aren't
+                # reading yet; the next read takes it from the socket.
+                if self.reading() or not self._edge_triggered:
+                    self._handle_read()
             if not self.socket:
                 return
             if events & self.io_loop.WRITE:
@@ -208,6 +245,8 @@ class IOStream(object):
             if events & self.io_loop.ERROR:
                 self.close()
                 return
+            if self._edge_triggered:
+                return
             state = self.io_loop.ERROR
             if self.reading():
                 state |= self.io_loop.READ
@@ -222,6 +261,18 @@ class IOStream(object):
             self.close()
             raise
 
+    def _handle_scheduled_write(self):
+        self._write_scheduled = False
+        if not self.socket or self._connecting:
+            return
+        try:
+            self._handle_write()
+        except:
+            logging.error("Uncaught exception, closing connection.",
+                          exc_info=True)
+            self.close()
+            raise
+
     def _run_callback(self, callback, *args, **kwargs):
         try:
             # Use a NullContext to ensure that all StackContexts are run
@@ -294,7 +345,8 @@ class IOStream(object):
         if chunk is None:
             return 0
         self._read_buffer.append(chunk)
-        if self._read_buffer_size() >= self.max_buffer_size:
+        self._read_buffer_size += len(chunk)
+        if self._read_buffer_size >= self.max_buffer_size:
             logging.error("Reached maximum read buffer size")
             self.close()
             raise IOError("Reached maximum read buffer size")
@@ -306,7 +358,7 @@ class IOStream(object):
         Returns True if the read was completed.
         """
         if self._read_bytes:
-            if self._read_buffer_size() >= self._read_bytes:
+            if self._read_buffer_size >= self._read_bytes:
                 num_bytes = self._read_bytes
                 callback = self._read_callback
                 self._read_callback = None
@@ -314,18 +366,49 @@ class IOStream(object):
                 self._run_callback(callback, self._consume(num_bytes))
                 return True
         elif self._read_delimiter:
-            _merge_prefix(self._read_buffer, sys.maxint)
-            loc = self._read_buffer[0].find(self._read_delimiter)
-            if loc != -1:
+            end = self._find_read_delimiter()
+            if end != -1:
                 callback = self._read_callback
-                delimiter_len = len(self._read_delimiter)
                 self._read_callback = None
                 self._read_delimiter = None
-                self._run_callback(callback,
-                                   self._consume(loc + delimiter_len))
+                self._run_callback(callback, self._consume(end))
                 return True
         return False
 
+    def _find_read_delimiter(self):
+        """Looks for the read delimiter in the read buffer.
+
+        Returns the offset just past the end of the delimiter, or -1.
+        Chunks searched by an earlier call are not searched again (except
+        for their last len(delimiter) - 1 bytes, in case the delimiter
+        spans two chunks) and the buffer is never merged, so a delimiter
+        that arrives in many small reads costs time linear in its offset.
+        """
+        delimiter = self._read_delimiter
+        overlap = len(delimiter) - 1
+        # New chunks are only ever appended, so take the unscanned ones
+        # from the right rather than skipping over the scanned ones.
+        unscanned = list(itertools.islice(
+            reversed(self._read_buffer),
+            len(self._read_buffer) - self._scanned_chunks))
+        unscanned.reverse()
+        for chunk in unscanned:
+            tail = self._scanned_tail
+            window = tail + chunk
+            loc = window.find(delimiter)
+            if loc != -1:
+                return self._scanned_bytes - len(tail) + loc + len(delimiter)
+            self._scanned_chunks += 1
+            self._scanned_bytes += len(chunk)
+            if overlap:
+                self._scanned_tail = window[-overlap:]
+        return -1
+
+    def _reset_delimiter_scan(self):
+        self._scanned_chunks = 0
+        self._scanned_bytes = 0
+        self._scanned_tail = ""
+
     def _handle_connect(self):
         if self._connect_callback is not None:
             callback = self._connect_callback
@@ -337,22 +420,18 @@ class IOStream(object):
         while self._write_buffer:
             try:
                 if not self._write_buffer_frozen:
-                    # On windows, socket.send blows up if given a
-                    # write buffer that's too large, instead of just
-                    # returning the number of bytes it was able to
-                    # process.  Therefore we must not call socket.send
-                    # with more than 128KB at a time.
-                    _merge_prefix(self._write_buffer, 128 * 1024)
-                num_bytes = self.socket.send(self._write_buffer[0])
+                    self._pending_write = self._next_write()
+                num_bytes = self.socket.send(self._pending_write)
                 self._write_buffer_frozen = False
-                _merge_prefix(self._write_buffer, num_bytes)
-                self._write_buffer.popleft()
+                self._pending_write = None
+                self._advance_write(num_bytes)
             except socket.error, e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     # With OpenSSL, after send returns EWOULDBLOCK,
                     # the very same string object must be used on the
-                    # next call to send.  Therefore we suppress
-                    # merging the write buffer after an EWOULDBLOCK.
+                    # next call to send.  Therefore we keep the pending
+                    # object and suppress merging the write buffer
+                    # after an EWOULDBLOCK.
                     # A cleaner solution would be to set
                     # SSL_MODE_ACCEPT_MOVING_WRITE_BUFFER, but this is
                     # not yet accessible from python
@@ -369,8 +448,47 @@ class IOStream(object):
             self._write_callback = None
             self._run_callback(callback)
 
+    def _next_write(self):
+        """Returns the data for the next socket.send call.
+
+        Large chunks are sent in place: a partially sent chunk is passed
+        to send as a buffer object starting at the unsent offset, so it is
+        never copied.  Runs of small chunks (such as separate writes of
+        headers and short bodies) are merged first so that they go out in
+        one send call rather than one each.
+        """
+        if self._write_buffer_pos == 0 and len(self._write_buffer) > 1:
+            size = 0
+            count = 0
+            for chunk in self._write_buffer:
+                if len(chunk) >= _WRITE_COALESCE_SIZE or \
+                   size + len(chunk) > _WRITE_CHUNK_SIZE:
+                    break
+                size += len(chunk)
+                count += 1
+            if count > 1:
+                _merge_prefix(self._write_buffer, size)
+        chunk = self._write_buffer[0]
+        pos = self._write_buffer_pos
+        if pos == 0 and len(chunk) <= _WRITE_CHUNK_SIZE:
+            return chunk
+        # On windows, socket.send blows up if given a write buffer
+        # that's too large, instead of just returning the number of
+        # bytes it was able to process.  Therefore we must not call
+        # socket.send with more than 128KB at a time.
+        return buffer(chunk, pos, _WRITE_CHUNK_SIZE)
+
+    def _advance_write(self, num_bytes):
+        self._write_buffer_size -= num_bytes
+        self._write_buffer_pos += num_bytes
+        if self._write_buffer_pos >= len(self._write_buffer[0]):
+            self._write_buffer.popleft()
+            self._write_buffer_pos = 0
+
     def _consume(self, loc):
         _merge_prefix(self._read_buffer, loc)
+        self._read_buffer_size -= loc
+        self._reset_delimiter_scan()
         return self._read_buffer.popleft()
 
     def _check_closed(self):
@@ -381,13 +499,19 @@ class IOStream(object):
         if self.socket is None:
             # connection has been closed, so there can be no future events
             return
+        if self._edge_triggered:
+            if not self._state:
+                self._state = (self.io_loop.READ | self.io_loop.WRITE |
+                               self.io_loop.ERROR | self.io_loop.EDGE)
+                with stack_context.NullContext():
+                    self.io_loop.add_handler(
+                        self.socket.fileno(), self._handle_events,
+                        self._state)
+            return
         if not self._state & state:
             self._state = self._state | state
             self.io_loop.update_handler(self.socket.fileno(), self._state)
 
-    def _read_buffer_size(self):
-        return sum(len(chunk) for chunk in self._read_buffer)
-
 
 class SSLIOStream(IOStream):
     """A utility class to write to and read from a non-blocking socket.
@@ -405,6 +529,8 @@ class SSLIOStream(IOStream):
         it will be used as additional keyword arguments to ssl.wrap_socket.
         """
         self._ssl_options = kwargs.pop('ssl_options', {})
+        # The SSL object buffers data that epoll can't see
+        kwargs['edge_triggered'] = False
         super(SSLIOStream, self).__init__(*args, **kwargs)
         self._ssl_accepting = True
         self._handshake_reading = False
@@ -490,6 +616,12 @@ class SSLIOStream(IOStream):
             return None
         return chunk
 
+# Largest amount of data passed to one socket.send call
+_WRITE_CHUNK_SIZE = 128 * 1024
+
+# Writes shorter than this are merged with their neighbours before sending
+_WRITE_COALESCE_SIZE = 4096
+
 def _merge_prefix(deque, size):
     """Replace the first entries in a deque of strings with a single
     string of up to size bytes.
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Facebook
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A supervised pool of HTTPServer worker processes.
+
+HTTPServer.start(n) forks n children that share one listening socket and
+then waits for the first of them to exit. Supervisor is meant for running
+a server in production instead:
+
+    server = httpserver.HTTPServer(application)
+    supervisor = process.Supervisor(server, 8888)
+    supervisor.start()  # Only returns in the workers
+    ioloop.IOLoop.instance().start()
+
+Each worker binds its own socket with SO_REUSEPORT, so the kernel spreads
+new connections evenly over the workers instead of waking all of them for
+every connection. Where SO_REUSEPORT is not available, the parent binds a
+single socket that the workers share, as HTTPServer.start() does.
+
+The parent process never serves requests. It restarts workers that die
+and reacts to these signals:
+
+    SIGHUP           rolling restart: each worker in turn is replaced by a
+                     new process, which starts accepting connections before
+                     the old one stops, so no connections are refused
+    SIGTERM, SIGINT  stops all workers gracefully and exits
+    SIGUSR1          logs the number of requests served by each worker
+
+A worker that receives SIGTERM stops accepting connections and lets its
+requests in progress finish, for at most shutdown_timeout seconds, then
+stops its IOLoop, so IOLoop.start() returns in the worker.
+
+Request counts are kept in memory shared by all the processes, so
+request_counts() can also be called in a worker, e.g. by a status page.
+"""
+
+import errno
+import logging
+import mmap
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+from tornado import httpserver
+from tornado import ioloop
+
+# Per-worker slot in shared memory: pid, number of requests
+_SLOT = struct.Struct("LL")
+
+
+class _WorkerStarted(Exception):
+    """Unwinds the parent's supervision loop in a newly forked worker."""
+    pass
+
+
+class Supervisor(object):
+    """Runs an HTTPServer in a supervised pool of worker processes.
+
+    num_processes defaults to the number of CPUs. A worker that exits
+    within min_uptime seconds of being started is restarted after a delay
+    of restart_delay seconds, so a worker that fails on startup does not
+    make the parent fork in a tight loop.
+    """
+    def __init__(self, server, port, address="", num_processes=None,
+                 shutdown_timeout=10.0, min_uptime=1.0, restart_delay=1.0):
+        self.server = server
+        self.port = port
+        self.address = address
+        if num_processes is None or num_processes <= 0:
+            num_processes = httpserver._cpu_count()
+        self.num_processes = num_processes
+        self.shutdown_timeout = shutdown_timeout
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        self.reuse_port = None
+        # One spare slot for the extra worker during rolling restarts
+        self._num_slots = num_processes + 1
+        self._counts = mmap.mmap(-1, _SLOT.size * self._num_slots)
+        self._slot = None
+        self._workers = {}  # pid -> (slot, start time)
+        self._retired = set()
+        self._stopping = False
+        self._restart_requested = False
+        self._report_requested = False
+        self._started = False
+
+    def start(self):
+        """Starts the workers.
+
+        In each worker, this method starts the server in the worker's
+        IOLoop and returns. In the parent, it supervises the workers until
+        it is told to stop, then exits the process.
+        """
+        assert not self._started
+        self._started = True
+        if ioloop.IOLoop.initialized():
+            raise RuntimeError("IOLoop.instance() must not be used before "
+                               "the workers have been forked")
+        self.reuse_port = self._check_reuse_port()
+        if not self.reuse_port:
+            logging.warning("SO_REUSEPORT is not supported; workers will "
+                            "share one listening socket")
+            self.server.bind(self.port, self.address)
+        logging.info("Starting %d worker processes", self.num_processes)
+        for i in range(self.num_processes):
+            if self._spawn(i):
+                return
+        try:
+            self._supervise()
+        except _WorkerStarted:
+            # A restarted worker returns from start() like the others
+            return
+
+    def request_counts(self):
+        """Returns a dict mapping each worker's pid to its request count."""
+        counts = {}
+        for slot in range(self._num_slots):
+            pid, count = _SLOT.unpack_from(self._counts, slot * _SLOT.size)
+            if pid:
+                counts[pid] = count
+        return counts
+
+    def _check_reuse_port(self):
+        if httpserver._SO_REUSEPORT is None:
+            return False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        try:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET,
+                                httpserver._SO_REUSEPORT, 1)
+            except socket.error:
+                return False
+        finally:
+            sock.close()
+        return True
+
+    def _spawn(self, slot):
+        """Forks a worker. Returns True in the worker and False in the
+        parent, once the worker is accepting connections."""
+        _SLOT.pack_into(self._counts, slot * _SLOT.size, 0, 0)
+        ready_fd, ready_writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_fd)
+            try:
+                self._start_worker(slot)
+            except Exception:
+                logging.error("Worker failed to start", exc_info=True)
+                os._exit(1)
+            os.write(ready_writer, "x")
+            os.close(ready_writer)
+            return True
+        os.close(ready_writer)
+        self._workers[pid] = (slot, time.time())
+        # Wait until the worker listens, so that rolling restarts never
+        # leave the port without a listener.
+        deadline = time.time() + self.shutdown_timeout
+        try:
+            while time.time() < deadline:
+                try:
+                    readable = select.select([ready_fd], [], [],
+                                             deadline - time.time())[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    os.read(ready_fd, 1)
+                break
+        finally:
+            os.close(ready_fd)
+        return False
+
+    def _start_worker(self, slot):
+        import random
+        from binascii import hexlify
+        random.seed(long(hexlify(os.urandom(16)), 16))
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM,
+                       signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_DFL)
+        self._slot = slot
+        self._workers = {}
+        _SLOT.pack_into(self._counts, slot * _SLOT.size, os.getpid(), 0)
+        request_callback = self.server.request_callback
+        def counting_callback(request):
+            self._count_request()
+            request_callback(request)
+        self.server.request_callback = counting_callback
+        if self.reuse_port:
+            self.server.bind(self.port, self.address, reuse_port=True)
+        self.server.start(1)
+        signal.signal(signal.SIGTERM, self._on_worker_sigterm)
+
+    def _count_request(self):
+        offset = self._slot * _SLOT.size
+        pid, count = _SLOT.unpack_from(self._counts, offset)
+        _SLOT.pack_into(self._counts, offset, pid, count + 1)
+
+    def _on_worker_sigterm(self, signum, frame):
+        self.server.io_loop.add_callback_from_signal(self._drain)
+
+    def _drain(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        server = self.server
+        io_loop = server.io_loop
+        # With SO_REUSEPORT, connections still in this socket's accept
+        # queue are reset when it is closed, so accept them first.
+        server._handle_events(server._socket.fileno(), io_loop.READ)
+        server.stop()
+        deadline = time.time() + self.shutdown_timeout
+        def check():
+            if server.requests_in_progress() and time.time() < deadline:
+                io_loop.add_timeout(time.time() + 0.1, check)
+            else:
+                io_loop.stop()
+        check()
+
+    def _supervise(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_stop_signal)
+        signal.signal(signal.SIGHUP, self._on_restart_signal)
+        signal.signal(signal.SIGUSR1, self._on_report_signal)
+        while self._workers:
+            if self._report_requested:
+                self._report_requested = False
+                self._log_request_counts()
+            if self._restart_requested and not self._stopping:
+                self._restart_requested = False
+                self._rolling_restart()
+                continue
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self._on_worker_exit(pid, status)
+        logging.info("All workers have stopped")
+        sys.exit(0)
+
+    def _on_stop_signal(self, signum, frame):
+        if not self._stopping:
+            self._stopping = True
+            logging.info("Stopping %d workers", len(self._workers))
+            self._signal_workers(signal.SIGTERM)
+
+    def _on_restart_signal(self, signum, frame):
+        self._restart_requested = True
+
+    def _on_report_signal(self, signum, frame):
+        self._report_requested = True
+
+    def _signal_workers(self, signum):
+        for pid in self._workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _on_worker_exit(self, pid, status):
+        if pid not in self._workers:
+            return
+        slot, started = self._workers.pop(pid)
+        _SLOT.pack_into(self._counts, slot * _SLOT.size, 0, 0)
+        if pid in self._retired:
+            self._retired.discard(pid)
+            return
+        if self._stopping:
+            return
+        if os.WIFSIGNALED(status):
+            logging.warning("Worker %d killed by signal %d", pid,
+                            os.WTERMSIG(status))
+        else:
+            logging.warning("Worker %d exited with status %d", pid,
+                            os.WEXITSTATUS(status))
+        if time.time() - started < self.min_uptime:
+            time.sleep(self.restart_delay)
+            if self._stopping:
+                return
+        if self._spawn(slot):
+            raise _WorkerStarted()
+
+    def _rolling_restart(self):
+        logging.info("Restarting %d workers", len(self._workers))
+        for pid in self._workers.keys():
+            if self._stopping:
+                return
+            if pid not in self._workers:
+                continue
+            slot = self._free_slot()
+            if self._spawn(slot):
+                raise _WorkerStarted()
+            self._retired.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            self._wait_for(pid)
+
+    def _wait_for(self, pid):
+        while pid in self._workers:
+            try:
+                exited, status = os.waitpid(pid, 0)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.ECHILD:
+                    self._workers.pop(pid, None)
+                    self._retired.discard(pid)
+                    return
+                raise
+            self._on_worker_exit(exited, status)
+
+    def _free_slot(self):
+        used = set(slot for slot, started in self._workers.values())
+        for slot in range(self._num_slots):
+            if slot not in used:
+                return slot
+        raise RuntimeError("No free worker slot")
+
+    def _log_request_counts(self):
+        counts = self.request_counts()
+        for pid in sorted(counts):
+            logging.info("Worker %d: %d requests", pid, counts[pid])
+        logging.info("Total: %d requests", sum(counts.values()))
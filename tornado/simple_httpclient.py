@@ -255,7 +255,10 @@ class _HTTPConnection(object):
             # Magic parameter makes zlib module understand gzip header
             # http://stackoverflow.com/questions/1838699/how-can-i-decompress-a-gzip-stream-with-zlib
             self._decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
-        if self.headers.get("Transfer-Encoding") == "chunked":
+        if self.request.method == "HEAD" or self.code in (204, 304):
+            # These responses never have a body, whatever their headers say
+            self._on_body("")
+        elif self.headers.get("Transfer-Encoding") == "chunked":
             self.chunks = []
             self.stream.read_until("\r\n", self._on_chunk_length)
         elif "Content-Length" in self.headers:
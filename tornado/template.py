@@ -86,6 +86,7 @@ import datetime
 import logging
 import os.path
 import re
+import types
 
 from tornado import escape
 
@@ -94,9 +95,14 @@ class Template(object):
 
     We compile into Python from the given template_string. You can generate
     the template from variables with generate().
+
+    If compiled_render is True, the generated module is executed only once
+    and the resulting _execute function is kept around. Each call to
+    generate() then just binds the given arguments as the globals of that
+    function instead of re-executing the module code for every render.
     """
     def __init__(self, template_string, name="<string>", loader=None,
-                 compress_whitespace=None):
+                 compress_whitespace=None, compiled_render=False):
         self.name = name
         if compress_whitespace is None:
             compress_whitespace = name.endswith(".html") or \
@@ -110,21 +116,19 @@ class Template(object):
             formatted_code = _format_code(self.code).rstrip()
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
+        self.compiled_render = compiled_render
+        self._execute_code = None
+        self._base_namespace = None
 
     def generate(self, **kwargs):
         """Generate this template with the given arguments."""
-        namespace = {
-            "escape": escape.xhtml_escape,
-            "xhtml_escape": escape.xhtml_escape,
-            "url_escape": escape.url_escape,
-            "json_encode": escape.json_encode,
-            "squeeze": escape.squeeze,
-            "linkify": escape.linkify,
-            "datetime": datetime,
-        }
-        namespace.update(kwargs)
-        exec self.compiled in namespace
-        execute = namespace["_execute"]
+        if self.compiled_render:
+            execute = self._bind(kwargs)
+        else:
+            namespace = _default_namespace()
+            namespace.update(kwargs)
+            exec self.compiled in namespace
+            execute = namespace["_execute"]
         try:
             return execute()
         except:
@@ -132,6 +136,22 @@ class Template(object):
             logging.error("%s code:\n%s", self.name, formatted_code)
             raise
 
+    def _bind(self, kwargs):
+        """Returns the compiled _execute function bound to the given args.
+
+        The module code is only executed the first time this is called;
+        afterwards we build a fresh globals dict from the cached defaults
+        and attach it to the cached code object.
+        """
+        if self._execute_code is None:
+            namespace = _default_namespace()
+            exec self.compiled in namespace
+            self._execute_code = namespace.pop("_execute").func_code
+            self._base_namespace = namespace
+        namespace = self._base_namespace.copy()
+        namespace.update(kwargs)
+        return types.FunctionType(self._execute_code, namespace, "_execute")
+
     def _generate_python(self, loader, compress_whitespace):
         buffer = cStringIO.StringIO()
         try:
@@ -166,9 +186,13 @@ class Loader(object):
     You must use a template loader to use template constructs like
     {% extends %} and {% include %}. Loader caches all templates after
     they are loaded the first time.
+
+    If compiled_render is True, every template loaded by this loader is
+    created in compiled-render mode (see Template).
     """
-    def __init__(self, root_directory):
+    def __init__(self, root_directory, compiled_render=False):
         self.root = os.path.abspath(root_directory)
+        self.compiled_render = compiled_render
         self.templates = {}
 
     def reset(self):
@@ -190,11 +214,25 @@ class Loader(object):
         if name not in self.templates:
             path = os.path.join(self.root, name)
             f = open(path, "r")
-            self.templates[name] = Template(f.read(), name=name, loader=self)
+            self.templates[name] = Template(
+                f.read(), name=name, loader=self,
+                compiled_render=self.compiled_render)
             f.close()
         return self.templates[name]
 
 
+def _default_namespace():
+    return {
+        "escape": escape.xhtml_escape,
+        "xhtml_escape": escape.xhtml_escape,
+        "url_escape": escape.url_escape,
+        "json_encode": escape.json_encode,
+        "squeeze": escape.squeeze,
+        "linkify": escape.linkify,
+        "datetime": datetime,
+    }
+
+
 class _Node(object):
     def each_child(self):
         return ()
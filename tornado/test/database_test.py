@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tornado import database
+from tornado.escape import json_decode, json_encode
+from tornado.testing import LogTrapTestCase
+
+
+class SQLiteConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database.SQLiteConnection(":memory:")
+        self.db.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                        "title VARCHAR(255) NOT NULL UNIQUE, "
+                        "published TIMESTAMP)")
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_query(self):
+        published = datetime.datetime(2011, 3, 1, 12, 30)
+        post_id = self.db.execute(
+            "INSERT INTO posts (title, published) VALUES (%s, %s)",
+            u"First", published)
+        post = self.db.get("SELECT * FROM posts WHERE id = %s", post_id)
+        self.assertEqual(post.title, u"First")
+        self.assertEqual(post.published, published)
+        self.assertEqual(self.db.get("SELECT * FROM posts WHERE id = %s",
+                                     post_id + 1), None)
+
+    def test_executemany_and_iter(self):
+        self.db.executemany("INSERT INTO posts (title) VALUES (%s)",
+                            [(u"a",), (u"b",), (u"c",)])
+        titles = [row.title for row in
+                  self.db.iter("SELECT title FROM posts ORDER BY title")]
+        self.assertEqual(titles, [u"a", u"b", u"c"])
+        self.assertRaises(Exception, self.db.get, "SELECT * FROM posts")
+
+    def test_literal_percent(self):
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"100%")
+        rows = self.db.query("SELECT title FROM posts WHERE title LIKE '%%%%'")
+        self.assertEqual([row.title for row in rows], [u"100%"])
+
+    def test_integrity_error(self):
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"a")
+        try:
+            self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"a")
+        except database.IntegrityError:
+            pass
+        else:
+            self.fail("duplicate title inserted")
+        # Errors don't lose the in-memory database
+        self.assertRaises(database.OperationalError, self.db.query,
+                          "SELECT * FROM missing")
+        self.assertEqual(len(self.db.query("SELECT * FROM posts")), 1)
+
+    def test_error_classes(self):
+        # The aliases are classes that can be raised and subclassed
+        for error_class in (database.IntegrityError,
+                            database.OperationalError):
+            self.assertTrue(issubclass(error_class, Exception))
+            self.assertRaises(error_class, self._raise, error_class("x"))
+        self.assertRaises(database.IntegrityError, self.db.executemany,
+                          "INSERT INTO posts (title) VALUES (%s)",
+                          [(u"a",), (u"a",)])
+
+    def _raise(self, error):
+        raise error
+
+    def test_dict_rows(self):
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"a")
+        row = self.db.get("SELECT id, title FROM posts")
+        self.assertTrue(isinstance(row, dict))
+        self.assertEqual(json_decode(json_encode(row)),
+                         dict(id=1, title=u"a"))
+        row["title"] = u"b"
+        self.assertEqual(row.title, u"b")
+        self.assertEqual([dict(row) for row in self.db.iter(
+            "SELECT title FROM posts")], [dict(title=u"a")])
+
+    def test_compact_rows(self):
+        self.db.compact_rows = True
+        published = datetime.datetime(2011, 3, 1)
+        self.db.execute("INSERT INTO posts (title, published) "
+                        "VALUES (%s, %s)", u"a", published)
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"b")
+        rows = self.db.query("SELECT id, title, published, "
+                             "LENGTH(title) AS count FROM posts ORDER BY id")
+        row = rows[0]
+        self.assertTrue(isinstance(row, tuple))
+        self.assertTrue(type(row) is type(rows[1]))
+        self.assertEqual(row.title, u"a")
+        self.assertEqual(row["published"], published)
+        self.assertEqual(row[1], u"a")
+        self.assertEqual(row.count, 1)
+        self.assertEqual(row.keys(), ["id", "title", "published", "count"])
+        self.assertEqual(list(row), row.keys())
+        self.assertTrue("title" in row and "missing" not in row)
+        self.assertEqual(row.get("missing", 5), 5)
+        self.assertEqual(row, dict(id=1, title=u"a", published=published,
+                                  count=1))
+        self.assertEqual(dict(row), dict(row.items()))
+        self.assertRaises(KeyError, lambda: row["missing"])
+        self.assertRaises(AttributeError, getattr, row, "missing")
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+        self.assertEqual(self.db.get("SELECT COUNT(*) FROM posts")
+                         ["COUNT(*)"], 2)
+
+    def test_prepared_statement_reuse(self):
+        query = "SELECT title FROM posts WHERE title = %s"
+        self.assertTrue(database._qmark(query) is database._qmark(query))
+        self.assertEqual(database._qmark(query),
+                         "SELECT title FROM posts WHERE title = ?")
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database.SQLiteConnection(":memory:")
+        self.db.execute("CREATE TABLE posts (title VARCHAR(255))")
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"a")
+        self.cache = database.ResultCache(self.db, ttl=60, max_size=3)
+
+    def tearDown(self):
+        self.db.close()
+
+    def titles(self, keys="posts"):
+        return [row.title for row in self.cache.query(
+            keys, "SELECT title FROM posts ORDER BY title")]
+
+    def test_read_through(self):
+        self.assertEqual(self.titles(), [u"a"])
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"b")
+        self.assertEqual(self.titles(), [u"a"])
+        self.cache.invalidate("posts")
+        self.assertEqual(self.titles(), [u"a", u"b"])
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]),
+                         (1, 2, 1))
+
+    def test_invalidation_keys(self):
+        self.assertEqual(self.titles(["posts", "titles"]), [u"a"])
+        self.assertEqual(self.cache.get(
+            ["posts"], "SELECT title FROM posts WHERE title = %s", u"a").title,
+            u"a")
+        self.cache.invalidate("titles")
+        self.assertEqual(self.cache.stats()["size"], 1)
+        self.cache.invalidate("unused")
+        self.assertEqual(self.cache.stats()["size"], 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_ttl(self):
+        self.cache.ttl = 0.01
+        self.titles()
+        self.db.execute("INSERT INTO posts (title) VALUES (%s)", u"b")
+        time.sleep(0.02)
+        self.assertEqual(self.titles(), [u"a", u"b"])
+
+    def test_max_size(self):
+        for i in range(5):
+            self.cache.get("posts", "SELECT %s AS n", i)
+        self.assertTrue(self.cache.stats()["size"] <= 3)
+        self.cache.invalidate("posts")
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_invalidated_while_running(self):
+        db = self.db
+        class RacingConnection(object):
+            def query(inner, query, *parameters):
+                rows = db.query(query, *parameters)
+                self.cache.invalidate("posts")
+                return rows
+        self.cache.db = RacingConnection()
+        self.titles()
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_unhashable_parameters(self):
+        class EchoConnection(object):
+            def query(self, query, *parameters):
+                return [parameters]
+        self.cache.db = EchoConnection()
+        self.assertEqual(self.cache.query("posts", "SELECT %s", [1]),
+                         [([1],)])
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+class _FlakyConnection(database.SQLiteConnection):
+    """Fails its health check once broken is set."""
+    broken = False
+
+    def query(self, query, *parameters):
+        if self.broken:
+            raise database.sqlite3.OperationalError("connection lost")
+        return database.SQLiteConnection.query(self, query, *parameters)
+
+
+class ConnectionPoolTest(LogTrapTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "pool.db")
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_pool(self, **kwargs):
+        pool = database.ConnectionPool(
+            lambda: _FlakyConnection(self.path), **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_query(self):
+        pool = self.make_pool(min_size=0, max_size=2)
+        pool.execute("CREATE TABLE posts (title VARCHAR(255))")
+        pool.executemany("INSERT INTO posts (title) VALUES (%s)",
+                         [(u"a",), (u"b",)])
+        self.assertEqual(pool.get("SELECT COUNT(*) AS n FROM posts").n, 2)
+        rows = pool.iter("SELECT title FROM posts ORDER BY title")
+        self.assertEqual(pool.stats()["in_use"], 0)
+        self.assertEqual([row.title for row in rows], [u"a", u"b"])
+        stats = pool.stats()
+        self.assertEqual((stats["in_use"], stats["size"], stats["opened"]),
+                         (0, 1, 1))
+        self.assertEqual(stats["checkouts"], 4)
+
+    def test_min_size(self):
+        pool = self.make_pool(min_size=2, max_size=3)
+        self.assertEqual(pool.stats()["idle"], 2)
+
+    def test_checkout_timeout(self):
+        pool = self.make_pool(min_size=0, max_size=2)
+        connections = [pool.checkout(), pool.checkout()]
+        self.assertRaises(database.PoolTimeoutError, pool.checkout, 0.01)
+        stats = pool.stats()
+        self.assertEqual((stats["in_use"], stats["timeouts"]), (2, 1))
+        for connection in connections:
+            pool.checkin(connection)
+
+    def test_wait_for_checkin(self):
+        pool = self.make_pool(min_size=1, max_size=1)
+        connection = pool.checkout()
+        result = []
+        def worker():
+            result.append(pool.get("SELECT 1 AS one").one)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(result, [])
+        pool.checkin(connection)
+        thread.join(5)
+        self.assertEqual(result, [1])
+        stats = pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertTrue(stats["max_wait_time"] >= 0.04)
+
+    def test_failed_health_check(self):
+        pool = self.make_pool(min_size=0, max_size=1, check_interval=0)
+        connection = pool.checkout()
+        pool.checkin(connection)
+        connection.broken = True
+        time.sleep(0.01)
+        replacement = pool.checkout()
+        self.assertTrue(replacement is not connection)
+        pool.checkin(replacement)
+        self.assertEqual(pool.stats()["failed_checks"], 1)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_idle_recycling(self):
+        pool = self.make_pool(min_size=1, max_size=3, max_idle_time=0.01)
+        connections = [pool.checkout() for i in range(3)]
+        for connection in connections:
+            pool.checkin(connection)
+        time.sleep(0.05)
+        pool.checkin(pool.checkout())
+        stats = pool.stats()
+        self.assertEqual((stats["size"], stats["recycled"]), (1, 2))
+
+if database.sqlite3 is None:
+    del SQLiteConnectionTest
+    del ResultCacheTest
+    del ConnectionPoolTest
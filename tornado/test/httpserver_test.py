@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
+from tornado.iostream import IOStream
 from tornado.testing import AsyncHTTPTestCase, LogTrapTestCase
-from tornado.web import Application, RequestHandler
+from tornado.web import Application, RequestHandler, asynchronous
 import os
 try:
     import pycurl
 except ImportError:
     pycurl = None
 import re
+import socket
+import time
 import unittest
 import urllib
 
@@ -73,3 +76,114 @@ if (ssl is None or pycurl is None or
     # cause this test to deadlock as the blocking network ops happen in
     # the same IOLoop as the server.
     del SSLTest
+
+
+class EchoHandler(RequestHandler):
+    def get(self):
+        self.finish(self.get_argument("message"))
+
+    def post(self):
+        self.finish(self.request.body)
+
+class DelayedEchoHandler(RequestHandler):
+    @asynchronous
+    def get(self):
+        self.request.connection.stream.io_loop.add_timeout(
+            time.time() + 0.01,
+            lambda: self.finish(self.get_argument("message")))
+
+class WriteCallbacksHandler(RequestHandler):
+    @asynchronous
+    def get(self):
+        # Writes to the connection directly, so both writes are buffered
+        # before either callback runs
+        self.called = self.settings["write_callbacks"]
+        self.request.write("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\na",
+                           lambda: self.on_write("a"))
+        self.request.write("b", lambda: self.on_write("b"))
+
+    def on_write(self, name):
+        self.called.append(name)
+        if len(self.called) == 2:
+            self.request.finish()
+
+class RawHTTPTestCase(AsyncHTTPTestCase, LogTrapTestCase):
+    """Talks HTTP/1.1 to the server over a single IOStream."""
+    def get_app(self):
+        self.write_callbacks = []
+        return Application([('/', EchoHandler),
+                            ('/delayed', DelayedEchoHandler),
+                            ('/write_callbacks', WriteCallbacksHandler)],
+                           write_callbacks=self.write_callbacks)
+
+    def connect(self):
+        stream = IOStream(socket.socket(), io_loop=self.io_loop)
+        stream.connect(("localhost", self.get_http_port()), self.stop)
+        self.wait()
+        return stream
+
+    def read_response(self, stream):
+        stream.read_until("\r\n\r\n", self.stop)
+        headers = self.wait()
+        self.assertTrue(headers.startswith("HTTP/1.1 200"), headers)
+        length = int(re.search(r"Content-Length: (\d+)", headers).group(1))
+        stream.read_bytes(length, self.stop)
+        return self.wait()
+
+class EdgeTriggeredTest(RawHTTPTestCase):
+    def get_httpserver_options(self):
+        return dict(edge_triggered=True)
+
+    def test_keep_alive(self):
+        stream = self.connect()
+        for i in range(3):
+            stream.write("GET /?message=%d HTTP/1.1\r\n\r\n" % i)
+            self.assertEqual(self.read_response(stream), str(i))
+        body = "x" * 100000
+        stream.write("POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" %
+                     (len(body), body))
+        self.assertEqual(self.read_response(stream), body)
+        stream.close()
+
+class WriteCallbackTest(RawHTTPTestCase):
+    def test_write_callbacks(self):
+        # A write does not drop the callback of the one before it
+        stream = self.connect()
+        stream.write("GET /write_callbacks HTTP/1.1\r\n\r\n")
+        self.assertEqual(self.read_response(stream), "ab")
+        stream.write("GET /?message=c HTTP/1.1\r\n\r\n")
+        self.assertEqual(self.read_response(stream), "c")
+        self.assertEqual(self.write_callbacks, ["a", "b"])
+        stream.close()
+
+class PipelineTest(RawHTTPTestCase):
+    def test_pipelined_requests(self):
+        stream = self.connect()
+        stream.write("GET /?message=a HTTP/1.1\r\n\r\n"
+                     "POST / HTTP/1.1\r\nContent-Length: 1\r\n\r\nb"
+                     "GET /delayed?message=c HTTP/1.1\r\n\r\n"
+                     "GET /?message=d HTTP/1.1\r\n\r\n")
+        self.assertEqual([self.read_response(stream) for i in range(4)],
+                         ["a", "b", "c", "d"])
+        stream.close()
+
+    def test_many_pipelined_requests(self):
+        # Buffered requests are run in a loop, not recursively
+        stream = self.connect()
+        stream.write("".join("GET /?message=%d HTTP/1.1\r\n\r\n" % i
+                             for i in range(1000)))
+        for i in range(1000):
+            self.assertEqual(self.read_response(stream), str(i))
+        stream.close()
+
+    def test_connection_close(self):
+        stream = self.connect()
+        stream.write("GET /?message=a HTTP/1.1\r\n\r\n"
+                     "GET /?message=b HTTP/1.1\r\nConnection: close\r\n\r\n"
+                     "GET /?message=c HTTP/1.1\r\n\r\n")
+        self.assertEqual(self.read_response(stream), "a")
+        self.assertEqual(self.read_response(stream), "b")
+        if not stream.closed():
+            stream.set_close_callback(self.stop)
+            self.wait()
+        self.assertTrue(stream.closed())
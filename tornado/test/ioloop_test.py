@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import thread
+import threading
 import unittest
 import time
 
 from tornado import ioloop
+from tornado.escape import json_decode, json_encode
 from tornado.testing import AsyncTestCase, LogTrapTestCase
 
 class TestIOLoop(AsyncTestCase, LogTrapTestCase):
@@ -24,5 +27,115 @@ class TestIOLoop(AsyncTestCase, LogTrapTestCase):
         self.assertAlmostEqual(time.time(), self.start_time, places=2)
         self.assertTrue(self.called)
 
+    def test_add_callback_from_thread(self):
+        # Only callbacks added from other threads write to the waker
+        wakes = []
+        wake = self.io_loop._wake
+        def counting_wake():
+            wakes.append(thread.get_ident())
+            wake()
+        def add_from_thread():
+            # IOLoop.stop() wakes the loop itself
+            self.io_loop.add_callback(lambda: self.stop(list(wakes)))
+        def start_thread():
+            self.io_loop._wake = counting_wake
+            self.io_loop.add_callback(
+                threading.Thread(target=add_from_thread).start)
+        self.io_loop.add_callback(start_thread)
+        woken_by = self.wait()
+        self.assertEqual(len(woken_by), 1)
+        self.assertNotEqual(woken_by[0], thread.get_ident())
+
+    def test_add_callback_from_signal(self):
+        # A signal handler runs in the loop's thread but may run just
+        # before poll, so it always wakes the loop
+        wakes = []
+        wake = self.io_loop._wake
+        def counting_wake():
+            wakes.append(1)
+            wake()
+        def on_signal():
+            self.io_loop._wake = counting_wake
+            self.io_loop.add_callback_from_signal(
+                lambda: self.stop(len(wakes)))
+        self.io_loop.add_callback(on_signal)
+        self.assertEqual(self.wait(), 1)
+
+    def test_timeout_order(self):
+        now = time.time()
+        order = []
+        for delay in (0.03, 0.01, 0.02, 0.01):
+            self.io_loop.add_timeout(now + delay,
+                                     lambda delay=delay: order.append(delay))
+        self.io_loop.add_timeout(now + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(order, [0.01, 0.01, 0.02, 0.03])
+
+    def test_remove_timeout(self):
+        called = []
+        timeout = self.io_loop.add_timeout(time.time() + 0.01,
+                                           lambda: called.append(1))
+        self.io_loop.remove_timeout(timeout)
+        self.io_loop.remove_timeout(timeout)
+        ran = self.io_loop.add_timeout(time.time(), self.stop)
+        self.wait()
+        # Removing a timeout that already ran does nothing
+        self.io_loop.remove_timeout(ran)
+        self.io_loop.add_timeout(time.time() + 0.02, self.stop)
+        self.wait()
+        self.assertEqual(called, [])
+
+    def test_compaction(self):
+        deadline = time.time() + 60
+        timeouts = [self.io_loop.add_timeout(deadline, self.fail)
+                    for i in range(2000)]
+        for timeout in timeouts[:1500]:
+            self.io_loop.remove_timeout(timeout)
+        # Compacted once more than half of the queue was cancelled
+        self.assertTrue(len(self.io_loop._timeouts) < 2000)
+        self.assertEqual(len([entry for entry in self.io_loop._timeouts
+                              if entry[2].callback is not None]), 500)
+        for timeout in timeouts[1500:]:
+            self.io_loop.remove_timeout(timeout)
+
+    def test_sleep_until_timeout(self):
+        before = self.io_loop.stats()
+        for i in range(5):
+            self.io_loop.add_timeout(time.time() + 0.02, self.stop)
+            self.wait()
+        after = self.io_loop.stats()
+        # One wakeup per timeout, none of them early
+        self.assertTrue(after["wakeups"] - before["wakeups"] <= 10)
+        self.assertEqual(after["idle_wakeups"], before["idle_wakeups"])
+
+    def test_idle_loop_sleeps(self):
+        before = self.io_loop.stats()["wakeups"]
+        self.io_loop.add_timeout(time.time() + 0.5, self.stop)
+        self.wait()
+        self.assertTrue(self.io_loop.stats()["wakeups"] - before <= 2)
+
+    def test_metrics(self):
+        metrics = ioloop.IOLoopMetrics(slowest=2)
+        self.io_loop.set_metrics(metrics)
+        def slow_callback():
+            time.sleep(0.02)
+        self.io_loop.add_callback(slow_callback)
+        self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+        self.wait()
+        self.io_loop.set_metrics(None)
+        snapshot = json_decode(json_encode(metrics.snapshot()))
+        self.assertTrue(snapshot["iterations"] >= 1)
+        self.assertTrue(snapshot["busy_time"] >= 0.02)
+        self.assertEqual(snapshot["timeouts_run"], 1)
+        # The timeout was due while the slow callback ran
+        self.assertTrue(snapshot["max_timer_lag"] >= 0.005)
+        self.assertEqual(sum(count for bound, count
+                             in snapshot["iteration_histogram"]),
+                         snapshot["iterations"])
+        slowest = snapshot["slowest_handlers"]
+        self.assertEqual(len(slowest), 2)
+        self.assertTrue(slowest[0]["handler"].endswith(".slow_callback"))
+        self.assertTrue(slowest[0]["seconds"] >= slowest[1]["seconds"])
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,7 @@ from tornado.iostream import IOStream
 from tornado.testing import AsyncHTTPTestCase, LogTrapTestCase, get_unused_port
 from tornado.web import RequestHandler, Application
 import socket
+import time
 
 class HelloHandler(RequestHandler):
     def get(self):
@@ -46,3 +47,88 @@ class TestIOStream(AsyncHTTPTestCase, LogTrapTestCase):
         self.wait()
         self.assertFalse(self.connect_called)
 
+
+    def test_read_until_small_chunks(self):
+        # One-byte reads put the delimiter across many buffer chunks
+        server, client = socket.socketpair()
+        stream = IOStream(server, io_loop=self.io_loop, read_chunk_size=1)
+        client.sendall("GET / HTTP/1.0\r\nHost: a\r\n\r\nnext\r\n\r\nrest")
+        stream.read_until("\r\n\r\n", self.stop)
+        data = self.wait()
+        self.assertEqual(data, "GET / HTTP/1.0\r\nHost: a\r\n\r\n")
+        stream.read_until("\r\n", self.stop)
+        data = self.wait()
+        self.assertEqual(data, "next\r\n")
+        stream.read_until("\r\n", self.stop)
+        data = self.wait()
+        self.assertEqual(data, "\r\n")
+        stream.read_bytes(4, self.stop)
+        data = self.wait()
+        self.assertEqual(data, "rest")
+        self.assertEqual(stream._read_buffer_size, 0)
+        stream.close()
+        client.close()
+
+    def test_large_write(self):
+        # Partial sends of a chunk larger than the socket buffer and a run
+        # of small writes must all arrive intact and in order
+        server, client = socket.socketpair()
+        server_stream = IOStream(server, io_loop=self.io_loop)
+        client_stream = IOStream(client, io_loop=self.io_loop)
+        large = "".join(chr(i) for i in range(256)) * 4096
+        small = ["%d," % i for i in range(1000)]
+        data = large + "".join(small)
+        server_stream.write(large)
+        for chunk in small:
+            server_stream.write(chunk)
+        client_stream.read_bytes(len(data), self.stop)
+        received = self.wait()
+        self.assertEqual(received, data)
+        server_stream.close()
+        client_stream.close()
+
+    def test_edge_triggered(self):
+        if not self.io_loop.supports_edge_triggered():
+            return
+        updates = []
+        update_handler = self.io_loop.update_handler
+        def counting_update_handler(fd, events):
+            updates.append(fd)
+            update_handler(fd, events)
+        self.io_loop.update_handler = counting_update_handler
+        server, client = socket.socketpair()
+        server_stream = IOStream(server, io_loop=self.io_loop,
+                                 edge_triggered=True)
+        client_stream = IOStream(client, io_loop=self.io_loop,
+                                 edge_triggered=True, read_chunk_size=1024)
+        large = "".join(chr(i) for i in range(256)) * 4096
+        for i in range(3):
+            server_stream.write(large)
+            server_stream.write("end")
+            client_stream.read_bytes(len(large) + 3, self.stop)
+            self.assertEqual(self.wait(), large + "end")
+            # Data that arrives while nothing is being read is kept in
+            # the socket until the next read
+            client_stream.write("ping %d\r\n" % i)
+            self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+            self.wait()
+            server_stream.read_until("\r\n", self.stop)
+            self.assertEqual(self.wait(), "ping %d\r\n" % i)
+        self.assertEqual(updates, [])
+        client_stream.set_close_callback(self.stop)
+        server_stream.close()
+        self.wait()
+        self.assertTrue(client_stream.closed())
+
+    def test_edge_triggered_connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        stream = IOStream(s, io_loop=self.io_loop, edge_triggered=True)
+        # Written before the connection is made
+        stream.write("GET / HTTP/1.0\r\n\r\n")
+        stream.connect(("localhost", self.get_http_port()))
+        stream.read_until("\r\n\r\n", self.stop)
+        data = self.wait()
+        self.assertTrue(data.startswith("HTTP/1.0 200"), data)
+        stream.read_bytes(5, self.stop)
+        self.assertEqual(self.wait(), "Hello")
+        stream.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+import urllib2
+
+from tornado.escape import json_decode
+
+# Runs a supervised server with two workers. "/" returns the pid of the
+# worker and "/counts" the request counts of all workers.
+SERVER = """
+import logging, os, sys
+from tornado import httpserver, ioloop, process, web
+from tornado.escape import json_encode
+
+class PidHandler(web.RequestHandler):
+    def get(self):
+        self.write(str(os.getpid()))
+
+class CountsHandler(web.RequestHandler):
+    def get(self):
+        self.write(json_encode(dict((str(pid), count) for pid, count
+                               in supervisor.request_counts().iteritems())))
+
+logging.getLogger().setLevel(logging.ERROR)
+server = httpserver.HTTPServer(web.Application([
+    ("/", PidHandler), ("/counts", CountsHandler)]))
+supervisor = process.Supervisor(server, int(sys.argv[1]), "127.0.0.1",
+                                num_processes=2, min_uptime=0)
+supervisor.start()
+ioloop.IOLoop.instance().start()
+"""
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.port = _unused_port()
+        self._last_counts = {}
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(root))
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", SERVER, str(self.port)], env=env)
+        self.wait_for(lambda: len(self.counts()) == 2)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        # Killing the parent doesn't stop its workers
+        for pid in self._last_counts:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def fetch(self, path):
+        try:
+            return urllib2.urlopen(
+                "http://127.0.0.1:%d%s" % (self.port, path)).read()
+        except (urllib2.URLError, socket.error):
+            return None
+
+    def counts(self):
+        body = self.fetch("/counts")
+        if body is None:
+            return {}
+        self._last_counts = dict((int(pid), count) for pid, count
+                                 in json_decode(body).iteritems())
+        return self._last_counts
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.05)
+
+    def test_request_counts(self):
+        before = sum(self.counts().values())
+        pids = [int(self.fetch("/")) for i in range(20)]
+        counts = self.counts()
+        self.assertEqual(set(pids) - set(counts), set())
+        # The /counts request itself is counted before it responds
+        self.assertEqual(sum(counts.values()), before + 21)
+
+    def test_restart_crashed_worker(self):
+        old = self.counts()
+        victim = min(old)
+        os.kill(victim, signal.SIGKILL)
+        self.wait_for(lambda: (len(self.counts()) == 2 and
+                               victim not in self.counts()))
+        self.assertTrue(max(old) in self.counts())
+
+    def test_rolling_restart(self):
+        old = set(self.counts())
+        os.kill(self.process.pid, signal.SIGHUP)
+        self.wait_for(lambda: (len(self.counts()) == 2 and
+                               not old & set(self.counts())))
+        self.assertTrue(self.fetch("/") is not None)
+
+    def test_graceful_stop(self):
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.wait_for(lambda: self.process.poll() is not None)
+        self.assertEqual(self.process.returncode, 0)
+        self.assertEqual(self.fetch("/"), None)
+
+if not hasattr(os, "fork"):
+    del SupervisorTest
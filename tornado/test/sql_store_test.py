@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import datetime
+import unittest
+
+from tornado import database
+from storage.sql import SQLStore
+
+
+class SQLStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database.SQLiteConnection(":memory:")
+        self.store = SQLStore(self.db)
+        self.store.create_tables()
+        self.store.create_tables()
+
+    def create(self, title, categories=(), markdown=None):
+        slug = title.lower().replace(" ", "-")
+        markdown = markdown or u"About " + title
+        return self.store.create_entry(
+            u"author@example.com", title, slug, markdown,
+            u"<p>%s</p>" % markdown, list(categories))
+
+    def slugs(self, entries):
+        return [entry.slug for entry in entries]
+
+    def testCreateEntry(self):
+        first = self.create(u"First", [u"tornado", u"python"])
+        self.assertEqual(first.neighbours, [])
+        self.assertTrue(first.months_changed)
+        second = self.create(u"Second")
+        self.assertEqual(second.neighbours, [u"first"])
+        self.assertFalse(second.months_changed)
+        entry = self.store.get_entry_by_slug(u"first")
+        self.assertEqual(entry.categories, [u"tornado", u"python"])
+        self.assertEqual(entry.next_slug, u"second")
+        self.assertEqual(entry.next_title, u"Second")
+        self.assertEqual(self.store.get_entry(str(entry.key())).slug,
+                         u"first")
+        self.assertEqual(self.store.get_entry("nonsense"), None)
+        self.assertEqual(second.entry.prev_slug, u"first")
+
+    def testListings(self):
+        for i in range(7):
+            self.create(u"Entry %d" % i, i % 2 and [u"odd"] or [])
+        entries, has_next = self.store.get_page(1, 5)
+        self.assertEqual(self.slugs(entries)[:2],
+                         [u"entry-6", u"entry-5"])
+        self.assertTrue(has_next)
+        entries, has_next = self.store.get_page(2, 5)
+        self.assertEqual(len(entries), 2)
+        self.assertFalse(has_next)
+        self.assertEqual(self.slugs(self.store.latest_entries(1)),
+                         [u"entry-6"])
+        self.assertEqual(self.slugs(self.store.entries_in_category(
+            u"odd")), [u"entry-5", u"entry-3", u"entry-1"])
+        self.assertEqual(self.store.categories(), [u"odd"])
+        now = datetime.datetime.utcnow()
+        month = datetime.date(now.year, now.month, 1)
+        self.assertEqual(len(self.store.entries_between(
+            month, month + datetime.timedelta(days=32))), 7)
+        self.assertEqual(self.store.archive_months()[0][:2],
+                         (now.year, "%02d" % now.month))
+
+    def testUpdateEntry(self):
+        self.create(u"First")
+        entry = self.create(u"Second", [u"a", u"b"]).entry
+        self.create(u"Third")
+        update = self.store.update_entry(entry, u"Renamed", u"New",
+                                         u"<p>New</p>", [u"b", u"c"])
+        self.assertEqual(update.old_categories, set([u"a", u"b"]))
+        self.assertEqual(sorted(update.neighbours),
+                         [u"first", u"third"])
+        self.assertEqual(update.entry.categories, [u"b", u"c"])
+        self.assertEqual(update.entry.slug, u"second")
+        self.assertEqual(self.store.get_entry_by_slug(
+            u"first").next_title, u"Renamed")
+        self.assertEqual(self.store.get_entry_by_slug(
+            u"third").prev_title, u"Renamed")
+        self.assertEqual(self.store.categories(), [u"b", u"c"])
+
+    def testComments(self):
+        entry = self.create(u"First").entry
+        for i in range(3):
+            self.store.add_comment(entry, u"Reader", u"r@example.com",
+                                   u"", u"Comment %d" % i)
+        comments = self.store.get_comments(u"first", 2, 1)
+        self.assertEqual([c.body for c in comments],
+                         [u"Comment 1", u"Comment 2"])
+        self.assertEqual(self.store.get_entry_by_slug(
+            u"first").comment_count, 3)
+
+    def testSearch(self):
+        entries = [self.create(u"Sockets", markdown=u"Sockets sockets."),
+                   self.create(u"Loops", markdown=u"The IOLoop polls "
+                               u"sockets."),
+                   self.create(u"Templates", markdown=u"Compiled.")]
+        for update in entries:
+            self.store.enqueue_indexing(update.entry)
+        self.assertEqual(self.slugs(self.store.search(u"sockets")),
+                         [u"sockets", u"loops"])
+        self.store.update_entry(entries[0].entry, u"Renamed",
+                                u"Nothing here", u"", [])
+        self.store.index_entry(entries[0].entry.key())
+        self.assertEqual(self.slugs(self.store.search(u"sockets")),
+                         [u"loops"])
+        self.assertEqual(self.store.search(u"unrelated words"), [])
+
+    def testQueriesUseIndexes(self):
+        plans = [
+            ("SELECT * FROM entries WHERE slug = %s", u"x"),
+            ("SELECT * FROM entries ORDER BY published DESC", None),
+            ("SELECT entry_id FROM entry_categories WHERE category = %s "
+             "ORDER BY published DESC", u"x"),
+            ("SELECT * FROM comments WHERE slug = %s "
+             "ORDER BY published", u"x"),
+        ]
+        for query, parameter in plans:
+            parameters = parameter is not None and [parameter] or []
+            plan = " ".join(str(row.values()) for row in self.db.query(
+                "EXPLAIN QUERY PLAN " + query, *parameters))
+            self.assertTrue("INDEX" in plan or "PRIMARY KEY" in plan,
+                            (query, plan))
+            self.assertFalse("TEMP B-TREE" in plan, (query, plan))
+
+    def testExport(self):
+        first = self.create(u"First", [u"b", u"a"]).entry
+        self.create(u"Second")
+        self.create(u"Third", [u"c"])
+        for slug in (u"third", u"first"):
+            entry = self.store.get_entry_by_slug(slug)
+            self.store.add_comment(entry, u"Reader", u"r@example.com",
+                                   u"", u"On " + slug)
+        entries = list(self.store.iter_entries())
+        self.assertEqual(self.slugs(entries),
+                         [u"first", u"second", u"third"])
+        self.assertEqual([e.categories for e in entries],
+                         [[u"b", u"a"], [], [u"c"]])
+        self.assertEqual(entries[0].markdown, first.markdown)
+        self.assertFalse(hasattr(entries[0], "_category"))
+        self.assertEqual([c.body for c in self.store.iter_comments()],
+                         [u"On first", u"On third"])
+
+class CachedSQLStoreTest(SQLStoreTest):
+    """Runs the tests again with reads of compact rows going through
+    a ResultCache."""
+    def setUp(self):
+        SQLStoreTest.setUp(self)
+        self.db.compact_rows = True
+        self.store = SQLStore(self.db, cache_ttl=60)
+
+    def testCachedReads(self):
+        self.create(u"First", [u"a"])
+        self.store.categories()
+        self.store.categories()
+        self.assertEqual(self.store.cache.stats()["hits"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
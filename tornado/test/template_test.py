@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import unittest
+
+from tornado.template import Template
+from tornado.testing import LogTrapTestCase
+
+class TemplateTest(LogTrapTestCase):
+    def test_simple(self):
+        template = Template("Hello {{ name }}!")
+        self.assertEqual(template.generate(name="Ben"), "Hello Ben!")
+
+    def test_compiled_render(self):
+        source = ("{% for x in items %}{% apply upper %}{{ x }}{% end %}"
+                  "{% end %} {{ escape(title) }}")
+        template = Template(source, compiled_render=True)
+        plain = Template(source)
+        args = dict(items=["a", "b"], upper=lambda s: s.upper(),
+                    title="<t>")
+        self.assertEqual(template.generate(**args), plain.generate(**args))
+        self.assertEqual(template.generate(**args), "AB &lt;t&gt;")
+
+    def test_compiled_render_rebinds_arguments(self):
+        template = Template("{{ value }}", compiled_render=True)
+        self.assertEqual(template.generate(value=1), "1")
+        self.assertEqual(template.generate(value=2), "2")
+        # Arguments from an earlier call must not leak into the next one
+        self.assertRaises(NameError, template.generate)
+
+    def test_compiled_render_builtins(self):
+        template = Template("{{ len(items) }} {{ max(items) }}",
+                            compiled_render=True)
+        self.assertEqual(template.generate(items=[3, 1, 2]), "3 3")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,17 @@
 from tornado.escape import json_decode
 from tornado.iostream import IOStream
 from tornado.testing import LogTrapTestCase, AsyncHTTPTestCase
-from tornado.web import RequestHandler, _O, authenticated, Application, asynchronous
+from tornado.web import RequestHandler, _O, authenticated, Application, asynchronous, gzip_encode, StaticFileHandler, build_static_manifest, write_static_manifest
 
+import datetime
+import hashlib
 import logging
+import os
 import re
+import shutil
 import socket
+import tempfile
+import time
 import tornado.ioloop
 
 class CookieTestRequestHandler(RequestHandler):
@@ -130,3 +136,262 @@ class RequestEncodingTest(AsyncHTTPTestCase, LogTrapTestCase):
         self.assertEqual(json_decode(self.fetch('/%3F?%3F=%3F').body),
                          dict(path='?', args={'?': ['?']}))
 
+
+class PrecompressedHandler(RequestHandler):
+    BODY = "Hello, precompressed world! " * 20
+
+    def get(self):
+        self.finish_precompressed(self.BODY,
+                                  gzip_encode(self.BODY, compress_level=1),
+                                  etag="abc123")
+
+class PrecompressedTest(AsyncHTTPTestCase, LogTrapTestCase):
+    def get_app(self):
+        return Application([("/", PrecompressedHandler)], gzip=True,
+                           gzip_level=1)
+
+    def test_gzip_body(self):
+        response = self.fetch("/")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Etag"], '"abc123-gzip"')
+        self.assertEqual(response.body, PrecompressedHandler.BODY)
+
+    def test_identity_body(self):
+        response = self.fetch("/", use_gzip=False)
+        self.assertTrue("Content-Encoding" not in response.headers)
+        self.assertEqual(response.headers["Etag"], '"abc123"')
+        self.assertEqual(response.body, PrecompressedHandler.BODY)
+
+    def test_if_none_match(self):
+        response = self.fetch("/", use_gzip=False,
+                              headers={"If-None-Match": '"abc123"'})
+        self.assertEqual(response.code, 304)
+
+class ConditionalHandler(RequestHandler):
+    def initialize(self, test):
+        self.test = test
+
+    def get(self):
+        if self.check_conditional_headers(
+            etag="v42", last_modified=datetime.datetime(2011, 3, 1, 12, 0, 0)):
+            return
+        self.test.rendered += 1
+        self.finish_precompressed("page", etag="v42")
+
+class ConditionalTest(AsyncHTTPTestCase, LogTrapTestCase):
+    def get_app(self):
+        self.rendered = 0
+        return Application([("/", ConditionalHandler, dict(test=self))])
+
+    def test_unconditional(self):
+        response = self.fetch("/")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Etag"], '"v42"')
+        self.assertEqual(response.headers["Last-Modified"],
+                         "Tue, 01 Mar 2011 12:00:00 GMT")
+        self.assertEqual(self.rendered, 1)
+
+    def test_if_none_match(self):
+        for etag in ('"v42"', '"v41", "v42-gzip"', '*'):
+            response = self.fetch("/", headers={"If-None-Match": etag})
+            self.assertEqual(response.code, 304)
+        response = self.fetch("/", headers={"If-None-Match": '"v41"'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.rendered, 1)
+
+    def test_if_modified_since(self):
+        response = self.fetch("/", headers={
+                "If-Modified-Since": "Tue, 01 Mar 2011 12:00:00 GMT"})
+        self.assertEqual(response.code, 304)
+        response = self.fetch("/", headers={
+                "If-Modified-Since": "Tue, 01 Mar 2011 11:59:59 GMT"})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.rendered, 1)
+
+    def test_if_none_match_takes_precedence(self):
+        response = self.fetch("/", headers={
+                "If-None-Match": '"v41"',
+                "If-Modified-Since": "Tue, 01 Mar 2011 12:00:00 GMT"})
+        self.assertEqual(response.code, 200)
+
+class SmallChunkStaticFileHandler(StaticFileHandler):
+    CACHE_FILE_SIZE = 100
+    STREAM_CHUNK_SIZE = 1000
+
+class StaticFileTest(AsyncHTTPTestCase, LogTrapTestCase):
+    SMALL = "0123456789"
+    LARGE = "".join(chr(i) for i in range(256)) * 40
+
+    def get_app(self):
+        self.root = tempfile.mkdtemp()
+        for name, data in (("small.txt", self.SMALL), ("large.bin", self.LARGE)):
+            f = open(os.path.join(self.root, name), "wb")
+            f.write(data)
+            f.close()
+        return Application([("/static/(.*)", SmallChunkStaticFileHandler,
+                             dict(path=self.root))])
+
+    def tearDown(self):
+        super(StaticFileTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def test_small_file(self):
+        response = self.fetch("/static/small.txt")
+        self.assertEqual(response.body, self.SMALL)
+        self.assertEqual(response.headers["Content-Type"], "text/plain")
+        etag = response.headers["Etag"]
+        response = self.fetch("/static/small.txt",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+        response = self.fetch("/static/small.txt", headers={
+                "If-Modified-Since": response.headers["Last-Modified"]})
+        self.assertEqual(response.code, 304)
+
+    def test_large_file(self):
+        response = self.fetch("/static/large.bin")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.LARGE)
+        self.assertEqual(response.headers["Content-Length"],
+                         str(len(self.LARGE)))
+
+    def test_range(self):
+        for name, data in (("small.txt", self.SMALL),
+                           ("large.bin", self.LARGE)):
+            size = len(data)
+            response = self.fetch("/static/" + name,
+                                  headers={"Range": "bytes=2-5"})
+            self.assertEqual(response.code, 206)
+            self.assertEqual(response.body, data[2:6])
+            self.assertEqual(response.headers["Content-Range"],
+                             "bytes 2-5/%d" % size)
+            response = self.fetch("/static/" + name,
+                                  headers={"Range": "bytes=-3"})
+            self.assertEqual(response.body, data[-3:])
+            response = self.fetch("/static/" + name,
+                                  headers={"Range": "bytes=%d-" % (size - 1)})
+            self.assertEqual(response.body, data[-1:])
+            response = self.fetch("/static/" + name,
+                                  headers={"Range": "bytes=%d-" % size})
+            self.assertEqual(response.code, 416)
+            self.assertEqual(response.headers["Content-Range"],
+                             "bytes */%d" % size)
+            response = self.fetch("/static/" + name, headers={
+                    "Range": "bytes=2-5", "If-Range": '"stale"'})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, data)
+
+    def test_head(self):
+        response = self.fetch("/static/large.bin", method="HEAD")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "")
+        self.assertEqual(response.headers["Content-Length"],
+                         str(len(self.LARGE)))
+
+    def test_missing(self):
+        self.assertEqual(self.fetch("/static/missing.txt").code, 404)
+
+class StaticUrlHandler(RequestHandler):
+    def get(self, path):
+        self.write(self.static_url(path))
+
+class StaticManifestTest(AsyncHTTPTestCase, LogTrapTestCase):
+    def get_app(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "css"))
+        f = open(os.path.join(self.root, "css", "site.css"), "w")
+        f.write("body {}")
+        f.close()
+        self.manifest = os.path.join(self.root, "manifest.json")
+        write_static_manifest(self.root, self.manifest)
+        # Later changes are not seen until the manifest is rebuilt
+        f = open(os.path.join(self.root, "css", "site.css"), "w")
+        f.write("body { color: red }")
+        f.close()
+        return Application([("/url/(.*)", StaticUrlHandler)],
+                           static_path=self.root,
+                           static_manifest=self.manifest)
+
+    def tearDown(self):
+        super(StaticManifestTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def test_build_static_manifest(self):
+        manifest = build_static_manifest(self.root)
+        self.assertEqual(sorted(manifest.keys()),
+                         ["css/site.css", "manifest.json"])
+        self.assertEqual(manifest["css/site.css"],
+                         hashlib.md5("body { color: red }").hexdigest())
+
+    def test_static_url(self):
+        version = hashlib.md5("body {}").hexdigest()[:5]
+        self.assertEqual(self.fetch("/url/css/site.css").body,
+                         "/static/css/site.css?v=" + version)
+        self.assertEqual(self.fetch("/url/missing.css").body,
+                         "/static/missing.css")
+
+    def test_immutable(self):
+        url = self.fetch("/url/css/site.css").body
+        response = self.fetch(url)
+        self.assertEqual(response.body, "body { color: red }")
+        self.assertTrue("immutable" in response.headers["Cache-Control"])
+        for stale in ("stale", "", url[-5:-4], url[-5:] + "0"):
+            response = self.fetch("/static/css/site.css?v=" + stale)
+            self.assertTrue("immutable" not in
+                            response.headers["Cache-Control"], stale)
+        response = self.fetch("/static/css/site.css")
+        self.assertEqual(response.headers["Cache-Control"], "public")
+
+class StreamHandler(RequestHandler):
+    def initialize(self, test):
+        self.test = test
+
+    def get(self, mode):
+        self.finish_stream(self.lines(mode), buffer_size=100)
+
+    def lines(self, mode):
+        try:
+            if mode == "error":
+                raise Exception("broken before any output")
+            for i in range(int(mode)):
+                self.test.produced = i
+                yield "line %d\n" % i
+                if mode == "500" and i == 100:
+                    raise Exception("broken after output")
+        finally:
+            self.test.closed = True
+
+class StreamTest(AsyncHTTPTestCase, LogTrapTestCase):
+    def get_app(self):
+        self.produced = None
+        self.closed = False
+        return Application([("/(.*)", StreamHandler, dict(test=self))])
+
+    def test_stream(self):
+        response = self.fetch("/1000")
+        lines = response.body.splitlines()
+        self.assertEqual((len(lines), lines[-1]), (1000, "line 999"))
+        self.assertTrue(self.closed)
+
+    def test_error_before_output(self):
+        self.assertEqual(self.fetch("/error").code, 500)
+
+    def test_error_after_output(self):
+        # The response is cut short instead of finished
+        response = self.fetch("/500")
+        self.assertTrue(response.code != 200 or
+                        len(response.body.splitlines()) < 500)
+        self.assertTrue(self.closed)
+
+    def test_client_gone(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(("localhost", self.get_http_port()))
+        s.send("GET /10000000 HTTP/1.0\r\n\r\n")
+        def check():
+            # Nothing reads the response, so the generator must stall
+            self.assertTrue(self.produced < 100000)
+            s.close()
+            self.io_loop.add_timeout(time.time() + 0.1, self.stop)
+        self.io_loop.add_timeout(time.time() + 0.2, check)
+        self.wait()
+        self.assertTrue(self.closed)
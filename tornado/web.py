@@ -511,7 +511,8 @@ class RequestHandler(object):
             RequestHandler._templates = {}
         if template_path not in RequestHandler._templates:
             loader = self.application.settings.get("template_loader") or\
-              template.Loader(template_path)
+              template.Loader(template_path, compiled_render=
+                  self.application.settings.get("compiled_templates", False))
             RequestHandler._templates[template_path] = loader
         t = RequestHandler._templates[template_path].load(template_name)
         args = dict(
@@ -528,8 +529,13 @@ class RequestHandler(object):
         args.update(kwargs)
         return t.generate(**args)
 
-    def flush(self, include_footers=False):
-        """Flushes the current output buffer to the network."""
+    def flush(self, include_footers=False, callback=None):
+        """Flushes the current output buffer to the network.
+
+        If callback is given, it is run when all flushed output has been
+        written to the socket, which lets handlers that stream large
+        responses wait for the client instead of buffering everything.
+        """
         if self.application._wsgi:
             raise Exception("WSGI applications do not support flush()")
 
@@ -548,11 +554,12 @@ class RequestHandler(object):
 
         # Ignore the chunk and only write the headers for HEAD requests
         if self.request.method == "HEAD":
-            if headers: self.request.write(headers)
-            return
+            chunk = ""
 
         if headers or chunk:
-            self.request.write(headers + chunk)
+            self.request.write(headers + chunk, callback=callback)
+        elif callback is not None:
+            callback()
 
     def finish(self, chunk=None):
         """Finishes this response, ending the HTTP request."""
@@ -592,6 +599,148 @@ class RequestHandler(object):
             self._log()
         self._finished = True
 
+    def finish_precompressed(self, body, gzip_body=None, etag=None):
+        """Finishes this response with a body that was compressed earlier.
+
+        This is meant for responses served from a cache: body is the
+        uncompressed content and gzip_body, if given, the same content as
+        returned by gzip_encode().  If the application has the 'gzip'
+        setting and the client accepts gzip, gzip_body is sent as is and
+        the gzip output transform is skipped.
+
+        etag is a strong validator for body (e.g. a content hash).  The
+        gzip representation gets a distinct etag derived from it, and a
+        matching If-None-Match answers 304 without hashing the body.
+        """
+        if gzip_body is not None and self.settings.get("gzip"):
+            self.set_header("Vary", "Accept-Encoding")
+            if self.request.supports_http_1_1() and \
+               "gzip" in self.request.headers.get("Accept-Encoding", ""):
+                self.set_header("Content-Encoding", "gzip")
+                body = gzip_body
+                if etag:
+                    etag = etag + _GZIP_ETAG_SUFFIX
+        if etag and self._status_code == 200:
+            self.set_header("Etag", '"%s"' % etag)
+            if _etag_matches(self.request.headers.get("If-None-Match"), etag):
+                self.set_status(304)
+                self.finish()
+                return
+        self.finish(body)
+
+    def finish_stream(self, chunks, buffer_size=64 * 1024):
+        """Finishes this response with the strings from an iterator.
+
+        Strings are taken from chunks until buffer_size bytes are waiting,
+        which are then flushed; the iterator is only advanced again once
+        they have been written to the socket. A response generated from,
+        e.g., the rows of database.Connection.iter() is thereby sent in
+        constant memory however large it is and however slow the client:
+
+            def get(self):
+                self.finish_stream(json_encode(dict(row)) + "\n"
+                                   for row in self.db.iter(query))
+
+        The handler is finished by finish_stream, as if the method were
+        @asynchronous. If the client goes away the iterator is closed and
+        on_connection_close is called. An error raised by the iterator
+        after output has been sent closes the connection, so that the
+        client sees a truncated response rather than a complete one.
+
+        WSGI applications can't flush, so there the whole response is
+        buffered and finished at once.
+        """
+        if self.application._wsgi:
+            for chunk in chunks:
+                self.write(chunk)
+            self.finish()
+            return
+        self._auto_finish = False
+        self._stream_chunks = iter(chunks)
+        self._stream_buffer_size = buffer_size
+        self.request.connection.stream.set_close_callback(
+            self._on_stream_close)
+        self._stream_next()
+
+    def _stream_next(self):
+        chunks = self._stream_chunks
+        if chunks is None:
+            return
+        size = 0
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                size += len(chunk)
+                if size >= self._stream_buffer_size:
+                    break
+            else:
+                self._stream_chunks = None
+        except Exception, e:
+            self._stream_chunks = None
+            if not self._headers_written:
+                self._handle_request_exception(e)
+                return
+            logging.error("Error streaming %s", self._request_summary(),
+                          exc_info=True)
+            self.request.connection.stream.set_close_callback(None)
+            self.request.connection.stream.close()
+            return
+        if self._stream_chunks is None:
+            self.finish()
+        else:
+            self.flush(callback=self._stream_next)
+
+    def _on_stream_close(self):
+        if self._stream_chunks is not None:
+            close = getattr(self._stream_chunks, "close", None)
+            self._stream_chunks = None
+            if close is not None:
+                close()
+        self.on_connection_close()
+
+    def check_conditional_headers(self, etag=None, last_modified=None):
+        """Answers a conditional GET from validators known before rendering.
+
+        Handlers whose output is fully determined by some data version
+        (a generation counter, an updated timestamp, ...) can call this
+        before doing any queries or rendering:
+
+            if self.check_conditional_headers(etag=version,
+                                              last_modified=updated):
+                return
+
+        etag is an opaque string and last_modified a UTC datetime; either
+        may be None.  They are set as the ETag and Last-Modified headers of
+        the response.  If the request's If-None-Match (or, in its absence,
+        If-Modified-Since) header matches, a 304 response is finished and
+        True is returned.  The etag also matches the gzip variant produced
+        by finish_precompressed.
+        """
+        if etag is not None:
+            self.set_header("Etag", '"%s"' % etag)
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0)
+            self.set_header("Last-Modified", last_modified)
+        if self.request.method not in ("GET", "HEAD"):
+            return False
+        inm = self.request.headers.get("If-None-Match")
+        ims = self.request.headers.get("If-Modified-Since")
+        if inm is not None:
+            matched = etag is not None and (
+                _etag_matches(inm, etag) or
+                _etag_matches(inm, etag + _GZIP_ETAG_SUFFIX))
+        elif ims is not None and last_modified is not None:
+            date_tuple = email.utils.parsedate(ims)
+            matched = date_tuple is not None and \
+                calendar.timegm(date_tuple) >= \
+                calendar.timegm(last_modified.utctimetuple())
+        else:
+            matched = False
+        if matched:
+            self.set_status(304)
+            self.finish()
+        return matched
+
     def send_error(self, status_code=500, **kwargs):
         """Sends the given HTTP error code to the browser.
 
@@ -792,30 +941,40 @@ class RequestHandler(object):
         returned content. The signature is based on the content of the
         file.
 
+        If the 'static_manifest' setting is given, signatures are looked
+        up in the manifest (see build_static_manifest) instead of being
+        computed by reading each file once per process.  Outside of
+        debug mode, files missing from the manifest get no signature.
+
         If this handler has a "include_host" attribute, we include the
         full host for every static URL, including the "http://". Set
         this attribute for handlers whose output needs non-relative static
         path names.
         """
         self.require_setting("static_path", "static_url")
-        if not hasattr(RequestHandler, "_static_hashes"):
-            RequestHandler._static_hashes = {}
-        hashes = RequestHandler._static_hashes
-        abs_path = os.path.join(self.application.settings["static_path"],
-                                path)
-        if abs_path not in hashes:
-            try:
-                f = open(abs_path)
-                hashes[abs_path] = hashlib.md5(f.read()).hexdigest()
-                f.close()
-            except:
-                logging.error("Could not open static file %r", path)
-                hashes[abs_path] = None
+        manifest = self.application.static_manifest
+        if manifest is not None and not self.settings.get("debug"):
+            version = manifest.get(path)
+        else:
+            if not hasattr(RequestHandler, "_static_hashes"):
+                RequestHandler._static_hashes = {}
+            hashes = RequestHandler._static_hashes
+            abs_path = os.path.join(self.application.settings["static_path"],
+                                    path)
+            if abs_path not in hashes:
+                try:
+                    f = open(abs_path)
+                    hashes[abs_path] = hashlib.md5(f.read()).hexdigest()
+                    f.close()
+                except:
+                    logging.error("Could not open static file %r", path)
+                    hashes[abs_path] = None
+            version = hashes.get(abs_path)
         base = self.request.protocol + "://" + self.request.host \
             if getattr(self, "include_host", False) else ""
         static_url_prefix = self.settings.get('static_url_prefix', '/static/')
-        if hashes.get(abs_path):
-            return base + static_url_prefix + path + "?v=" + hashes[abs_path][:5]
+        if version:
+            return base + static_url_prefix + path + "?v=" + version[:5]
         else:
             return base + static_url_prefix + path
 
@@ -1037,13 +1196,19 @@ class Application(object):
     keyword argument. We will serve those files from the /static/ URI
     (this is configurable with the static_url_prefix setting),
     and we will serve /favicon.ico and /robots.txt from the same directory.
+    The static_manifest setting names a JSON file of content hashes for
+    static_url, written by write_static_manifest; if the file does not
+    exist the hashes are computed once at startup.
     """
     def __init__(self, handlers=None, default_host="", transforms=None,
                  wsgi=False, **settings):
         if transforms is None:
             self.transforms = []
             if settings.get("gzip"):
-                self.transforms.append(GZipContentEncoding)
+                self.transforms.append(functools.partial(
+                    GZipContentEncoding,
+                    compress_level=settings.get("gzip_level",
+                        GZipContentEncoding.COMPRESS_LEVEL)))
             self.transforms.append(ChunkedTransferEncoding)
         else:
             self.transforms = transforms
@@ -1054,6 +1219,11 @@ class Application(object):
         self.ui_modules = {}
         self.ui_methods = {}
         self._wsgi = wsgi
+        self.static_manifest = None
+        if self.settings.get("static_path") and \
+           self.settings.get("static_manifest"):
+            self.static_manifest = load_static_manifest(
+                self.settings["static_manifest"], self.settings["static_path"])
         self._load_ui_modules(settings.get("ui_modules", {}))
         self._load_ui_methods(settings.get("ui_methods", {}))
         if self.settings.get("static_path"):
@@ -1215,6 +1385,7 @@ class Application(object):
                 for loader in RequestHandler._templates.values():
                     loader.reset()
             RequestHandler._static_hashes = {}
+            StaticFileHandler.clear_cache()
 
         handler._execute(transforms, *args, **kwargs)
         return handler
@@ -1310,15 +1481,44 @@ class StaticFileHandler(RequestHandler):
     with the path, we set an infinite HTTP expiration header. So, if you
     want browsers to cache a file indefinitely, send them to, e.g.,
     /static/images/myimage.png?v=xxx.
+
+    Responses carry an ETag built from the file's size and modification
+    time, and single-range Range requests are answered with 206 Partial
+    Content.  The stat() result of every file served is reused for
+    STAT_CACHE_TIME seconds, and files of up to CACHE_FILE_SIZE bytes are
+    kept in memory (together with their gzip encoding when the 'gzip'
+    setting is on).  Larger files are not read into memory: under
+    HTTPServer they are sent in STREAM_CHUNK_SIZE pieces, each read once
+    the previous one has been written to the socket.
     """
+    # Seconds for which a file's stat() result is reused
+    STAT_CACHE_TIME = 5
+    # Files up to this size are kept in memory
+    CACHE_FILE_SIZE = 64 * 1024
+    # Upper bound on the memory used by all cached files
+    CACHE_MAX_BYTES = 16 * 1024 * 1024
+    # Size of the pieces large files are streamed in
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    _files = {}
+    _cached_bytes = [0]
+
     def initialize(self, path, default_filename=None):
         self.root = os.path.abspath(path) + os.path.sep
         self.default_filename = default_filename
+        self._stream_file = None
+
+    @classmethod
+    def clear_cache(cls):
+        """Forgets all cached stat() results and file contents."""
+        StaticFileHandler._files.clear()
+        StaticFileHandler._cached_bytes[0] = 0
 
     def head(self, path):
         self.get(path, include_body=False)
 
     def get(self, path, include_body=True):
+        url_path = path
         if os.path.sep != "/":
             path = path.replace("/", os.path.sep)
         abspath = os.path.abspath(os.path.join(self.root, path))
@@ -1326,7 +1526,9 @@ class StaticFileHandler(RequestHandler):
         # it needs to be temporarily added back for requests to root/
         if not (abspath + os.path.sep).startswith(self.root):
             raise HTTPError(403, "%s is not in root static directory", path)
-        if os.path.isdir(abspath) and self.default_filename is not None:
+        static_file = self._get_file(abspath)
+        if static_file is not None and static_file.is_dir and \
+           self.default_filename is not None:
             # need to look at the request.path here for when path is empty
             # but there is some prefix to the path that was already
             # trimmed by the routing
@@ -1334,49 +1536,269 @@ class StaticFileHandler(RequestHandler):
                 self.redirect(self.request.path + "/")
                 return
             abspath = os.path.join(abspath, self.default_filename)
-        if not os.path.exists(abspath):
+            static_file = self._get_file(abspath)
+        if static_file is None:
             raise HTTPError(404)
-        if not os.path.isfile(abspath):
+        if not static_file.is_file:
             raise HTTPError(403, "%s is not a file", path)
 
-        stat_result = os.stat(abspath)
-        modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
-
-        self.set_header("Last-Modified", modified)
         if "v" in self.request.arguments:
             self.set_header("Expires", datetime.datetime.utcnow() + \
                                        datetime.timedelta(days=365*10))
-            self.set_header("Cache-Control", "max-age=" + str(86400*365*10))
+            cache_control = "max-age=" + str(86400*365*10)
+            if self._is_current_version(url_path):
+                # The URL changes whenever the content does
+                cache_control += ", public, immutable"
+            self.set_header("Cache-Control", cache_control)
         else:
             self.set_header("Cache-Control", "public")
-        mime_type, encoding = mimetypes.guess_type(abspath)
-        if mime_type:
-            self.set_header("Content-Type", mime_type)
+        if static_file.mime_type:
+            self.set_header("Content-Type", static_file.mime_type)
+        self.set_header("Accept-Ranges", "bytes")
 
         self.set_extra_headers(path)
 
-        # Check the If-Modified-Since, and don't send the result if the
-        # content has not been modified
-        ims_value = self.request.headers.get("If-Modified-Since")
-        if ims_value is not None:
-            date_tuple = email.utils.parsedate(ims_value)
-            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-            if if_since >= modified:
-                self.set_status(304)
-                return
+        # Check the If-None-Match and If-Modified-Since headers, and don't
+        # send the result if the content has not been modified
+        if self.check_conditional_headers(static_file.etag,
+                                          static_file.modified):
+            return
+
+        size = static_file.size
+        byte_range = self._get_range(static_file)
+        if byte_range is False:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            self.finish()
+            return
+        start, end = byte_range or (0, size)
+        if byte_range:
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, end - 1, size))
 
         if not include_body:
+            self.set_header("Content-Length", end - start)
+            return
+        data = self._load(static_file)
+        if data is not None:
+            if byte_range:
+                self.finish(data[start:end])
+            else:
+                self.finish_precompressed(data, static_file.gzip_data,
+                                          static_file.etag)
             return
+        self.set_header("Content-Length", end - start)
         file = open(abspath, "rb")
-        try:
-            self.write(file.read())
-        finally:
-            file.close()
+        if self.application._wsgi:
+            try:
+                file.seek(start)
+                self.finish(file.read(end - start))
+            finally:
+                file.close()
+            return
+        file.seek(start)
+        self._stream_file = file
+        self._stream_remaining = end - start
+        self._auto_finish = False
+        self._stream_next_chunk()
 
     def set_extra_headers(self, path):
         """For subclass to add extra headers to the response"""
         pass
 
+    def on_connection_close(self):
+        self._close_stream_file()
+
+    def _is_current_version(self, path):
+        """Returns True if the "v" argument is the one static_url gives."""
+        manifest = self.application.static_manifest
+        if manifest is None or self.settings.get("debug"):
+            return False
+        version = manifest.get(path)
+        return bool(version) and \
+            self.get_argument("v", None) == version[:5]
+
+    def _get_file(self, abspath):
+        """Returns the _StaticFile for abspath, or None if it is missing."""
+        now = time.time()
+        static_file = StaticFileHandler._files.get(abspath)
+        if static_file is not None and \
+           now - static_file.checked < self.STAT_CACHE_TIME:
+            return static_file
+        try:
+            stat_result = os.stat(abspath)
+        except OSError:
+            stat_result = None
+        if stat_result is None or static_file is None or \
+           not static_file.matches(stat_result):
+            if static_file is not None:
+                self._forget(static_file)
+            if stat_result is None:
+                return None
+            static_file = _StaticFile(abspath, stat_result)
+            StaticFileHandler._files[abspath] = static_file
+        static_file.checked = now
+        return static_file
+
+    def _forget(self, static_file):
+        if static_file.data is not None:
+            StaticFileHandler._cached_bytes[0] -= len(static_file.data)
+        StaticFileHandler._files.pop(static_file.path, None)
+
+    def _load(self, static_file):
+        """Returns the contents of a small file, or None for a large one."""
+        if static_file.data is not None:
+            return static_file.data
+        if static_file.size > self.CACHE_FILE_SIZE:
+            return None
+        file = open(static_file.path, "rb")
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        if len(data) != static_file.size:
+            # Changed since it was stat()ed; serve it but don't keep it
+            return data
+        if self.settings.get("gzip"):
+            static_file.gzip_data = gzip_encode(
+                data, self.settings.get("gzip_level",
+                                        GZipContentEncoding.COMPRESS_LEVEL),
+                static_file.mime_type)
+        if StaticFileHandler._cached_bytes[0] + len(data) <= \
+           self.CACHE_MAX_BYTES and \
+           StaticFileHandler._files.get(static_file.path) is static_file:
+            static_file.data = data
+            StaticFileHandler._cached_bytes[0] += len(data)
+        return data
+
+    def _get_range(self, static_file):
+        """Returns the (start, end) byte range requested by the client.
+
+        Returns None to send the whole file (no Range header, or one we
+        don't support, such as multiple ranges) and False if the range
+        cannot be satisfied.
+        """
+        header = self.request.headers.get("Range", "")
+        if not header.startswith("bytes=") or "," in header:
+            return None
+        if_range = self.request.headers.get("If-Range")
+        if if_range is not None and if_range != '"%s"' % static_file.etag:
+            return None
+        start, sep, end = header[len("bytes="):].strip().partition("-")
+        size = static_file.size
+        try:
+            if start:
+                start = int(start)
+                end = end and int(end) + 1 or size
+            else:
+                start = max(size - int(end), 0)
+                end = size
+        except ValueError:
+            return None
+        if start >= size:
+            return False
+        if end <= start:
+            return None
+        return start, min(end, size)
+
+    def _stream_next_chunk(self):
+        if self._stream_file is None:
+            return
+        if self._stream_remaining <= 0:
+            self._close_stream_file()
+            self.finish()
+            return
+        data = self._stream_file.read(
+            min(self.STREAM_CHUNK_SIZE, self._stream_remaining))
+        if not data:
+            # The file was truncated while we were sending it
+            self._close_stream_file()
+            self.request.connection.stream.close()
+            return
+        self._stream_remaining -= len(data)
+        self.write(data)
+        self.flush(callback=self._stream_next_chunk)
+
+    def _close_stream_file(self):
+        if self._stream_file is not None:
+            self._stream_file.close()
+            self._stream_file = None
+
+
+def build_static_manifest(static_path):
+    """Returns a {path: MD5 hex digest} manifest of the files under static_path.
+
+    Paths are relative to static_path and use forward slashes, as they are
+    passed to static_url.
+    """
+    static_path = os.path.abspath(static_path)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(static_path):
+        for filename in filenames:
+            abspath = os.path.join(dirpath, filename)
+            path = abspath[len(static_path):].lstrip(os.path.sep)
+            f = open(abspath, "rb")
+            try:
+                manifest[path.replace(os.path.sep, "/")] = \
+                    hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+    return manifest
+
+
+def write_static_manifest(static_path, filename):
+    """Writes the manifest of static_path to filename as JSON.
+
+    Run this when building a release so that processes don't have to hash
+    the static files (which on some platforms, such as App Engine, they
+    cannot even read).
+    """
+    f = open(filename, "w")
+    try:
+        f.write(escape.json_encode(build_static_manifest(static_path)))
+    finally:
+        f.close()
+
+
+def load_static_manifest(filename, static_path):
+    """Reads a manifest written by write_static_manifest.
+
+    If filename does not exist, the manifest of static_path is built
+    instead.
+    """
+    try:
+        f = open(filename)
+    except IOError:
+        logging.warning("No static manifest at %s; hashing %s",
+                        filename, static_path)
+        return build_static_manifest(static_path)
+    try:
+        return escape.json_decode(f.read())
+    finally:
+        f.close()
+
+
+class _StaticFile(object):
+    """What StaticFileHandler knows about one file."""
+    def __init__(self, path, stat_result):
+        self.path = path
+        self.is_file = stat.S_ISREG(stat_result.st_mode)
+        self.is_dir = stat.S_ISDIR(stat_result.st_mode)
+        self.size = stat_result.st_size
+        self.mtime = stat_result.st_mtime
+        self.modified = datetime.datetime.utcfromtimestamp(int(self.mtime))
+        self.etag = "%x-%x" % (int(self.mtime), self.size)
+        self.mime_type = mimetypes.guess_type(path)[0]
+        self.data = None
+        self.gzip_data = None
+        self.checked = 0
+
+    def matches(self, stat_result):
+        return stat_result.st_mtime == self.mtime and \
+            stat_result.st_size == self.size and \
+            stat.S_ISREG(stat_result.st_mode) == self.is_file
+
 
 class FallbackHandler(RequestHandler):
     """A RequestHandler that wraps another HTTP server callback.
@@ -1427,10 +1849,12 @@ class GZipContentEncoding(OutputTransform):
         "application/x-javascript", "application/xml", "application/atom+xml",
         "text/javascript", "application/json", "application/xhtml+xml"])
     MIN_LENGTH = 5
+    COMPRESS_LEVEL = 9
 
-    def __init__(self, request):
+    def __init__(self, request, compress_level=COMPRESS_LEVEL):
         self._gzipping = request.supports_http_1_1() and \
             "gzip" in request.headers.get("Accept-Encoding", "")
+        self._compress_level = compress_level
 
     def transform_first_chunk(self, headers, chunk, finishing):
         if self._gzipping:
@@ -1438,11 +1862,13 @@ class GZipContentEncoding(OutputTransform):
             self._gzipping = (ctype in self.CONTENT_TYPES) and \
                 (not finishing or len(chunk) >= self.MIN_LENGTH) and \
                 (finishing or "Content-Length" not in headers) and \
-                ("Content-Encoding" not in headers)
+                ("Content-Encoding" not in headers) and \
+                ("Content-Range" not in headers)
         if self._gzipping:
             headers["Content-Encoding"] = "gzip"
             self._gzip_value = cStringIO.StringIO()
-            self._gzip_file = gzip.GzipFile(mode="w", fileobj=self._gzip_value)
+            self._gzip_file = gzip.GzipFile(mode="w", fileobj=self._gzip_value,
+                                            compresslevel=self._compress_level)
             self._gzip_pos = 0
             chunk = self.transform_chunk(chunk, finishing)
             if "Content-Length" in headers:
@@ -1463,6 +1889,26 @@ class GZipContentEncoding(OutputTransform):
         return chunk
 
 
+def gzip_encode(data, compress_level=GZipContentEncoding.COMPRESS_LEVEL,
+                content_type=None):
+    """Returns data gzip-compressed, for use with finish_precompressed().
+
+    If content_type is given and GZipContentEncoding would not compress
+    that type (or data is too short), returns None instead.
+    """
+    if content_type is not None:
+        ctype = content_type.split(";")[0]
+        if ctype not in GZipContentEncoding.CONTENT_TYPES or \
+           len(data) < GZipContentEncoding.MIN_LENGTH:
+            return None
+    value = cStringIO.StringIO()
+    gzip_file = gzip.GzipFile(mode="w", fileobj=value,
+                              compresslevel=compress_level)
+    gzip_file.write(data)
+    gzip_file.close()
+    return value.getvalue()
+
+
 class ChunkedTransferEncoding(OutputTransform):
     """Applies the chunked transfer encoding to the response.
 
@@ -1636,6 +2082,17 @@ def _unicode(s):
     return s
 
 
+_GZIP_ETAG_SUFFIX = "-gzip"
+
+def _etag_matches(header, etag):
+    """Returns True if an If-None-Match header value lists etag."""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return '"%s"' % etag in [t.strip() for t in header.split(",")]
+
+
 def _time_independent_equals(a, b):
     if len(a) != len(b):
         return False